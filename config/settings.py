@@ -35,6 +35,42 @@ class Settings:
         self.openai_api_key = os.getenv("OPENAI_API_KEY", "")
         self.openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.siliconflow.cn/v1")
         self.llm_timeout_s = self._load_float_env("BOSS_LLM_TIMEOUT_S", 120.0)
+        # 流式请求是否附带 stream_options.include_usage（上游不支持时可关闭）
+        self.llm_stream_usage = self._load_int_env("BOSS_LLM_STREAM_USAGE", 1) > 0
+
+        # 服务端配置
+        self.max_queue_depth = self._load_int_env("BOSS_MAX_QUEUE_DEPTH", 4)
+        # 截止前提前生成追问的秒数（0 表示关闭）
+        self.followup_prefetch_s = self._load_float_env("BOSS_FOLLOWUP_PREFETCH_S", 0.0)
+        # 事件日志保留的最大事件数
+        self.event_log_capacity = self._load_int_env("BOSS_EVENT_LOG_CAPACITY", 1000)
+        # 按 message_id 缓存生成过程的保留时间（秒）与条数，用于断线续传和重复提交去重
+        self.turn_cache_ttl_s = self._load_float_env("BOSS_TURN_CACHE_TTL_S", 300.0)
+        self.turn_cache_size = self._load_int_env("BOSS_TURN_CACHE_SIZE", 32)
+        # 每个事件订阅者的队列容量（单次生成的订阅者队列满时合并 chunk，仍放不下则改从生成记录补齐）
+        self.event_queue_capacity = self._load_int_env("BOSS_EVENT_QUEUE_CAPACITY", 256)
+        # 流式片段合并窗口（毫秒，按片段密度在两者之间自适应）与单批最大字符数；最大窗口为 0 时不合并
+        self.chunk_coalesce_min_ms = self._load_float_env("BOSS_CHUNK_COALESCE_MIN_MS", 16.0)
+        self.chunk_coalesce_max_ms = self._load_float_env("BOSS_CHUNK_COALESCE_MAX_MS", 50.0)
+        self.chunk_coalesce_max_chars = self._load_int_env("BOSS_CHUNK_COALESCE_MAX_CHARS", 256)
+        # 启动后是否在后台预热（加载文档、拼装提示词、预先连接上游）
+        self.warmup_enabled = self._load_int_env("BOSS_WARMUP", 1) > 0
+        # 与上游空闲连接的保活时间（秒）
+        self.llm_keepalive_s = self._load_float_env("BOSS_LLM_KEEPALIVE_S", 120.0)
+        # 请求前对历史消息依次执行的裁剪阶段（格式见 core/pruning.py，off 表示不裁剪）
+        self.context_pruning = os.getenv("BOSS_CONTEXT_PRUNING", "tool_rounds:6,triggers:2,cap:2000:4")
+        # 上下文只保留最近的轮数（0 表示全部保留）；窗口之外按相关度召回的条数与 token 预算
+        self.context_window_turns = self._load_int_env("BOSS_CONTEXT_WINDOW_TURNS", 0)
+        self.recall_top_k = self._load_int_env("BOSS_RECALL_TOP_K", 3)
+        self.recall_token_budget = self._load_int_env("BOSS_RECALL_TOKEN_BUDGET", 1200)
+        # 历史记录中达到该长度的字符串按内容去重存储（共享一份）
+        self.history_intern_min_chars = self._load_int_env("BOSS_HISTORY_INTERN_MIN_CHARS", 64)
+        # 启动时先从文件末尾加载的最近记录数，较早的记录在后台补齐（0 表示启动时全部同步加载）
+        self.history_tail_records = self._load_int_env("BOSS_HISTORY_TAIL_RECORDS", 200)
+        # POST /history/import 每批写入的记录数（每批只提交一次存储）
+        self.history_import_batch = self._load_int_env("BOSS_HISTORY_IMPORT_BATCH", 500)
+        # 同时常驻内存的对话数（默认对话和设置了截止时间的对话不会被换出）
+        self.conversation_cache_size = self._load_int_env("BOSS_CONVERSATION_CACHE_SIZE", 4)
 
         # Agent 配置
         self.agent_name = "CyberBoss"
@@ -42,6 +78,8 @@ class Settings:
         # 数据文件
         self.memory_file = os.path.join(self.data_dir, "conversation_history.json")
         self.task_state_file = os.path.join(self.data_dir, "task_state.json")
+        self.recall_index_file = os.path.join(self.data_dir, "recall_index.json")
+        self.token_calibration_file = os.path.join(self.data_dir, "token_calibration.json")
         self.documents_dir = os.path.join(self.data_dir, "文案")
 
         # 提示词文件
@@ -88,6 +126,16 @@ class Settings:
         except (TypeError, ValueError):
             return default
 
+    def _load_int_env(self, key: str, default: int) -> int:
+        """安全解析整数环境变量"""
+        raw = os.getenv(key)
+        if raw is None:
+            return default
+        try:
+            return int(raw)
+        except (TypeError, ValueError):
+            return default
+
     def _load_runtime_config(self) -> dict:
         """加载运行时配置"""
         if os.path.exists(self.runtime_config_file):
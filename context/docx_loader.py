@@ -4,7 +4,7 @@
 """
 import os
 import glob
-from docx import Document
+import threading
 from colorama import Fore, Style
 
 
@@ -14,6 +14,9 @@ class DocxLoader:
     def __init__(self, documents_dir: str):
         self.documents_dir = documents_dir
         self._content = None
+        self._tokens = None
+        # 预热线程与首个对话可能同时加载，只解析一次
+        self._load_lock = threading.Lock()
     
     def load(self) -> str:
         """
@@ -24,19 +27,26 @@ class DocxLoader:
         """
         if self._content is not None:
             return self._content
-        
+        with self._load_lock:
+            if self._content is None:
+                self._content = self._parse()
+        return self._content
+
+    def _parse(self) -> str:
+        """解析目录下全部 docx 文件"""
         context_text = ""
         
         if not os.path.exists(self.documents_dir):
-            self._content = ""
             return ""
         
         docx_files = glob.glob(os.path.join(self.documents_dir, "*.docx"))
         
         if not docx_files:
-            self._content = ""
             return ""
         
+        # python-docx 导入较慢，只在确实有文档需要解析时加载
+        from docx import Document
+
         for file_path in docx_files:
             try:
                 doc = Document(file_path)
@@ -52,13 +62,27 @@ class DocxLoader:
             except Exception as e:
                 print(f"{Fore.YELLOW}无法读取文件 {file_path}: {e}{Style.RESET_ALL}")
         
-        self._content = context_text
-        return self._content
+        return context_text
     
+    def set_directory(self, documents_dir: str):
+        """切换文档目录，内容在下次 load 时重新解析"""
+        with self._load_lock:
+            self.documents_dir = documents_dir
+            self._content = None
+            self._tokens = None
+
     def reload(self) -> str:
         """强制重新加载文档"""
         self._content = None
+        self._tokens = None
         return self.load()
+
+    def get_token_count(self) -> int:
+        """文档内容的估算 token 数（随解析结果缓存）"""
+        if self._tokens is None:
+            from core.tokens import estimate_tokens
+            self._tokens = estimate_tokens(self.load())
+        return self._tokens
     
     def get_file_count(self) -> int:
         """获取文档数量"""
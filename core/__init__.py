@@ -1,7 +1,29 @@
 """
 CyberBoss 核心模块
 """
-from .agent import BossAgent
-from .scheduler import TaskScheduler
-from .memory import Memory
-from .llm import LLMClient
+from importlib import import_module
+
+from .errors import GenerationCancelled
+from .events import EventBus, EventLog, Subscription
+
+# 依赖 openai/httpx/docx 的模块在首次访问时才导入，缩短服务端冷启动时间
+_LAZY_EXPORTS = {
+    "BossAgent": ".agent",
+    "TaskScheduler": ".scheduler",
+    "Memory": ".memory",
+    "Conversation": ".conversations",
+    "ConversationManager": ".conversations",
+    "LLMClient": ".llm",
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+__all__ = ["BossAgent", "GenerationCancelled", "TaskScheduler", "Memory", "Conversation", "ConversationManager", "LLMClient", "EventBus", "EventLog", "Subscription"]
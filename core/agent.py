@@ -7,15 +7,20 @@ import json
 import re
 import threading
 import traceback
+from datetime import datetime
 import httpx
 import openai
-from typing import List, Dict, Any, Tuple, Optional, Callable, TYPE_CHECKING
+from typing import List, Dict, Any, Tuple, Optional, Callable, Sequence, TYPE_CHECKING
 from colorama import Fore, Style
 
 from config import settings
-from core.memory import Memory
+from core.coalesce import ChunkCoalescer
+from core.conversations import DEFAULT_CONVERSATION, Conversation
+from core.errors import GenerationCancelled
+from core.pruning import ContextPruner, is_system_trigger
+from core.recall import record_text
 from core.llm import LLMClient
-from core.scheduler import TaskScheduler
+from core.tokens import estimate_tokens, token_estimator
 from prompts import PromptLoader
 from context import DocxLoader
 if TYPE_CHECKING:
@@ -44,18 +49,20 @@ def _is_timeout_error(err: BaseException) -> bool:
 class BossAgent:
     """赛博司马特 - AI 老板 Agent"""
     
-    def __init__(self, ui: Optional["TerminalUI"] = None):
+    def __init__(self, ui: Optional["TerminalUI"] = None, conversation: Optional[Conversation] = None):
         # 初始化配置
         self.name = settings.agent_name
         
         # 初始化各模块
-        self.memory = Memory(settings.memory_file)
         self.llm = LLMClient(
             api_key=settings.openai_api_key,
             base_url=settings.openai_base_url,
             model=settings.llm_model,
-            timeout_s=settings.llm_timeout_s
+            timeout_s=settings.llm_timeout_s,
+            keepalive_s=settings.llm_keepalive_s,
+            stream_usage=settings.llm_stream_usage
         )
+        token_estimator.configure(model=settings.llm_model, state_file=settings.token_calibration_file)
         self.prompt_loader = PromptLoader(
             system_prompt_file=settings.system_prompt_file,
             context_intro_file=settings.context_intro_file
@@ -67,8 +74,8 @@ class BossAgent:
         else:
             self.ui = ui
         
-        # 初始化任务调度器
-        self.scheduler = TaskScheduler(settings.task_state_file)
+        # 当前对话：历史存储、任务调度器与召回/检索索引都属于对话
+        self.bind_conversation(conversation or Conversation(DEFAULT_CONVERSATION))
 
         # 工具定义与处理器
         self.tools = self._build_tools()
@@ -84,21 +91,59 @@ class BossAgent:
         self._input_ready = threading.Event()
         self._pending_input = None
         self._auto_followup_triggered = threading.Event()
+
+        # 预生成期间暂存调度器操作，发布时再执行
+        self._deferred_actions: Optional[List[Callable[[], None]]] = None
+
+        # 最近一次生成中各段流式输出的合并统计
+        self._stream_stats: List[Dict[str, Any]] = []
+
+        # 请求前的历史裁剪阶段链，以及最近一次裁剪的报告
+        self.pruner = ContextPruner.from_spec(settings.context_pruning)
+        self._prune_report: Dict[str, Any] = {}
+
+        # 最近一次请求的 token 估算明细、未校准的估算值，以及上游返回的 usage
+        self._token_estimate: Dict[str, int] = {}
+        self._request_raw = 0.0
+        self._usage: List[Dict[str, int]] = []
+        self._tools_json = json.dumps(self.tools, ensure_ascii=False)
+
+    def bind_conversation(self, conversation: Conversation):
+        """
+        切换到另一个对话（调用方需保证此时没有正在进行的生成）
+
+        之后的生成、追问与调度器操作都作用于该对话。
+        """
+        self.conversation = conversation
+        self.memory = conversation.memory
+        self.scheduler = conversation.scheduler
+        self.recall = conversation.recall
+        self.search_index = conversation.search_index
     
-    def build_messages(self, user_input: str) -> List[Dict]:
+    def load_document_context(self) -> str:
+        """加载文档上下文（只解析一次，可由预热线程提前调用）"""
+        if self.document_context is None:
+            self.document_context = self.doc_loader.load()
+        return self.document_context
+
+    def warm_up_prompt(self) -> int:
+        """预先读取提示词文件并拼好固定部分，返回系统提示词长度"""
+        self.prompt_loader.load_system_prompt()
+        return len(self.prompt_loader.build_system_content(self.load_document_context()))
+
+    def build_messages(self, user_input: str, history_limit: Optional[int] = None) -> List[Dict]:
         """
         构建发送给 LLM 的消息列表
         
         Args:
             user_input: 用户输入
+            history_limit: 只使用前若干条历史记录（重试时为重试点之前的历史）
             
         Returns:
             消息列表
         """
         # 获取系统提示词内容（按需加载文档上下文）
-        if self.document_context is None:
-            self.document_context = self.doc_loader.load()
-        system_content = self.prompt_loader.build_system_content(self.document_context)
+        system_content = self.prompt_loader.build_system_content(self.load_document_context())
         scheduler_status = self.scheduler.get_status()
         if scheduler_status.get("active"):
             remaining = max(0, int(scheduler_status.get("remaining_seconds", 0) // 60))
@@ -115,38 +160,115 @@ class BossAgent:
             {"role": "system", "content": system_content}
         ]
         
-        # 添加历史对话（阶段二：使用完整消息格式）
-        for record in self.memory.get_all():
-            # 新格式：直接展开完整消息列表
-            if "messages" in record:
-                messages.extend(record["messages"])
-            # 向后兼容旧格式（如果存在）
-            elif "user_input" in record and "response" in record:
-                messages.append({"role": "user", "content": record["user_input"]})
-                messages.append({"role": "assistant", "content": record["response"]})
+        # 添加历史对话（阶段二：使用完整消息格式），按轮次经过裁剪阶段链
+        records = self.memory.get_all(limit=history_limit)
+        window = settings.context_window_turns
+        window_start = max(0, len(records) - window) if window > 0 else 0
+        if not self.memory.is_loaded:
+            # 较早的记录仍在后台加载：本轮只带已加载的尾部，不等待全部加载完成
+            window_start = max(window_start, self.memory.loaded_start)
+        history_messages, self._prune_report = self._build_history_prefix(records, window_start)
+        messages.extend(history_messages)
+
+        # 窗口之外的相关旧对话
+        recalled = self._build_recall_context(user_input, records, window_start)
+        if recalled:
+            messages.append({"role": "system", "content": recalled})
         
         # 添加当前用户输入
         messages.append({"role": "user", "content": user_input})
+
+        self._token_estimate = {
+            "system": token_estimator.count_message(messages[0]),
+            "history": token_estimator.count_messages(history_messages),
+            "history_stored": self.memory.total_tokens(),
+            "recall": token_estimator.count(recalled),
+            "input": token_estimator.count(user_input),
+            "tools": token_estimator.count(self._tools_json),
+        }
+        self._request_raw = self._request_raw_tokens(messages, with_tools=True)
+        self._token_estimate["total"] = int(round(self._request_raw * token_estimator.factor))
         
         return messages
     
+    def _build_history_prefix(self, records: Sequence[Dict], window_start: int) -> Tuple[List[Dict], Dict[str, Any]]:
+        """
+        窗口内的历史经裁剪阶段链后的消息列表，按对话缓存
+
+        历史未变化时（同一版本、同样的记录数与窗口）直接复用上次的结果，
+        避免定时追问、预生成等连续请求重复遍历和裁剪全部历史。
+        """
+        key = (self.memory.version, len(records), window_start)
+        cached = self.conversation.prefix_cache
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+        turns = []
+        for record in records[window_start:]:
+            # 新格式：直接使用完整消息列表
+            if "messages" in record:
+                turns.append(record["messages"])
+            # 向后兼容旧格式（如果存在）
+            elif "user_input" in record and "response" in record:
+                turns.append([
+                    {"role": "user", "content": record["user_input"]},
+                    {"role": "assistant", "content": record["response"]}
+                ])
+        history_messages, report = self.pruner.run(turns)
+        self.conversation.prefix_cache = (key, history_messages, report)
+        return history_messages, report
+
+    def _build_recall_context(self, user_input: str, records: List[Dict], window_start: int) -> str:
+        """
+        从上下文窗口之前的记录中召回与当前输入最相关的几轮对话
+
+        系统触发的输入没有话题信息，改用最近一轮对话作为查询。
+        召回内容按时间顺序排列，总量不超过 recall_token_budget。
+        """
+        if window_start <= 0 or settings.recall_top_k <= 0 or settings.recall_token_budget <= 0:
+            return ""
+        # 较早的记录仍在后台加载时不等待，本轮先不召回
+        if not self.memory.is_loaded:
+            return ""
+        query = user_input
+        if is_system_trigger({"role": "user", "content": user_input}):
+            query = record_text(records[-1]) if records else ""
+        hits = self.recall.search(query, records, top_k=settings.recall_top_k, limit=window_start)
+        budget = settings.recall_token_budget
+        selected = []
+        for record_index, _ in hits:
+            record = records[record_index]
+            text = f"[{record.get('timestamp', '')}]\n{record_text(record)}"
+            tokens = estimate_tokens(text)
+            if tokens > budget:
+                continue
+            budget -= tokens
+            selected.append((record_index, text))
+        if not selected:
+            return ""
+        selected.sort()
+        return "以下是与当前话题相关的较早对话（仅供参考）：\n\n" + "\n\n".join(text for _, text in selected)
+
     def generate_response(
         self,
         user_input: str,
         event_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
-        message_id: Optional[str] = None
+        message_id: Optional[str] = None,
+        history_limit: Optional[int] = None
     ) -> Tuple[str, List[Dict], bool]:
         """
         生成回复并流式打印
         
         Args:
             user_input: 用户输入
+            history_limit: 只使用前若干条历史记录（见 build_messages）
             
         Returns:
             完整的回复内容、本轮对话消息列表、是否写入历史记录
         """
-        messages = self.build_messages(user_input)
+        messages = self.build_messages(user_input, history_limit=history_limit)
         self.ui.print_agent_prefix()
+        self._stream_stats = []
+        self._usage = []
 
         if not self.llm.is_ready:
             error_text = "错误：未配置有效的 OpenAI API Key，无法进行对话。"
@@ -167,6 +289,9 @@ class BossAgent:
                 event_callback=event_callback,
                 message_id=message_id
             )
+        except GenerationCancelled:
+            self.ui.print_newline()
+            raise
         except Exception as err:
             error_trace = traceback.format_exc()
             is_timeout = _is_timeout_error(err)
@@ -266,6 +391,13 @@ class BossAgent:
             self._process_deadline(full_response, tool_used=tool_used)
         return full_response, conversation_messages, should_save
 
+    def _scheduler_action(self, action: Callable, *args: Any):
+        """执行调度器操作；预生成期间先记录，等发布时再执行"""
+        if self._deferred_actions is not None:
+            self._deferred_actions.append(lambda: action(*args))
+            return
+        action(*args)
+
     def _process_deadline(self, response: str, tool_used: bool):
         """从回复中解析截止时间并设置调度器（工具调用失败时的兜底）"""
         if tool_used:
@@ -273,10 +405,10 @@ class BossAgent:
         minutes = self.scheduler.parse_deadline(response)
         if minutes is not None:
             if minutes > 0:
-                self.scheduler.set_deadline(minutes)
+                self._scheduler_action(self.scheduler.set_deadline, minutes)
             else:
                 # minutes == 0 表示任务完成
-                self.scheduler.clear_deadline()
+                self._scheduler_action(self.scheduler.clear_deadline)
 
     def _build_tools(self) -> List[Dict[str, Any]]:
         """构建工具定义"""
@@ -325,15 +457,15 @@ class BossAgent:
         status = self.scheduler.get_status()
         if status.get("active"):
             old_remaining = status.get("remaining_seconds", 0) // 60
-            self.scheduler.set_deadline(minutes_int)
+            self._scheduler_action(self.scheduler.set_deadline, minutes_int)
             return f"已覆盖之前的定时器（原剩余 {old_remaining} 分钟），新的截止时间：{minutes_int}分钟"
         else:
-            self.scheduler.set_deadline(minutes_int)
+            self._scheduler_action(self.scheduler.set_deadline, minutes_int)
             return f"已设置截止时间：{minutes_int}分钟"
 
     def _tool_clear_deadline(self, **_unused: Any) -> str:
         """工具：清除截止时间"""
-        self.scheduler.clear_deadline()
+        self._scheduler_action(self.scheduler.clear_deadline)
         return "截止时间已清除"
 
     def _execute_tool_calls(
@@ -483,6 +615,57 @@ class BossAgent:
         )
         return cleaned, True, tool_calls, tool_messages
 
+    def _make_coalescer(
+        self,
+        event_callback: Optional[Callable[[Dict[str, Any]], None]],
+        message_id: Optional[str]
+    ) -> ChunkCoalescer:
+        """创建合并器：合并后的文本一次性发出 chunk 事件并写入终端"""
+        def emit(text: str):
+            if event_callback:
+                event_callback({"type": "chunk", "content": text, "message_id": message_id})
+            self.ui.print_stream(text)
+
+        return ChunkCoalescer(
+            emit,
+            min_interval_s=settings.chunk_coalesce_min_ms / 1000,
+            max_interval_s=settings.chunk_coalesce_max_ms / 1000,
+            max_chars=settings.chunk_coalesce_max_chars
+        )
+
+    def get_stream_stats(self) -> Dict[str, Any]:
+        """最近一次生成的流式合并统计（flush 次数、批大小、首次发出耗时）"""
+        return ChunkCoalescer.merge_stats(self._stream_stats)
+
+    def _request_raw_tokens(self, messages: List[Dict], with_tools: bool) -> float:
+        raw = sum(token_estimator.message_raw(message) for message in messages)
+        return raw + token_estimator.raw(self._tools_json) if with_tools else raw
+
+    def _observe_usage(self, messages: List[Dict], with_tools: bool):
+        """记录一次请求的真实 usage，并用 prompt_tokens 修正估算系数"""
+        usage = getattr(self.llm, "last_usage", None)
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        self._usage.append({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        token_estimator.observe(self._request_raw_tokens(messages, with_tools), prompt_tokens)
+
+    def get_token_report(self) -> Dict[str, Any]:
+        """最近一次生成的 token 估算明细与上游返回的真实 usage（未返回时为 None）"""
+        usage = None
+        if self._usage:
+            usage = {
+                "prompt_tokens": sum(item["prompt_tokens"] for item in self._usage),
+                "completion_tokens": sum(item["completion_tokens"] for item in self._usage),
+                "requests": len(self._usage)
+            }
+        return {"estimate": dict(self._token_estimate), "usage": usage, "factor": token_estimator.factor}
+
+    def get_prune_report(self) -> Dict[str, Any]:
+        """最近一次构建消息时的历史裁剪报告（各阶段节省的 token 数）"""
+        return dict(self._prune_report)
+
     def _stream_with_tools(
         self,
         messages: List[Dict],
@@ -492,45 +675,56 @@ class BossAgent:
         """流式请求首轮回复并解析工具调用"""
         full_response = ""
         tool_call_map: Dict[int, Dict[str, Any]] = {}
-
-        for chunk in self.llm.chat_stream_chunks(messages, tools=self.tools, tool_choice="auto"):
-            choice = chunk.choices[0]
-            delta = choice.delta
-
-            if delta.content:
-                if event_callback:
-                    event_callback({"type": "chunk", "content": delta.content, "message_id": message_id})
-                self.ui.print_stream(delta.content)
-                full_response += delta.content
-
-            tool_calls_delta = getattr(delta, "tool_calls", None)
-            if tool_calls_delta:
-                for tool_call in tool_calls_delta:
-                    index = tool_call.index
-                    entry = tool_call_map.get(index)
-                    if entry is None:
-                        entry = {
-                            "id": tool_call.id,
-                            "type": "function",
-                            "function": {
-                                "name": "",
-                                "arguments": ""
-                            }
-                        }
-                        tool_call_map[index] = entry
-                    if tool_call.id:
-                        entry["id"] = tool_call.id
-                    if tool_call.function:
-                        if tool_call.function.name:
-                            entry["function"]["name"] = tool_call.function.name
-                        if tool_call.function.arguments:
-                            entry["function"]["arguments"] += tool_call.function.arguments
+        coalescer = self._make_coalescer(event_callback, message_id)
+        try:
+            for chunk in self.llm.chat_stream_chunks(messages, tools=self.tools, tool_choice="auto"):
+                full_response += self._consume_chunk(chunk, coalescer, tool_call_map)
+            self._stream_stats.append(coalescer.close())
+            self._observe_usage(messages, with_tools=True)
+        finally:
+            coalescer.close(flush=False)
 
         tool_calls = [tool_call_map[index] for index in sorted(tool_call_map.keys())]
         if not tool_calls:
             self.ui.print_newline()
         return full_response, tool_calls
 
+    @staticmethod
+    def _consume_chunk(chunk: Any, coalescer: ChunkCoalescer, tool_call_map: Dict[int, Dict[str, Any]]) -> str:
+        """处理一个流式 chunk：文本交给合并器，工具调用增量累积到 tool_call_map，返回文本"""
+        if not chunk.choices:
+            # 末尾只带 usage 的 chunk
+            return ""
+        choice = chunk.choices[0]
+        delta = choice.delta
+        content = delta.content or ""
+        if content:
+            coalescer.add(content)
+
+        tool_calls_delta = getattr(delta, "tool_calls", None)
+        if tool_calls_delta:
+            for tool_call in tool_calls_delta:
+                index = tool_call.index
+                entry = tool_call_map.get(index)
+                if entry is None:
+                    entry = {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {
+                            "name": "",
+                            "arguments": ""
+                        }
+                    }
+                    tool_call_map[index] = entry
+                if tool_call.id:
+                    entry["id"] = tool_call.id
+                if tool_call.function:
+                    if tool_call.function.name:
+                        entry["function"]["name"] = tool_call.function.name
+                    if tool_call.function.arguments:
+                        entry["function"]["arguments"] += tool_call.function.arguments
+        return content
+
     def _stream_response(
         self,
         messages: List[Dict],
@@ -539,13 +733,19 @@ class BossAgent:
     ) -> Tuple[str, bool]:
         """流式输出 LLM 回复并返回完整内容"""
         full_response = ""
+        coalescer = self._make_coalescer(event_callback, message_id)
         try:
             for chunk in self.llm.chat_stream(messages):
-                if event_callback:
-                    event_callback({"type": "chunk", "content": chunk, "message_id": message_id})
-                self.ui.print_stream(chunk)
+                coalescer.add(chunk)
                 full_response += chunk
+            self._stream_stats.append(coalescer.close())
+            self._observe_usage(messages, with_tools=False)
+        except GenerationCancelled:
+            coalescer.close(flush=False)
+            self.ui.print_newline()
+            raise
         except Exception as err:
+            coalescer.close(flush=False)
             error_trace = traceback.format_exc()
             is_timeout = _is_timeout_error(err)
             error_text = "请求超时，点击“重试”可再次生成。" if is_timeout else error_trace
@@ -600,14 +800,18 @@ class BossAgent:
             self.memory.add(conversation_messages, request_input=proactive_input)
         return response
     
+    def _build_auto_followup_input(self, at: Optional[datetime] = None) -> str:
+        """构建定时追问的系统触发文本"""
+        time_info = self.prompt_loader.get_time_info(at)
+        return f"（系统自动触发：任务截止时间已到，用户还没有任何回复。当前时间是 {time_info['time_str']} {time_info['weekday']}，现在是{time_info['time_period']}。之前你给用户布置了任务并设定了截止时间，现在时间到了他还没交付成果。请用非常严厉凶狠的语气骂他、训斥他。像老板发现员工拖延任务时那样愤怒地质问：时间到了东西呢？在干什么？是不是又在摸鱼？要直接骂出来，让他感受到你的怒火和不满。如果他还没完成，除了骂他，还要追问到底卡在哪里了，是能力不行还是态度有问题。语气要凶，要狠，要让他意识到拖延的严重性。）"
+
     def handle_auto_followup(
         self,
         event_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
         message_id: Optional[str] = None
     ):
         """处理定时自动触发的追问"""
-        time_info = self.prompt_loader.get_time_info()
-        auto_input = f"（系统自动触发：任务截止时间已到，用户还没有任何回复。当前时间是 {time_info['time_str']} {time_info['weekday']}，现在是{time_info['time_period']}。之前你给用户布置了任务并设定了截止时间，现在时间到了他还没交付成果。请用非常严厉凶狠的语气骂他、训斥他。像老板发现员工拖延任务时那样愤怒地质问：时间到了东西呢？在干什么？是不是又在摸鱼？要直接骂出来，让他感受到你的怒火和不满。如果他还没完成，除了骂他，还要追问到底卡在哪里了，是能力不行还是态度有问题。语气要凶，要狠，要让他意识到拖延的严重性。）"
+        auto_input = self._build_auto_followup_input()
         response, conversation_messages, should_save = self.generate_response(
             auto_input,
             event_callback=event_callback,
@@ -616,6 +820,47 @@ class BossAgent:
         if should_save:
             self.memory.add(conversation_messages, request_input=auto_input)
         return response
+
+    def prepare_auto_followup(
+        self,
+        at: Optional[datetime] = None,
+        event_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        提前生成定时追问，但不写入历史、不改动调度器
+        
+        Args:
+            at: 预计发布的时间点（用于提示词中的时间信息）
+            event_callback: 生成过程中的事件回调；抛出 GenerationCancelled 可中止预生成
+            
+        Returns:
+            可交给 commit_auto_followup 发布的结果；生成失败时返回 None
+        """
+        auto_input = self._build_auto_followup_input(at)
+        self._deferred_actions = []
+        try:
+            response, conversation_messages, should_save = self.generate_response(
+                auto_input,
+                event_callback=event_callback
+            )
+            actions = self._deferred_actions
+        finally:
+            self._deferred_actions = None
+        if not should_save:
+            return None
+        return {
+            "request_input": auto_input,
+            "response": response,
+            "messages": conversation_messages,
+            "actions": actions
+        }
+
+    def commit_auto_followup(self, prepared: Dict[str, Any]) -> str:
+        """发布预生成的追问：执行暂存的调度器操作并写入历史"""
+        for action in prepared["actions"]:
+            action()
+        self.memory.add(prepared["messages"], request_input=prepared["request_input"])
+        return prepared["response"]
     
     def handle_user_input(
         self,
@@ -674,6 +919,34 @@ class BossAgent:
             # 确保调度器正确停止
             self.scheduler.stop()
 
+    def reconfigure(self, changed: set) -> List[str]:
+        """
+        按变更项就地更新，不重建智能体（记忆与调度器状态保持不变）
+
+        Args:
+            changed: 发生变化的配置项，取值为 settings 的运行时配置键，
+                以及表示提示词文件已修改的 "prompts"
+
+        Returns:
+            实际执行的更新动作列表
+        """
+        applied = []
+        if changed & {"openai_api_key", "openai_base_url"}:
+            self.llm.set_connection(settings.openai_api_key, settings.openai_base_url)
+            applied.append("connection")
+        if "llm_model" in changed:
+            self.llm.model = settings.llm_model
+            token_estimator.configure(model=settings.llm_model)
+            applied.append("model")
+        if "documents_dir" in changed:
+            self.doc_loader.set_directory(settings.documents_dir)
+            self.document_context = None
+            applied.append("documents")
+        if "prompts" in changed:
+            self.prompt_loader.reload(settings.system_prompt_file, settings.context_intro_file)
+            applied.append("prompts")
+        return applied
+
     def shutdown(self):
         """停止后台资源（用于非交互模式）"""
         self.scheduler.stop()
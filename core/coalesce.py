@@ -0,0 +1,164 @@
+"""
+流式输出合并模块
+把密集的 token 片段按时间与大小合并后再发出，减少事件、写入和界面刷新的次数
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ChunkCoalescer:
+    """
+    流式片段合并器
+
+    第一个片段立即发出（不影响首字延迟），之后的片段先进入缓冲区，
+    满足以下任一条件时合并发出：
+    - 缓冲时间达到合并窗口（根据片段到达间隔在 min~max 之间自适应：
+      片段越密集窗口越长，片段本身稀疏时尽快发出）
+    - 缓冲字符数达到 max_chars
+    上游停顿时由后台线程按窗口到期发出，缓冲内容不会滞留。
+    emit 在内部锁内调用，保证发出顺序；后台线程中 emit 抛出的异常
+    会在生产者下一次 add/close 时重新抛出。
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[str], None],
+        min_interval_s: float = 0.016,
+        max_interval_s: float = 0.05,
+        max_chars: int = 256
+    ):
+        self._emit = emit
+        self.min_interval_s = max(0.0, min_interval_s)
+        self.max_interval_s = max(self.min_interval_s, max_interval_s)
+        self.max_chars = max(1, int(max_chars))
+        self._cond = threading.Condition()
+        self._buffer: List[str] = []
+        self._buffer_chars = 0
+        self._buffer_since: Optional[float] = None
+        self._last_add: Optional[float] = None
+        self._gap_ema: Optional[float] = None
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+        self._created = time.monotonic()
+        self._stats = {
+            "deltas": 0,
+            "flushes": 0,
+            "chars": 0,
+            "max_batch": 0,
+            "first_emit_ms": None,
+        }
+
+    @property
+    def interval_s(self) -> float:
+        """当前合并窗口"""
+        gap = self._gap_ema
+        if gap is None or self.max_interval_s <= 0:
+            return self.min_interval_s
+        density = min(1.0, max(0.0, 1.0 - gap / self.max_interval_s))
+        return self.min_interval_s + (self.max_interval_s - self.min_interval_s) * density
+
+    def add(self, text: str):
+        """加入一个片段"""
+        if not text:
+            return
+        now = time.monotonic()
+        with self._cond:
+            self._raise_pending()
+            if self._closed:
+                return
+            self._stats["deltas"] += 1
+            if self._last_add is not None:
+                gap = now - self._last_add
+                self._gap_ema = gap if self._gap_ema is None else self._gap_ema * 0.8 + gap * 0.2
+            self._last_add = now
+            self._buffer.append(text)
+            self._buffer_chars += len(text)
+            if self._buffer_since is None:
+                self._buffer_since = now
+            first = self._stats["flushes"] == 0
+            if first or self._buffer_chars >= self.max_chars or now - self._buffer_since >= self.interval_s:
+                self._flush_locked()
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="chunk-coalescer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """立即发出缓冲区内容（在发出其他类型事件之前调用以保持顺序）"""
+        with self._cond:
+            self._raise_pending()
+            self._flush_locked()
+
+    def close(self, flush: bool = True) -> Dict[str, Any]:
+        """结束合并：默认发出剩余内容，停止后台线程并返回统计"""
+        with self._cond:
+            if not self._closed:
+                self._closed = True
+                self._cond.notify_all()
+                if flush:
+                    self._raise_pending()
+                    self._flush_locked()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        return self.get_stats()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+        stats["avg_batch"] = round(stats["deltas"] / stats["flushes"], 2) if stats["flushes"] else 0.0
+        stats["interval_ms"] = round(self.interval_s * 1000, 1)
+        return stats
+
+    @staticmethod
+    def merge_stats(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """合并多段流式输出的统计（例如工具调用前后的两轮回复）"""
+        merged = {"deltas": 0, "flushes": 0, "chars": 0, "max_batch": 0, "first_emit_ms": None}
+        for stats in items:
+            for key in ("deltas", "flushes", "chars"):
+                merged[key] += stats.get(key, 0)
+            merged["max_batch"] = max(merged["max_batch"], stats.get("max_batch", 0))
+            if merged["first_emit_ms"] is None:
+                merged["first_emit_ms"] = stats.get("first_emit_ms")
+        merged["avg_batch"] = round(merged["deltas"] / merged["flushes"], 2) if merged["flushes"] else 0.0
+        return merged
+
+    def _raise_pending(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+        text = "".join(self._buffer)
+        batch = len(self._buffer)
+        self._buffer.clear()
+        self._buffer_chars = 0
+        self._buffer_since = None
+        stats = self._stats
+        stats["flushes"] += 1
+        stats["chars"] += len(text)
+        if batch > stats["max_batch"]:
+            stats["max_batch"] = batch
+        if stats["first_emit_ms"] is None:
+            stats["first_emit_ms"] = round((time.monotonic() - self._created) * 1000, 1)
+        self._emit(text)
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if not self._buffer or self._error is not None:
+                    self._cond.wait()
+                    continue
+                remaining = self._buffer_since + self.interval_s - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                try:
+                    self._flush_locked()
+                except BaseException as err:
+                    # 交给生产者线程处理（例如生成被取消）
+                    self._error = err
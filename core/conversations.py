@@ -0,0 +1,240 @@
+"""
+多对话管理模块
+每个具名对话拥有独立的历史存储、调度器、召回/检索索引与提示词前缀缓存；
+只有最近使用的对话常驻内存，其余的落盘后释放
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import settings
+from core.memory import Memory
+from core.recall import RecallIndex
+from core.search import HistorySearchIndex
+
+DEFAULT_CONVERSATION = "default"
+CONVERSATIONS_DIR = "conversations"
+
+_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+def is_valid_conversation_id(conversation_id: Any) -> bool:
+    """对话 ID 只允许字母、数字、下划线和连字符（同时用作目录名）"""
+    return isinstance(conversation_id, str) and bool(_ID_PATTERN.match(conversation_id))
+
+
+def conversation_dir(conversation_id: str) -> str:
+    """非默认对话的数据目录"""
+    return os.path.join(settings.data_dir, CONVERSATIONS_DIR, conversation_id)
+
+
+def conversation_paths(conversation_id: str) -> Dict[str, str]:
+    """
+    对话的数据文件路径
+
+    默认对话沿用原有文件位置，保持向后兼容；
+    其他对话在 conversations/<id>/ 下使用同名文件。
+    """
+    if conversation_id == DEFAULT_CONVERSATION:
+        return {
+            "memory": settings.memory_file,
+            "task_state": settings.task_state_file,
+            "recall_index": settings.recall_index_file,
+        }
+    base = conversation_dir(conversation_id)
+    return {
+        "memory": os.path.join(base, os.path.basename(settings.memory_file)),
+        "task_state": os.path.join(base, os.path.basename(settings.task_state_file)),
+        "recall_index": os.path.join(base, os.path.basename(settings.recall_index_file)),
+    }
+
+
+class Conversation:
+    """单个具名对话的全部状态"""
+
+    def __init__(self, conversation_id: str):
+        # 调度器依赖 colorama，在首次创建对话时才导入，服务端导入本模块时不必加载
+        from core.scheduler import TaskScheduler
+
+        self.id = conversation_id
+        self.paths = conversation_paths(conversation_id)
+        self.memory = Memory(
+            self.paths["memory"],
+            intern_min_chars=settings.history_intern_min_chars,
+            tail_records=settings.history_tail_records
+        )
+        self.scheduler = TaskScheduler(self.paths["task_state"])
+        # 上下文窗口之外的历史按相关度召回
+        self.recall = RecallIndex(self.paths["recall_index"])
+        self.memory.add_listener(self.recall.mark_dirty)
+        # 历史全文检索（首次检索时建立，之后增量更新）
+        self.search_index = HistorySearchIndex()
+        self.memory.add_listener(self.search_index.mark_dirty)
+        # 裁剪后的历史消息缓存：(键, 消息列表, 裁剪报告)，历史版本变化即失效
+        self.prefix_cache: Optional[Tuple[Tuple, List[Dict], Dict[str, Any]]] = None
+        self.last_used = time.time()
+        # 正在使用该对话的请求数，大于 0 时不会被换出
+        self.users = 0
+
+    @property
+    def has_deadline(self) -> bool:
+        """是否设置了截止时间（需要常驻内存才能按时触发）"""
+        return self.scheduler.deadline is not None
+
+    def get_summary(self) -> Dict[str, Any]:
+        """对话概要"""
+        return {
+            "conversation_id": self.id,
+            "resident": True,
+            "records": len(self.memory.get_all()),
+            "loaded": self.memory.is_loaded,
+            "deadline_active": self.has_deadline,
+            "last_used": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_used)),
+        }
+
+    def close(self):
+        """停止调度器；历史与任务状态在每次修改时已落盘"""
+        self.scheduler.stop()
+
+
+class ConversationManager:
+    """
+    对话的 LRU 缓存
+
+    最多常驻 capacity 个对话，超出时换出最久未使用的一个。
+    默认对话、正在被请求使用的对话，以及设置了截止时间的对话（换出后无法按时追问）
+    不会被换出，因此常驻数量可能暂时超过上限。
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        on_load: Optional[Callable[[Conversation], None]] = None,
+        on_evict: Optional[Callable[[Conversation], None]] = None
+    ):
+        self.capacity = max(1, int(capacity))
+        self.on_load = on_load
+        self.on_evict = on_evict
+        self._lock = threading.RLock()
+        self._resident: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._stats = {"loads": 0, "evictions": 0}
+
+    def exists(self, conversation_id: str) -> bool:
+        """对话是否已存在（常驻内存或已有数据目录）"""
+        if conversation_id == DEFAULT_CONVERSATION or conversation_id in self._resident:
+            return True
+        return os.path.isdir(conversation_dir(conversation_id))
+
+    def list_ids(self) -> List[str]:
+        """全部对话 ID：默认对话在前，其余按名称排序"""
+        root = os.path.join(settings.data_dir, CONVERSATIONS_DIR)
+        ids = set(self._resident)
+        if os.path.isdir(root):
+            ids.update(
+                name for name in os.listdir(root)
+                if is_valid_conversation_id(name) and os.path.isdir(os.path.join(root, name))
+            )
+        ids.discard(DEFAULT_CONVERSATION)
+        return [DEFAULT_CONVERSATION] + sorted(ids)
+
+    def acquire(self, conversation_id: str, create: bool = True) -> Conversation:
+        """
+        取得对话并标记为使用中（用完须调用 release）
+
+        Args:
+            conversation_id: 对话 ID
+            create: 对话不存在时是否新建；为 False 时抛出 KeyError
+        """
+        with self._lock:
+            conversation = self._resident.get(conversation_id)
+            if conversation is None:
+                if not create and not self.exists(conversation_id):
+                    raise KeyError(conversation_id)
+                conversation = self._load(conversation_id)
+            else:
+                self._resident.move_to_end(conversation_id)
+            conversation.users += 1
+            conversation.last_used = time.time()
+            self._evict()
+            return conversation
+
+    def release(self, conversation: Conversation):
+        """结束使用；超出容量的对话此时才能被换出"""
+        with self._lock:
+            conversation.users = max(0, conversation.users - 1)
+            self._evict()
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """返回常驻内存的对话（不触发加载）"""
+        with self._lock:
+            return self._resident.get(conversation_id)
+
+    def resident(self) -> List[Conversation]:
+        """常驻内存的对话，最近使用的在后"""
+        with self._lock:
+            return list(self._resident.values())
+
+    def load_scheduled(self) -> List[str]:
+        """启动时加载设置了截止时间的对话，让它们的定时追问照常触发"""
+        loaded = []
+        for conversation_id in self.list_ids():
+            if conversation_id in self._resident:
+                continue
+            if self._has_saved_deadline(conversation_paths(conversation_id)["task_state"]):
+                conversation = self.acquire(conversation_id, create=False)
+                self.release(conversation)
+                loaded.append(conversation_id)
+        return loaded
+
+    @staticmethod
+    def _has_saved_deadline(state_file: str) -> bool:
+        """任务状态文件中是否记录了截止时间（不必加载整个对话即可判断）"""
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                return bool(json.load(f).get("deadline"))
+        except (OSError, ValueError, AttributeError):
+            return False
+
+    def _load(self, conversation_id: str) -> Conversation:
+        conversation = Conversation(conversation_id)
+        self._resident[conversation_id] = conversation
+        self._stats["loads"] += 1
+        if self.on_load:
+            self.on_load(conversation)
+        return conversation
+
+    def _evict(self):
+        """从最久未使用的一端换出可换出的对话，直到回到容量以内"""
+        while len(self._resident) > self.capacity:
+            victim = next((
+                conversation for conversation in self._resident.values()
+                if conversation.id != DEFAULT_CONVERSATION
+                and conversation.users == 0
+                and not conversation.has_deadline
+            ), None)
+            if victim is None:
+                return
+            del self._resident[victim.id]
+            victim.close()
+            self._stats["evictions"] += 1
+            if self.on_evict:
+                self.on_evict(victim)
+
+    def close_all(self):
+        """停止所有常驻对话的调度器"""
+        with self._lock:
+            for conversation in self._resident.values():
+                conversation.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """常驻数量、容量与累计加载/换出次数"""
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "resident": list(self._resident),
+                **self._stats,
+            }
@@ -0,0 +1,8 @@
+"""
+核心异常定义
+单独成模块，服务端无需导入 agent（及其依赖的 openai 等重量级库）即可使用
+"""
+
+
+class GenerationCancelled(Exception):
+    """生成被调用方取消（由事件回调抛出，用于中断流式输出）"""
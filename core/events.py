@@ -0,0 +1,304 @@
+"""
+事件分发模块
+提供带序号的有界事件日志（供多个客户端按游标读取），
+以及生成端与消费者之间带有界队列的事件总线
+"""
+import threading
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional
+
+
+class EventLog:
+    """
+    有界事件环形缓冲区
+
+    每个事件写入时分配单调递增的序号（seq），读者只需记住自己读到的序号，
+    读取不会移除事件，因此任意多个客户端可以互不干扰地消费同一份日志。
+    """
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = max(1, int(capacity))
+        self._items = deque(maxlen=self.capacity)
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def last_seq(self) -> int:
+        """最新事件的序号（尚无事件时为 0）"""
+        with self._cond:
+            return self._next_seq - 1
+
+    def add_listener(self, listener: Callable[[], None]):
+        """注册追加事件时的通知回调（在写入线程中调用，需自行保证轻量）"""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]):
+        with self._cond:
+            try:
+                self._listeners.remove(listener)
+            except ValueError:
+                pass
+
+    def append(self, event: Dict[str, Any]) -> int:
+        """追加事件并唤醒等待中的读者，返回分配的序号"""
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._items.append({**event, "seq": seq})
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener()
+            except Exception:
+                pass
+        return seq
+
+    def read(self, after: Optional[int] = None, limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        读取序号大于 after 的事件
+
+        Args:
+            after: 读者已处理的最后一个序号；None 表示从当前末尾开始（只拿游标）
+            limit: 最多返回的事件数
+
+        Returns:
+            items: 事件列表；next: 下次读取应传入的游标；
+            gap: 读者落后于缓冲区、有事件已被覆盖时为 True
+        """
+        with self._cond:
+            return self._read_locked(after, limit)
+
+    def wait(self, after: Optional[int], timeout: float, limit: Optional[int] = None) -> Dict[str, Any]:
+        """与 read 相同，但没有新事件时最多阻塞 timeout 秒"""
+        with self._cond:
+            if after is not None and after == self._next_seq - 1:
+                self._cond.wait(timeout)
+            return self._read_locked(after, limit)
+
+    def _read_locked(self, after: Optional[int], limit: Optional[int]) -> Dict[str, Any]:
+        last_seq = self._next_seq - 1
+        if after is not None and after > last_seq:
+            # 游标超出日志末尾（服务端重启后序号从头开始）：报告断档，让读者从当前末尾重新同步
+            return {"items": [], "next": last_seq, "gap": True}
+        if after is None or after == last_seq:
+            return {"items": [], "next": last_seq, "gap": False}
+        first_seq = self._items[0]["seq"] if self._items else self._next_seq
+        gap = after < first_seq - 1
+        start = max(0, after + 1 - first_seq)
+        stop = None if limit is None else start + max(0, int(limit))
+        items: List[Dict[str, Any]] = list(islice(self._items, start, stop))
+        next_seq = items[-1]["seq"] if items else after
+        return {"items": items, "next": next_seq, "gap": gap}
+
+
+class Subscription:
+    """
+    事件总线的一个订阅者
+
+    生产者只把事件放进有界队列，由订阅者自己的线程取出并调用 handler，
+    慢消费者不会拖住生产者。队列满时按溢出策略处理：
+    merge —— 合并同一消息相邻的 chunk 腾出空间；
+    drop_oldest —— 丢弃最旧的非关键事件（只适合统计类订阅者），只剩关键事件时照常放入。
+    done/tool/error/replace 等关键事件在任何策略下都不会被丢弃。merge 策略下无法腾出空间时
+    订阅者溢出：不再接收新事件，队尾放入一个 overflow 事件（accepted 为此前接收的事件数），
+    由 handler 从自己的来源补齐之后的事件。
+    """
+
+    MERGE = "merge"
+    DROP_OLDEST = "drop_oldest"
+    OVERFLOW = "overflow"
+    # 丢失后客户端无法得到完整结果的事件
+    ESSENTIAL_TYPES = frozenset(("done", "tool", "error", "replace"))
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Dict[str, Any]], None],
+        capacity: int = 256,
+        policy: str = MERGE,
+        accept: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ):
+        self.name = name
+        self.handler = handler
+        self.capacity = max(1, int(capacity))
+        self.policy = policy if policy in (self.MERGE, self.DROP_OLDEST) else self.MERGE
+        self.accept = accept
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closing = False
+        self._overflowed = False
+        # 已接收（放入队列或并入队列中事件）的事件数
+        self._accepted = 0
+        self._counts = {"published": 0, "delivered": 0, "merged": 0, "dropped": 0, "errors": 0, "max_depth": 0}
+        self._thread = threading.Thread(target=self._run, name=f"bus-{name}", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _mergeable(first: Dict[str, Any], second: Dict[str, Any]) -> bool:
+        return (
+            first.get("type") == "chunk"
+            and second.get("type") == "chunk"
+            and first.get("message_id") == second.get("message_id")
+        )
+
+    @staticmethod
+    def _merge(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+        # 事件字典可能被其他订阅者共享，合并时生成新字典
+        return {**first, "content": (first.get("content") or "") + (second.get("content") or "")}
+
+    def offer(self, event: Dict[str, Any]):
+        """放入事件，从不阻塞等待消费者"""
+        with self._cond:
+            if self._closing:
+                return
+            self._counts["published"] += 1
+            if self._overflowed:
+                self._counts["dropped"] += 1
+                return
+            queue = self._queue
+            if len(queue) >= self.capacity:
+                room = self._make_room(event)
+                if room is None:
+                    self._overflow_locked()
+                    self._counts["dropped"] += 1
+                    return
+                if not room:
+                    self._accepted += 1
+                    return
+            queue.append(event)
+            self._accepted += 1
+            if len(queue) > self._counts["max_depth"]:
+                self._counts["max_depth"] = len(queue)
+            self._cond.notify()
+
+    def _make_room(self, event: Dict[str, Any]) -> Optional[bool]:
+        """
+        队列已满时腾出位置
+
+        Returns:
+            True 表示已腾出位置；False 表示事件已并入队尾、无需再追加；None 表示无法腾出位置
+        """
+        queue = self._queue
+        if self.policy == self.MERGE:
+            if self._mergeable(queue[-1], event):
+                queue[-1] = self._merge(queue[-1], event)
+                self._counts["merged"] += 1
+                return False
+            for index in range(len(queue) - 1):
+                if self._mergeable(queue[index], queue[index + 1]):
+                    queue[index] = self._merge(queue[index], queue[index + 1])
+                    del queue[index + 1]
+                    self._counts["merged"] += 1
+                    return True
+            return None
+        for index, queued in enumerate(queue):
+            if queued.get("type") not in self.ESSENTIAL_TYPES:
+                del queue[index]
+                self._counts["dropped"] += 1
+                return True
+        # 只剩关键事件：暂时超出容量，不丢弃
+        return True
+
+    def _overflow_locked(self):
+        self._overflowed = True
+        self._queue.append({"type": self.OVERFLOW, "subscription": self.name, "accepted": self._accepted})
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                event = self._queue.popleft()
+            try:
+                self.handler(event)
+                delivered = True
+            except Exception:
+                delivered = False
+            with self._cond:
+                self._counts["delivered" if delivered else "errors"] += 1
+
+    def close(self, timeout: Optional[float] = None):
+        """停止接收新事件，等待队列中剩余事件投递完毕"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "name": self.name,
+                "policy": self.policy,
+                "capacity": self.capacity,
+                "depth": len(self._queue),
+                "overflowed": self._overflowed,
+                **self._counts
+            }
+
+
+class EventBus:
+    """
+    生成端与各消费者之间的事件总线
+
+    publish 只把事件分发到各订阅者的有界队列，不会因为某个消费者写入缓慢而阻塞；
+    已退订的订阅者计数累计在 retired 中，便于观察整体丢弃/合并情况。
+    """
+
+    COUNTERS = ("published", "delivered", "merged", "dropped", "errors")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: List[Subscription] = []
+        self._retired = {key: 0 for key in self.COUNTERS}
+        self._retired["subscriptions"] = 0
+
+    def subscribe(
+        self,
+        name: str,
+        handler: Callable[[Dict[str, Any]], None],
+        capacity: int = 256,
+        policy: str = Subscription.MERGE,
+        accept: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ) -> Subscription:
+        subscription = Subscription(name, handler, capacity=capacity, policy=policy, accept=accept)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription, timeout: Optional[float] = None):
+        """移除订阅者；会先投递完它队列中剩余的事件"""
+        with self._lock:
+            try:
+                self._subscriptions.remove(subscription)
+            except ValueError:
+                return
+        subscription.close(timeout)
+        stats = subscription.get_stats()
+        with self._lock:
+            for key in self.COUNTERS:
+                self._retired[key] += stats[key]
+            self._retired["subscriptions"] += 1
+
+    def publish(self, event: Dict[str, Any]):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.accept is None or subscription.accept(event):
+                subscription.offer(event)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            retired = dict(self._retired)
+        return {
+            "subscribers": [subscription.get_stats() for subscription in subscriptions],
+            "retired": retired
+        }
@@ -11,23 +11,53 @@ from colorama import Fore, Style
 class LLMClient:
     """LLM 客户端类"""
     
-    def __init__(self, api_key: str, base_url: str, model: str, timeout_s: float = 120.0):
+    def __init__(self, api_key: str, base_url: str, model: str, timeout_s: float = 120.0,
+                 keepalive_s: float = 5.0, stream_usage: bool = True):
         self.model = model
         self.client = None
         self.timeout_s = timeout_s
-        
+        self.keepalive_s = keepalive_s
+        # 流式请求是否要求上游在末尾返回 usage，以及最近一次请求的 usage
+        self.stream_usage = stream_usage
+        self.last_usage: Optional[Any] = None
+        self.set_connection(api_key, base_url)
+
+    def set_connection(self, api_key: str, base_url: str):
+        """（重新）创建底层客户端；旧的连接池会被关闭"""
+        old_client, self.client = self.client, None
         if api_key:
             # 显式禁用代理，忽略系统环境变量中的代理配置 (HTTP_PROXY, HTTPS_PROXY 等)
             # 这可以解决因系统配置了不兼容的代理协议 (如 socks://) 而导致的启动失败问题
-            http_client = httpx.Client(proxy=None, timeout=httpx.Timeout(timeout_s))
+            http_client = httpx.Client(
+                proxy=None,
+                timeout=httpx.Timeout(self.timeout_s),
+                limits=httpx.Limits(keepalive_expiry=self.keepalive_s)
+            )
             self.client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
         else:
             print(f"{Fore.RED}警告：未配置有效的 OPENAI_API_KEY。请检查 .env。{Style.RESET_ALL}")
+        if old_client is not None:
+            try:
+                old_client.close()
+            except Exception:
+                pass
     
     @property
     def is_ready(self) -> bool:
         """检查客户端是否就绪"""
         return self.client is not None
+
+    def warm_up(self, timeout_s: float = 10.0) -> int:
+        """
+        发起一次轻量的 models 请求，提前完成 DNS/TLS 握手，连接留在连接池中供首次对话复用
+
+        Returns:
+            上游返回的模型数量
+        """
+        if not self.is_ready:
+            raise RuntimeError("错误：未配置有效的 OpenAI API Key，无法进行对话。")
+        page = self.client.models.list(timeout=timeout_s)
+        return len(getattr(page, "data", None) or [])
     
     def chat(self, messages: List[Dict], tools: Optional[List[Dict]] = None, tool_choice: Optional[str] = None) -> Any:
         """
@@ -67,7 +97,8 @@ class LLMClient:
             生成的文本片段
         """
         for chunk in self.chat_stream_chunks(messages, tools=tools, tool_choice=tool_choice):
-            if chunk.choices[0].delta.content is not None:
+            # 末尾的 usage chunk 没有 choices
+            if chunk.choices and chunk.choices[0].delta.content is not None:
                 yield chunk.choices[0].delta.content
 
     def chat_stream_chunks(
@@ -78,6 +109,7 @@ class LLMClient:
     ) -> Generator[Any, None, None]:
         """
         流式调用 LLM，返回原始 chunk 对象（用于处理工具调用）
+        开启 stream_usage 时最后一个 chunk 只带 usage、choices 为空，usage 同时记录到 last_usage
         """
         if not self.is_ready:
             raise RuntimeError("错误：未配置有效的 OpenAI API Key，无法进行对话。")
@@ -88,11 +120,17 @@ class LLMClient:
             "temperature": 0.7,
             "stream": True
         }
+        if self.stream_usage:
+            kwargs["stream_options"] = {"include_usage": True}
         if tools is not None:
             kwargs["tools"] = tools
         if tool_choice is not None:
             kwargs["tool_choice"] = tool_choice
         kwargs["timeout"] = self.timeout_s
+        self.last_usage = None
         stream = self.client.chat.completions.create(**kwargs)
         for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                self.last_usage = usage
             yield chunk
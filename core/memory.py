@@ -2,18 +2,213 @@
 对话记忆管理模块
 负责加载和保存对话历史
 """
+import hashlib
 import json
+import sys
+import threading
 import time
 import os
-from typing import List, Dict
+import uuid
+from typing import Any, Callable, Iterator, List, Dict, Optional, Sequence, Tuple
+
+from core.tokens import token_estimator
+
+
+# 文件格式版本：3 为按行存储（首行文件头，之后每行一条当前分支上的记录，字符串表在 .strings、
+# 非活动分支在 .branches 旁路文件）；2 为带字符串表的单个 JSON 对象，更早的版本为记录数组，
+# 加载后会改写为当前格式。
+# 按行格式只追加：同一序号后出现的行覆盖之前的行，分支操作在末尾追加标记行
+# {"l": 当前分支长度, "x": 下一个记录编号}，加载到标记行时丢弃该长度之后的记录；
+# .branches 中同一编号以最后一行为准。整体保存时才压缩掉被覆盖的行
+STORE_FORMAT = 3
+# 从文件末尾反向读取时每次读取的字节数
+TAIL_BLOCK_SIZE = 64 * 1024
+# 逐行格式按批解析的行数
+DECODE_BATCH_SIZE = 512
+# 引用字符串表的占位对象的键
+STRING_REF_KEY = "$str"
+
+
+def _string_key(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=12).hexdigest()
+
+
+_MESSAGE_FIELDS = frozenset(("role", "content", "tool_calls", "tool_call_id"))
+_RECORD_FIELDS = frozenset(("timestamp", "request_input", "messages"))
+
+
+class _StringRef:
+    """解析文件时遇到的字符串表引用，加载结束后统一还原"""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key: str):
+        self.key = key
+
+
+class CompactMessage:
+    """
+    紧凑的消息表示
+
+    常用字段放在 __slots__ 中（角色字符串经过 sys.intern 共享），
+    工具调用保存为紧凑的 JSON 字符串，其他少见字段放在 extra 中；
+    需要时通过 to_dict 生成普通字典。
+    """
+
+    __slots__ = ("role", "content", "tool_calls", "tool_call_id", "extra")
+
+    def __init__(self, data: Dict[str, Any], intern=None):
+        role = data.get("role")
+        self.role = sys.intern(role) if isinstance(role, str) else role
+        content = data.get("content")
+        self.content = intern(content) if intern else content
+        tool_calls = data.get("tool_calls")
+        self.tool_calls = json.dumps(tool_calls, ensure_ascii=False, separators=(",", ":")) if tool_calls else None
+        self.tool_call_id = data.get("tool_call_id")
+        self.extra = (
+            {key: value for key, value in data.items() if key not in _MESSAGE_FIELDS}
+            if data.keys() - _MESSAGE_FIELDS else None
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"role": self.role, "content": self.content}
+        if self.tool_calls is not None:
+            data["tool_calls"] = json.loads(self.tool_calls)
+        if self.tool_call_id is not None:
+            data["tool_call_id"] = self.tool_call_id
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class CompactRecord:
+    """
+    紧凑的对话记录：时间、请求输入与消息元组；旧格式记录的字段保留在 extra 中
+
+    node_id 是记录在对话树中的稳定编号，分支切换后记录序号会变，编号不变。
+    tokens 是全部消息未校准的估算 token 数，随记录行一起保存，None 表示尚未计算。
+    """
+
+    __slots__ = ("timestamp", "request_input", "messages", "extra", "node_id", "tokens")
+
+    def __init__(self, data: Dict[str, Any], intern=None):
+        self.node_id: Optional[int] = None
+        self.tokens: Optional[float] = None
+        self.timestamp = data.get("timestamp")
+        request_input = data.get("request_input")
+        self.request_input = intern(request_input) if intern else request_input
+        messages = data.get("messages")
+        self.messages: Optional[Tuple[CompactMessage, ...]] = (
+            tuple(
+                message if isinstance(message, CompactMessage) else CompactMessage(message, intern)
+                for message in messages
+            ) if isinstance(messages, list) else None
+        )
+        self.extra = (
+            {key: value for key, value in data.items() if key not in _RECORD_FIELDS}
+            if data.keys() - _RECORD_FIELDS else None
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {}
+        if self.timestamp is not None:
+            data["timestamp"] = self.timestamp
+        if self.request_input is not None:
+            data["request_input"] = self.request_input
+        if self.messages is not None:
+            data["messages"] = [message.to_dict() for message in self.messages]
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class BranchNode:
+    """
+    不在当前分支上的记录
+
+    parent 为父记录的编号（-1 表示对话开头）；active_child 为该分支上次接在它后面的记录编号，
+    切换回来时沿它恢复整条分支。
+    """
+
+    __slots__ = ("record", "parent", "active_child")
+
+    def __init__(self, record: CompactRecord, parent: int, active_child: Optional[int] = None):
+        self.record = record
+        self.parent = parent
+        self.active_child = active_child
+
+
+class HistoryView(Sequence):
+    """
+    历史记录的只读视图
+
+    按序号或切片访问时才把紧凑记录生成为普通字典，调用方拿到的字典可以随意使用，
+    不会影响存储中的记录。较早的记录仍在后台加载时，访问它们会等待加载完成。
+    """
+
+    def __init__(self, memory: "Memory", limit: Optional[int] = None):
+        self._memory = memory
+        self._limit = limit
+
+    def __len__(self) -> int:
+        count = len(self._memory._records)
+        return count if self._limit is None else min(self._limit, count)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._memory._record(i).to_dict() for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("history index out of range")
+        return self._memory._record(index).to_dict()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self._memory._record(i).to_dict()
 
 
 class Memory:
     """对话记忆管理类"""
     
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, intern_min_chars: int = 64, tail_records: int = 0):
         self.file_path = file_path
-        self.history: List[Dict] = []
+        self.strings_path = f"{file_path}.strings"
+        self.branches_path = f"{file_path}.branches"
+        # 当前分支上紧凑表示的记录；外部通过 get_all() 的字典视图访问。
+        # 尾部优先加载时，较早的记录在后台加载完成前为 None
+        self._records: List[Optional[CompactRecord]] = []
+        # 对话树：每条记录的父记录是当前分支上的前一条。重试产生的其他分支记录在 _branches 中
+        # （编号 -> BranchNode），_children 为父记录编号 -> 其下非活动记录的编号，用于列出同级分支
+        self._branches: Dict[int, BranchNode] = {}
+        self._children: Dict[int, List[int]] = {}
+        self._next_node = 0
+        self._node_lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._loaded.set()
+        # 后台加载完成前，从该序号起的记录已全部读入，可以直接访问
+        self._loaded_start = 0
+        # 启动时同步加载的最近记录数（0 表示全部同步加载）
+        self.tail_records = tail_records
+        # 内容寻址的字符串表（哈希 -> 文本）：达到长度阈值且重复出现的字符串在内存中共享同一对象，
+        # 在文件中只保存一份，记录里用 {"$str": 哈希} 引用
+        self.intern_min_chars = intern_min_chars
+        self._strings: Dict[str, str] = {}
+        # 已写入 .strings 文件的哈希
+        self._table_keys: set = set()
+        self._intern_stats: Dict[str, int] = {}
+        # 每次修改递增的版本号；store_id 区分不同进程/加载，二者共同构成 ETag
+        self.store_id = uuid.uuid4().hex[:12]
+        self.version = 0
+        # 记录序号 -> 已编码的 JSON 字节（含 record_index），修改时失效
+        self._encoded: Dict[int, bytes] = {}
+        # 当前分支上已计入 token 总数的记录（序号 -> 未校准估算值）与它们的和；
+        # 记录变化时只调整对应序号，_token_total 为 None 时整体重算
+        self._token_counts: Dict[int, float] = {}
+        self._token_total: Optional[float] = None
+        self._token_pending: set = set()
+        # 记录变化的监听者（例如召回索引），参数为记录序号，None 表示全部变化
+        self._listeners: List[Callable[[Optional[int]], None]] = []
         self._ensure_dir()
         self.load()
     
@@ -23,44 +218,736 @@ class Memory:
         if dir_path and not os.path.exists(dir_path):
             os.makedirs(dir_path, exist_ok=True)
     
-    def load(self) -> List[Dict]:
-        """加载历史对话记录"""
+    def load(self) -> Sequence[Dict]:
+        """
+        加载历史对话记录
+
+        当前格式下先从文件末尾读取最近 tail_records 条记录，立即可用，
+        较早的记录由后台线程补齐；旧格式文件整体加载后改写为当前格式，
+        无法解析时原文件改名为 .bak 保留，不会被覆盖。
+        """
+        self._loaded.wait()
+        self._strings = {}
+        self._table_keys = set()
+        self._intern_stats = {}
+        self._records = []
+        self._branches = {}
+        self._children = {}
+        self._next_node = 0
+        self._loaded_start = 0
+        header = None
         if os.path.exists(self.file_path):
+            with open(self.file_path, 'rb') as f:
+                first_line = f.readline()
+            try:
+                header = json.loads(first_line)
+            except ValueError:
+                header = None
+            if isinstance(header, dict) and header.get("format") == STORE_FORMAT:
+                self._next_node = int(header.get("next_node") or 0)
+                self._load_lines(len(first_line))
+            elif self._load_legacy():
+                for record in self._records:
+                    record.node_id = self._allocate_node()
+                self.save()
+            else:
+                self._set_aside_unreadable()
+        self._touch()
+        return self.get_all()
+
+    def _load_legacy(self) -> bool:
+        """加载旧格式（记录数组或带字符串表的单个 JSON 对象），文件无法解析时返回 False"""
+        try:
+            # 解析时直接生成紧凑对象，避免先构造整棵字典树（加载峰值内存与 RSS 更低）
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f, object_hook=self._decode_object)
+            legacy = not isinstance(data, dict)
+            if legacy:
+                strings, records = {}, data
+            else:
+                strings = data.get("strings") or {}
+                records = data.get("records") or []
+            records = [
+                record if isinstance(record, CompactRecord) else CompactRecord(record)
+                for record in records
+            ]
+            for record in records:
+                self._resolve_record(record, strings, intern_inline=legacy)
+        except Exception as e:
+            print(f"解析历史记录文件失败: {e}")
+            return False
+        self._records = records
+        return True
+
+    def _set_aside_unreadable(self):
+        """无法解析的历史文件改名保留，不被新的存储覆盖；之后从空历史开始"""
+        backup = f"{self.file_path}.bak"
+        if os.path.exists(backup):
+            backup = f"{self.file_path}.{time.strftime('%Y%m%d-%H%M%S')}.bak"
+        # 改名失败时直接抛出：继续运行会把新记录追加到无法解析的文件里
+        os.replace(self.file_path, backup)
+        print(f"历史记录文件无法解析，已另存为 {backup}，从空历史开始")
+
+    def _load_lines(self, header_end: int):
+        """加载当前格式：字符串表 + 尾部记录，较早的记录交给后台线程"""
+        strings = self._read_strings()
+        self._table_keys = set(strings)
+        with open(self.file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_end = f.tell()
+            if self.tail_records > 0:
+                tail_start = self._find_tail_start(f, header_end, file_end, self.tail_records)
+            else:
+                tail_start = header_end
+            decoded = self._decode_lines(self._iter_lines(f, tail_start, file_end), strings)
+            for item, record in decoded:
+                if record is None:
+                    self._apply_marker(item)
+                    continue
+                record_index = item.get("i")
+                if not isinstance(record_index, int) or record_index < 0:
+                    continue
+                record.node_id = item.get("n", record_index)
+                # 上次整体保存之后追加的记录编号比文件头中记下的都大
+                self._next_node = max(self._next_node, record.node_id + 1)
+                if record_index >= len(self._records):
+                    self._records.extend([None] * (record_index + 1 - len(self._records)))
+                self._records[record_index] = record
+        if tail_start == header_end or None not in self._records:
+            # 全部同步读取后仍有空位（序号不连续或行损坏），以空记录占位
+            self._fill_holes()
+            self._load_branches(strings)
+        else:
+            loaded_start = len(self._records)
+            while loaded_start > 0 and self._records[loaded_start - 1] is not None:
+                loaded_start -= 1
+            self._loaded_start = loaded_start
+            self._loaded.clear()
+            threading.Thread(
+                target=self._load_older,
+                args=(header_end, tail_start, strings),
+                name="history-loader",
+                daemon=True
+            ).start()
+
+    @staticmethod
+    def _find_tail_start(f, header_end: int, file_end: int, count: int) -> int:
+        """从文件末尾向前找到倒数第 count 条记录的起始位置"""
+        position = file_end
+        newlines = 0
+        # 文件末尾的换行属于最后一行
+        f.seek(max(header_end, file_end - 1))
+        if f.read(1) == b"\n":
+            position -= 1
+        while position > header_end:
+            block_start = max(header_end, position - TAIL_BLOCK_SIZE)
+            f.seek(block_start)
+            block = f.read(position - block_start)
+            index = len(block)
+            while True:
+                index = block.rfind(b"\n", 0, index)
+                if index == -1:
+                    break
+                newlines += 1
+                if newlines == count:
+                    return block_start + index + 1
+            position = block_start
+        return header_end
+
+    def _apply_marker(self, item: Dict[str, Any]):
+        """处理分支操作的标记行：截断/补齐当前分支到记下的长度，并更新下一个记录编号"""
+        length = item.get("l")
+        if isinstance(length, int) and length >= 0:
+            del self._records[length:]
+            self._records.extend([None] * (length - len(self._records)))
+        next_node = item.get("x")
+        if isinstance(next_node, int):
+            self._next_node = max(self._next_node, next_node)
+
+    def _load_older(self, header_end: int, tail_start: int, strings: Dict[str, str]):
+        """后台加载尾部之前的记录（尾部的行更新，只填补仍为空的位置）"""
+        try:
+            older: Dict[int, CompactRecord] = {}
+            with open(self.file_path, 'rb') as f:
+                decoded = self._decode_lines(self._iter_lines(f, header_end, tail_start), strings)
+                for item, record in decoded:
+                    if record is None:
+                        # 这一段内同样按文件顺序处理覆盖与截断
+                        length = item.get("l")
+                        if isinstance(length, int):
+                            for record_index in [i for i in older if i >= length]:
+                                del older[record_index]
+                        continue
+                    record_index = item.get("i")
+                    if not isinstance(record_index, int) or record_index < 0:
+                        continue
+                    record.node_id = item.get("n", record_index)
+                    older[record_index] = record
+            for record_index, record in older.items():
+                if record_index < len(self._records) and self._records[record_index] is None:
+                    self._records[record_index] = record
+        except Exception as e:
+            print(f"加载较早的对话记录失败: {e}")
+        finally:
+            self._fill_holes()
             try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    self.history = json.load(f)
+                self._load_branches(strings)
+            except Exception as e:
+                print(f"加载对话分支失败: {e}")
+            self._loaded.set()
+
+    def _fill_holes(self):
+        """无法解析的行以空记录占位，保证访问不会一直等待"""
+        for record_index, record in enumerate(self._records):
+            if record is None:
+                placeholder = CompactRecord({"messages": []})
+                placeholder.node_id = self._allocate_node()
+                self._records[record_index] = placeholder
+
+    def _load_branches(self, strings: Dict[str, str]):
+        """
+        读取非活动分支：同一编号以最后一行为准；已在当前分支上的记录以当前分支为准
+        （之后又切换回来的分支，或写到一半时中断）
+        """
+        if not os.path.exists(self.branches_path):
+            return
+        active = {record.node_id for record in self._records}
+        nodes: Dict[int, BranchNode] = {}
+        with open(self.branches_path, 'rb') as f:
+            for item, record in self._decode_lines(f, strings):
+                node_id, parent = item.get("n"), item.get("p")
+                if record is None or not isinstance(node_id, int) or not isinstance(parent, int):
+                    continue
+                record.node_id = node_id
+                nodes[node_id] = BranchNode(record, parent, item.get("a"))
+        for node_id, node in nodes.items():
+            if node_id in active:
+                continue
+            self._branches[node_id] = node
+            self._children.setdefault(node.parent, []).append(node_id)
+
+    def _allocate_node(self) -> int:
+        with self._node_lock:
+            node_id = self._next_node
+            self._next_node += 1
+            return node_id
+
+    @staticmethod
+    def _iter_lines(f, start: int, end: int) -> Iterator[bytes]:
+        """逐行读取 [start, end) 范围内的内容，不把整段读入内存"""
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+    def _decode_lines(self, lines: Iterator[bytes], strings: Dict[str, str]) -> Iterator[Tuple[Dict, CompactRecord]]:
+        """按批拼成 JSON 数组解析（比逐行解析快得多），某批解析失败时退回逐行解析"""
+        batch: List[bytes] = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                batch.append(line)
+            if len(batch) >= DECODE_BATCH_SIZE:
+                yield from self._decode_batch(batch, strings)
+                batch = []
+        if batch:
+            yield from self._decode_batch(batch, strings)
+
+    def _decode_batch(self, batch: List[bytes], strings: Dict[str, str]) -> Iterator[Tuple[Dict, CompactRecord]]:
+        """解析一批行，产出 (行对象, 还原后的记录)；不含记录的标记行产出 (行对象, None)"""
+        try:
+            items = json.loads(b"[" + b",".join(batch) + b"]", object_hook=self._decode_object)
+        except ValueError:
+            items = []
+            for line in batch:
+                try:
+                    items.append(json.loads(line, object_hook=self._decode_object))
+                except ValueError:
+                    # 例如异常退出时写了一半的最后一行
+                    continue
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            if "r" not in item:
+                yield item, None
+                continue
+            try:
+                record = item["r"]
+                if not isinstance(record, CompactRecord):
+                    record = CompactRecord(record)
+                self._resolve_record(record, strings, intern_inline=False)
             except Exception:
-                self.history = []
-        return self.history
+                continue
+            tokens = item.get("t")
+            if isinstance(tokens, (int, float)):
+                record.tokens = float(tokens)
+            yield item, record
+
+    def _read_strings(self) -> Dict[str, str]:
+        strings = {}
+        if not os.path.exists(self.strings_path):
+            return strings
+        with open(self.strings_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                    strings[item["k"]] = item["v"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return strings
+
+    def wait_loaded(self, timeout: Optional[float] = None) -> bool:
+        """等待后台加载较早记录完成"""
+        return self._loaded.wait(timeout)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    @property
+    def loaded_start(self) -> int:
+        """已加载的连续尾部的起始序号：从这里开始读取不会等待后台加载（加载完成后为 0）"""
+        if self._loaded.is_set():
+            return 0
+        return min(self._loaded_start, len(self._records))
+
+    def _record(self, record_index: int) -> CompactRecord:
+        """取紧凑记录；较早的记录尚未加载时等待后台加载完成"""
+        record = self._records[record_index]
+        if record is None:
+            self._loaded.wait()
+            record = self._records[record_index]
+        return record
+
+    @staticmethod
+    def _decode_object(data: Dict[str, Any]) -> Any:
+        if len(data) == 1 and STRING_REF_KEY in data:
+            return _StringRef(data[STRING_REF_KEY])
+        if "role" in data:
+            return CompactMessage(data)
+        if isinstance(data.get("messages"), list):
+            return CompactRecord(data)
+        return data
+
+    def _resolve_record(self, record: CompactRecord, strings: Dict[str, str], intern_inline: bool):
+        """
+        还原字符串表引用，并把长字符串登记到内存中的字符串表
+
+        新格式中内联的长字符串在文件里只出现一次，不必逐个计算哈希；
+        旧格式文件没有做过去重，全部登记。
+        """
+        def resolve(value):
+            if isinstance(value, _StringRef):
+                text = strings.get(value.key)
+                if text is None:
+                    # 字符串表缺少这一项（.strings 文件丢失或损坏）：内容无法还原，明确提示而不是悄悄当作空串
+                    print(f"历史记录引用的字符串 {value.key} 不在字符串表中，该内容无法还原")
+                    return ""
+                return self._strings.setdefault(value.key, text)
+            return self._intern(value) if intern_inline else value
+
+        record.request_input = resolve(record.request_input)
+        for message in record.messages or ():
+            message.content = resolve(message.content)
+
+    @property
+    def history(self) -> Sequence[Dict]:
+        """全部历史记录的字典视图（与 get_all 相同）"""
+        return self.get_all()
+
+    def _intern(self, value: Any) -> Any:
+        """达到长度阈值的字符串换成字符串表中的同一对象"""
+        if not isinstance(value, str) or len(value) < self.intern_min_chars:
+            return value
+        key = _string_key(value)
+        existing = self._strings.get(key)
+        if existing is None:
+            self._strings[key] = value
+            return value
+        return existing
+
+    def _long_strings(self, record: CompactRecord) -> Iterator[str]:
+        """记录中参与去重的字符串（请求输入与消息内容）"""
+        values = [record.request_input] + [message.content for message in record.messages or ()]
+        for value in values:
+            if isinstance(value, str) and len(value) >= self.intern_min_chars:
+                yield value
+
+    @staticmethod
+    def _new_intern_stats() -> Dict[str, int]:
+        return {
+            "strings": 0,
+            "references": 0,
+            "referenced_chars": 0,
+            "unique_chars": 0,
+            "saved_bytes_disk": 0,
+            "saved_bytes_memory": 0,
+        }
+
+    def _count_reference(self, key: str, value: str, first: bool):
+        stats = self._intern_stats
+        stats["references"] += 1
+        stats["referenced_chars"] += len(value)
+        if first:
+            stats["strings"] += 1
+            stats["unique_chars"] += len(value)
+        else:
+            stats["saved_bytes_disk"] += len(value.encode("utf-8")) - len(key) - 12
+            stats["saved_bytes_memory"] += sys.getsizeof(value)
+
+    @staticmethod
+    def _encode_line(head: Dict[str, Any], data: Dict[str, Any], ref: Callable[[Any], Any]) -> str:
+        """生成一条记录的文件行（head 为序号/编号等字段）：长字符串经 ref 换成引用"""
+        if "request_input" in data:
+            data["request_input"] = ref(data["request_input"])
+        if "messages" in data:
+            data["messages"] = [{**message, "content": ref(message["content"])} for message in data["messages"]]
+        return json.dumps({**head, "r": data}, ensure_ascii=False) + "\n"
+
+    @staticmethod
+    def _line_head(record_index: int, node_id: int, tokens: Optional[float] = None) -> Dict[str, Any]:
+        """当前分支记录行的序号与估算 token 数；编号与序号不同时（切换过分支）才写出编号"""
+        head: Dict[str, Any] = {"i": record_index}
+        if node_id != record_index:
+            head["n"] = node_id
+        if tokens is not None:
+            head["t"] = tokens
+        return head
+
+    @staticmethod
+    def _branch_head(node: BranchNode) -> Dict[str, Any]:
+        head: Dict[str, Any] = {"n": node.record.node_id, "p": node.parent}
+        if node.active_child is not None:
+            head["a"] = node.active_child
+        if node.record.tokens is not None:
+            head["t"] = node.record.tokens
+        return head
+
+    def _build_store(self) -> Tuple[Dict[str, str], List[str], List[str]]:
+        """
+        生成写入文件的字符串表、当前分支记录行与非活动分支记录行，同时重算去重统计
+
+        出现两次及以上的长字符串写入字符串表，记录中保存 {"$str": 哈希}；
+        只出现一次的仍内联保存，避免引用本身的开销，但仍留在内存中的字符串表里，
+        之后追加同样的内容时照常改为引用。
+        """
+        self._loaded.wait()
+        self._intern_stats = self._new_intern_stats()
+        # 同一对象只算一次哈希（保存期间字符串对象都被记录持有，id 不会复用）
+        keys: Dict[int, str] = {}
+        counts: Dict[str, int] = {}
+        branch_records = [node.record for node in self._branches.values()]
+        for record in self._records + branch_records:
+            for value in self._long_strings(record):
+                key = keys.get(id(value))
+                if key is None:
+                    key = keys[id(value)] = _string_key(value)
+                counts[key] = counts.get(key, 0) + 1
+
+        table: Dict[str, str] = {}
+        strings: Dict[str, str] = {}
+
+        def ref(value):
+            if not isinstance(value, str) or len(value) < self.intern_min_chars:
+                return value
+            key = keys[id(value)]
+            strings.setdefault(key, value)
+            if counts[key] < 2:
+                return value
+            first = key not in table
+            if first:
+                table[key] = value
+            self._count_reference(key, value, first)
+            return {STRING_REF_KEY: key}
+
+        lines = [
+            self._encode_line(self._line_head(i, record.node_id, record.tokens), record.to_dict(), ref)
+            for i, record in enumerate(self._records)
+        ]
+        # 非活动分支与当前分支共用字符串表（重试的请求输入等只存一份）
+        branch_lines = [
+            self._encode_line(self._branch_head(node), node.record.to_dict(), ref)
+            for node in self._branches.values()
+        ]
+        # 只保留仍被记录使用的字符串（包括只出现一次的），替换或清空的记录不再占用字符串表
+        self._strings = strings
+        self._table_keys = set(table)
+        return table, lines, branch_lines
+
+    def get_intern_stats(self) -> Dict[str, int]:
+        """去重统计（共享字符串数、引用次数、节省的磁盘/内存字节数），整体保存时重算，追加时累加"""
+        if not self._intern_stats:
+            # 较早的记录仍在加载时不等待，先返回空统计
+            if not self.is_loaded:
+                return self._new_intern_stats()
+            self._build_store()
+        return dict(self._intern_stats)
+
+    def add_listener(self, listener: Callable[[Optional[int]], None]):
+        """注册记录变化的监听者"""
+        self._listeners.append(listener)
+
+    def _touch(self, record_index: int = None):
+        """记录发生变化：递增版本号并丢弃对应的编码缓存（不传序号则全部丢弃），再通知监听者"""
+        self.version += 1
+        if record_index is None:
+            self._encoded.clear()
+            self._token_counts.clear()
+            self._token_total = None
+        else:
+            self._encoded.pop(record_index, None)
+            previous = self._token_counts.pop(record_index, None)
+            if previous is not None and self._token_total is not None:
+                self._token_total -= previous
+            self._token_pending.add(record_index)
+        for listener in self._listeners:
+            listener(record_index)
+
+    @property
+    def etag(self) -> str:
+        """当前历史内容的强校验 ETag"""
+        return f'"{self.store_id}-{self.version}"'
+
+    def encoded_record(self, record_index: int) -> bytes:
+        """返回单条记录的 JSON 字节（带 record_index 字段），按序号缓存"""
+        data = self._encoded.get(record_index)
+        if data is None:
+            record = self._record(record_index).to_dict()
+            data = json.dumps({"record_index": record_index, **record}, ensure_ascii=False).encode("utf-8")
+            self._encoded[record_index] = data
+        return data
+
+    @staticmethod
+    def _count_tokens(data: Dict[str, Any]) -> float:
+        """记录全部消息未校准的估算 token 数（旧格式记录按输入与回复估算）"""
+        messages = data.get("messages")
+        if messages is None:
+            messages = [{"content": data.get("user_input", "")}, {"content": data.get("response", "")}]
+        return round(sum(token_estimator.message_raw(message) for message in messages), 2)
+
+    def _record_raw_tokens(self, record_index: int) -> float:
+        record = self._record(record_index)
+        if record.tokens is None:
+            # 没有保存估算值的旧记录只计算一次，下次整体保存时写入文件
+            record.tokens = self._count_tokens(record.to_dict())
+        return record.tokens
+
+    def record_tokens(self, record_index: int) -> int:
+        """单条记录全部消息的估算 token 数（基础值保存在记录上，读取时乘校准系数）"""
+        return int(round(self._record_raw_tokens(record_index) * token_estimator.factor))
+
+    def total_tokens(self) -> int:
+        """
+        全部历史记录的估算 token 数
+
+        维护累计值，每次只重新计入变化过的记录；较早的记录仍在加载时只统计已加载的尾部，不等待。
+        """
+        if not self._loaded.is_set():
+            raw = sum(self._record_raw_tokens(i) for i in range(self.loaded_start, len(self._records)))
+            return int(round(raw * token_estimator.factor))
+        if self._token_total is None:
+            self._token_counts = {}
+            self._token_total = 0.0
+            self._token_pending = set(range(len(self._records)))
+        count = len(self._records)
+        for record_index in self._token_pending:
+            if record_index < count and record_index not in self._token_counts:
+                raw = self._record_raw_tokens(record_index)
+                self._token_counts[record_index] = raw
+                self._token_total += raw
+        self._token_pending = set()
+        return int(round(self._token_total * token_estimator.factor))
+
+    def encoded_items(self, start: int = 0) -> bytes:
+        """拼接从 start 起全部记录的缓存字节，得到 JSON 数组"""
+        return b"[" + b",".join(self.encoded_record(i) for i in range(start, len(self.get_all()))) + b"]"
     
     def save(self):
-        """保存对话记录到文件"""
+        """整体改写记录文件、非活动分支与字符串表（先写临时文件再替换）"""
+        table, lines, branch_lines = self._build_store()
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=2)
+            with open(f"{self.strings_path}.tmp", 'w', encoding='utf-8') as f:
+                for key, value in table.items():
+                    f.write(json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n")
+            if branch_lines:
+                with open(f"{self.branches_path}.tmp", 'w', encoding='utf-8') as f:
+                    f.writelines(branch_lines)
+            with open(f"{self.file_path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(json.dumps({"format": STORE_FORMAT, "next_node": self._next_node}) + "\n")
+                f.writelines(lines)
+            os.replace(f"{self.strings_path}.tmp", self.strings_path)
+            if branch_lines:
+                os.replace(f"{self.branches_path}.tmp", self.branches_path)
+            elif os.path.exists(self.branches_path):
+                os.remove(self.branches_path)
+            os.replace(f"{self.file_path}.tmp", self.file_path)
         except Exception as e:
             print(f"保存记忆文件失败: {e}")
+
+    def _append(
+        self,
+        entries: List[Tuple[Dict[str, int], Dict[str, Any]]],
+        branch_nodes: Sequence[BranchNode] = (),
+        marker: Optional[Dict[str, int]] = None
+    ) -> bool:
+        """
+        把新记录 [(行头, 记录字典)] 一次写到文件末尾，不改写已有内容；文件不存在时返回 False，由调用方整体保存
+
+        之前出现过的长字符串（包括同一条记录里的重复，例如 request_input 与首条消息）
+        写入字符串表并以引用保存；首次出现的先内联，同时登记以便后续去重。
+        分支操作同时把移入非活动分支的记录追加到 .branches，并在记录之后追加标记行 marker。
+        """
+        if not os.path.exists(self.file_path):
+            return False
+        if not self._intern_stats:
+            self._intern_stats = self._new_intern_stats()
+        new_strings = []
+
+        def ref(value):
+            if not isinstance(value, str) or len(value) < self.intern_min_chars:
+                return value
+            key = _string_key(value)
+            if key in self._table_keys:
+                self._count_reference(key, value, first=False)
+                return {STRING_REF_KEY: key}
+            if key in self._strings:
+                self._table_keys.add(key)
+                new_strings.append((key, value))
+                # 之前内联的那一次也算一次引用
+                self._count_reference(key, value, first=True)
+                self._count_reference(key, value, first=False)
+                return {STRING_REF_KEY: key}
+            self._strings[key] = value
+            return value
+
+        lines = "".join(self._encode_line(head, data, ref) for head, data in entries)
+        if marker is not None:
+            lines += json.dumps(marker) + "\n"
+        branch_lines = "".join(
+            self._encode_line(self._branch_head(node), node.record.to_dict(), ref)
+            for node in branch_nodes
+        )
+        try:
+            if new_strings:
+                with open(self.strings_path, 'a', encoding='utf-8') as f:
+                    for key, value in new_strings:
+                        f.write(json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n")
+            # 先写分支再写记录：中途中断时，仍在当前分支上的记录加载时以当前分支为准
+            if branch_lines:
+                self._append_file(self.branches_path, branch_lines.encode("utf-8"))
+            self._append_file(self.file_path, lines.encode("utf-8"))
+        except Exception as e:
+            print(f"保存记忆文件失败: {e}")
+        return True
+
+    @staticmethod
+    def _append_file(path: str, data: bytes):
+        """写到文件末尾；上次异常退出可能留下没有换行的半行，先补上换行，避免新行与其粘连"""
+        with open(path, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write(data)
     
     def add(self, messages: List[Dict], request_input: str = ""):
-        """添加一条对话记录（完整消息列表）"""
-        self.history.append({
+        """添加一条对话记录（完整消息列表），只在文件末尾追加一行"""
+        record = {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
             "request_input": request_input or "",
             "messages": messages  # 保存完整消息列表（包括 user、assistant、tool_calls、tool）
-        })
-        self.save()
+        }
+        record_index = len(self._records)
+        compact = CompactRecord(record)
+        compact.node_id = self._allocate_node()
+        compact.tokens = self._count_tokens(record)
+        # 先编码写入（登记字符串），再生成共享字符串的紧凑记录
+        appended = self._append([(self._line_head(record_index, compact.node_id, compact.tokens), compact.to_dict())])
+        stored = CompactRecord(record, self._intern)
+        stored.node_id = compact.node_id
+        stored.tokens = compact.tokens
+        self._records.append(stored)
+        if not appended:
+            self.save()
+        self._touch(record_index)
+
+    def import_records(self, records: List[Dict]) -> int:
+        """
+        追加一批外部记录（保留原有时间），整批只写一次文件
+
+        Returns:
+            起始序号
+        """
+        start = len(self._records)
+        # 统一成存储中的字段形式；编码会替换字段值，每条写入用浅拷贝
+        normalized = [CompactRecord(record).to_dict() for record in records]
+        node_ids = [self._allocate_node() for _ in normalized]
+        tokens = [self._count_tokens(data) for data in normalized]
+        appended = self._append([
+            (self._line_head(start + offset, node_id, count), dict(data))
+            for offset, (node_id, count, data) in enumerate(zip(node_ids, tokens, normalized))
+        ])
+        # 写入时才登记字符串，之后再生成共享字符串的紧凑记录
+        for node_id, count, data in zip(node_ids, tokens, normalized):
+            compact = CompactRecord(data, self._intern)
+            compact.node_id = node_id
+            compact.tokens = count
+            self._records.append(compact)
+        if not appended:
+            self.save()
+        for record_index in range(start, len(self._records)):
+            self._touch(record_index)
+        return start
+
+    def iter_export(self, chunk_bytes: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        以 NDJSON 逐块导出全部记录（每行一条，带 record_index），内存占用与历史长度无关
+
+        只导出开始时已有的记录；已编码的缓存直接复用，未缓存的记录临时编码、不写入缓存。
+        """
+        count = len(self._records)
+        chunk: List[bytes] = []
+        size = 0
+        for record_index in range(count):
+            data = self._encoded.get(record_index)
+            if data is None:
+                record = self._record(record_index).to_dict()
+                data = json.dumps({"record_index": record_index, **record}, ensure_ascii=False).encode("utf-8")
+            chunk.append(data)
+            size += len(data) + 1
+            if size >= chunk_bytes:
+                yield b"\n".join(chunk) + b"\n"
+                chunk, size = [], 0
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
     
     def is_empty(self) -> bool:
-        """检查是否有历史记录"""
-        return len(self.history) == 0
+        """检查是否有历史记录（尾部优先加载期间同样准确）"""
+        return len(self.get_all()) == 0
     
-    def get_all(self) -> List[Dict]:
-        """获取所有历史记录"""
-        return self.history
+    def get_all(self, limit: Optional[int] = None) -> Sequence[Dict]:
+        """
+        获取历史记录（只读视图，访问时生成字典）
+
+        Args:
+            limit: 只包含前 limit 条记录（重试时基于重试点之前的历史生成），
+                只影响返回的视图，不影响其他读取者
+        """
+        return HistoryView(self, limit)
     
     def clear(self):
-        """清空历史记录"""
-        self.history = []
+        """清空历史记录（包括全部分支）"""
+        self._loaded.wait()
+        self._records = []
+        self._branches = {}
+        self._children = {}
+        self._next_node = 0
+        self._touch()
         self.save()
 
     def update_message(
@@ -73,36 +960,128 @@ class Memory:
         """更新指定记录中的消息内容"""
         if record_index is None:
             return False
-        if record_index < 0 or record_index >= len(self.history):
+        if record_index < 0 or record_index >= len(self._records):
             return False
-        record = self.history[record_index]
-        messages = record.get("messages")
-        if not isinstance(messages, list):
+        record = self._record(record_index)
+        messages = record.messages
+        if messages is None:
             return False
         target_index = message_index
         if target_index is None or target_index < 0 or target_index >= len(messages):
             if role:
                 for idx in range(len(messages) - 1, -1, -1):
                     msg = messages[idx]
-                    if msg.get("role") == role:
+                    if msg.role == role:
                         target_index = idx
                         break
         if target_index is None or target_index < 0 or target_index >= len(messages):
             return False
-        messages[target_index]["content"] = content
+        messages[target_index].content = self._intern(content)
         if role == "user" and target_index == 0:
-            record["request_input"] = content
+            record.request_input = self._intern(content)
+        record.tokens = self._count_tokens(record.to_dict())
+        self._touch(record_index)
         self.save()
         return True
 
-    def replace_record(self, record_index: int, messages: List[Dict], request_input: str = "") -> bool:
-        """用新的消息列表替换指定记录"""
-        if record_index < 0 or record_index >= len(self.history):
+    def _parent_id(self, record_index: int) -> int:
+        """当前分支上记录的父记录编号"""
+        return self._records[record_index - 1].node_id if record_index > 0 else -1
+
+    def _detach_suffix(self, record_index: int) -> List[BranchNode]:
+        """把当前分支从 record_index 开始的记录整体移入非活动分支（记录对象不复制），返回新的分支节点"""
+        parent = self._parent_id(record_index)
+        suffix = self._records[record_index:]
+        nodes = []
+        for offset, record in enumerate(suffix):
+            following = suffix[offset + 1].node_id if offset + 1 < len(suffix) else None
+            node = BranchNode(record, parent, following)
+            self._branches[record.node_id] = node
+            self._children.setdefault(parent, []).append(record.node_id)
+            nodes.append(node)
+            parent = record.node_id
+        del self._records[record_index:]
+        return nodes
+
+    def branch(self, record_index: int, messages: List[Dict], request_input: str = "") -> bool:
+        """
+        在 record_index 处新建分支（重试）
+
+        新记录与原记录共享之前的全部历史；原记录连同其后的对话保留为非活动分支，
+        之后可以用 switch_branch 切换回去。文件只追加移走的记录、新记录与标记行。
+        """
+        if record_index < 0 or record_index >= len(self._records):
             return False
-        self.history[record_index] = {
+        self._loaded.wait()
+        previous_length = len(self._records)
+        detached = self._detach_suffix(record_index)
+        record = {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
             "request_input": request_input or "",
             "messages": messages
         }
-        self.save()
+        compact = CompactRecord(record)
+        compact.node_id = self._allocate_node()
+        compact.tokens = self._count_tokens(record)
+        # 与 add 相同：先编码写入（登记字符串），再生成共享字符串的紧凑记录
+        appended = self._append(
+            [(self._line_head(record_index, compact.node_id, compact.tokens), compact.to_dict())],
+            branch_nodes=detached,
+            marker={"l": record_index + 1, "x": self._next_node}
+        )
+        stored = CompactRecord(record, self._intern)
+        stored.node_id = compact.node_id
+        stored.tokens = compact.tokens
+        self._records.append(stored)
+        if not appended:
+            self.save()
+        for index in range(record_index, previous_length):
+            self._touch(index)
+        return True
+
+    def get_branches(self, record_index: int) -> Optional[Dict[str, Any]]:
+        """record_index 处的同级分支：按创建顺序排列的记录编号，以及当前分支上的编号"""
+        self._loaded.wait()
+        if record_index < 0 or record_index >= len(self._records):
+            return None
+        node_id = self._records[record_index].node_id
+        nodes = sorted(self._children.get(self._parent_id(record_index), []) + [node_id])
+        return {"record_index": record_index, "nodes": nodes, "active": node_id}
+
+    def switch_branch(self, record_index: int, node_id: int) -> bool:
+        """
+        把 record_index 处切换到同级的另一个分支
+
+        切换本身只是改变分叉点的选择：分叉点之后的当前记录整体移入非活动分支，
+        目标分支沿各记录上次接续的记录接回当前分支，之前的历史不受影响。
+        文件只追加移走的记录、接回的记录与标记行。
+        """
+        self._loaded.wait()
+        if record_index < 0 or record_index >= len(self._records):
+            return False
+        target = self._branches.get(node_id)
+        if target is None or target.parent != self._parent_id(record_index):
+            return False
+        previous_length = len(self._records)
+        detached = self._detach_suffix(record_index)
+        while target is not None:
+            record = target.record
+            del self._branches[record.node_id]
+            siblings = self._children[target.parent]
+            siblings.remove(record.node_id)
+            if not siblings:
+                del self._children[target.parent]
+            self._records.append(record)
+            target = self._branches.get(target.active_child) if target.active_child is not None else None
+        entries = [
+            (
+                self._line_head(index, self._records[index].node_id, self._records[index].tokens),
+                self._records[index].to_dict()
+            )
+            for index in range(record_index, len(self._records))
+        ]
+        if not self._append(entries, branch_nodes=detached, marker={"l": len(self._records), "x": self._next_node}):
+            self.save()
+        for index in range(record_index, max(previous_length, len(self._records))):
+            self._touch(index)
         return True
@@ -0,0 +1,165 @@
+"""
+上下文裁剪模块
+在每次请求前按配置的阶段链裁剪历史消息，并统计每个阶段节省的 token 数
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.tokens import token_estimator
+
+# 历史轮次：每条记录对应的一组消息
+Turn = List[Dict[str, Any]]
+
+SYSTEM_TRIGGER_PREFIXES = ("（系统自动触发", "(系统自动触发")
+
+
+def turns_tokens(turns: List[Turn]) -> int:
+    return token_estimator.count_messages(message for turn in turns for message in turn)
+
+
+def is_system_trigger(message: Dict[str, Any]) -> bool:
+    return message.get("role") == "user" and (message.get("content") or "").startswith(SYSTEM_TRIGGER_PREFIXES)
+
+
+class PruneStage:
+    """
+    裁剪阶段基类
+
+    keep_turns 为最近不做处理的轮数；apply 返回新的轮次列表，
+    需要修改的消息一律复制，不能改动记忆中的原始记录。
+    """
+
+    name = "stage"
+
+    def __init__(self, keep_turns: int):
+        self.keep_turns = max(0, int(keep_turns))
+
+    def apply(self, turns: List[Turn]) -> List[Turn]:
+        cutoff = max(0, len(turns) - self.keep_turns)
+        return [self.prune_turn(turn) for turn in turns[:cutoff]] + turns[cutoff:]
+
+    def prune_turn(self, turn: Turn) -> Turn:
+        return turn
+
+    def describe(self) -> str:
+        return f"{self.name}:{self.keep_turns}"
+
+
+class DropToolRounds(PruneStage):
+    """删除较早轮次中的工具调用与工具结果，只保留对话文字"""
+
+    name = "tool_rounds"
+
+    def prune_turn(self, turn: Turn) -> Turn:
+        pruned = []
+        for message in turn:
+            if message.get("role") == "tool":
+                continue
+            if message.get("role") == "assistant" and message.get("tool_calls"):
+                if not (message.get("content") or "").strip():
+                    continue
+                message = {key: value for key, value in message.items() if key != "tool_calls"}
+            pruned.append(message)
+        return pruned
+
+
+class CollapseSystemTriggers(PruneStage):
+    """把较早轮次中冗长的系统触发提示替换为简短占位（保留第一句）"""
+
+    name = "triggers"
+
+    @staticmethod
+    def placeholder(content: str) -> str:
+        head = content.split("。", 1)[0]
+        closing = "）" if content.startswith("（") else ")"
+        return head if head.endswith(closing) else f"{head}。{closing}"
+
+    def prune_turn(self, turn: Turn) -> Turn:
+        return [
+            {**message, "content": self.placeholder(message["content"])} if is_system_trigger(message) else message
+            for message in turn
+        ]
+
+
+class CapMessageLength(PruneStage):
+    """截断较早轮次中过长的单条消息"""
+
+    name = "cap"
+    SUFFIX = "……（内容过长，已截断）"
+
+    def __init__(self, max_chars: int, keep_turns: int = 2):
+        super().__init__(keep_turns)
+        self.max_chars = max(1, int(max_chars))
+
+    def prune_turn(self, turn: Turn) -> Turn:
+        pruned = []
+        for message in turn:
+            content = message.get("content")
+            if isinstance(content, str) and len(content) > self.max_chars:
+                message = {**message, "content": content[:self.max_chars] + self.SUFFIX}
+            pruned.append(message)
+        return pruned
+
+    def describe(self) -> str:
+        return f"{self.name}:{self.max_chars}:{self.keep_turns}"
+
+
+class ContextPruner:
+    """
+    裁剪阶段链
+
+    配置格式为逗号分隔的阶段列表，例如 "tool_rounds:6,triggers:2,cap:2000:2"：
+    - tool_rounds:N    最近 N 轮之前的工具调用/结果删除
+    - triggers:N       最近 N 轮之前的系统触发提示折叠为一句
+    - cap:CHARS[:N]    最近 N 轮（默认 2）之前的单条消息截断到 CHARS 字符
+    空字符串或 off 表示不裁剪。
+    """
+
+    STAGES = {
+        "tool_rounds": lambda args: DropToolRounds(*args[:1]),
+        "triggers": lambda args: CollapseSystemTriggers(*args[:1]),
+        "cap": lambda args: CapMessageLength(*args[:2]),
+    }
+
+    def __init__(self, stages: Optional[List[PruneStage]] = None):
+        self.stages = list(stages or [])
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "ContextPruner":
+        stages = []
+        for part in (spec or "").split(","):
+            part = part.strip()
+            if not part or part.lower() == "off":
+                continue
+            name, *raw_args = part.split(":")
+            factory = cls.STAGES.get(name.strip())
+            if factory is None:
+                print(f"未知的上下文裁剪阶段，已忽略: {part}")
+                continue
+            try:
+                stages.append(factory([int(arg) for arg in raw_args if arg.strip()]))
+            except (TypeError, ValueError):
+                print(f"上下文裁剪阶段参数无效，已忽略: {part}")
+        return cls(stages)
+
+    def run(self, turns: List[Turn]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        依次执行各阶段
+
+        Returns:
+            展开后的历史消息列表，以及裁剪报告（各阶段节省的 token 数）
+        """
+        before = turns_tokens(turns)
+        current = before
+        report_stages = []
+        for stage in self.stages:
+            turns = stage.apply(turns)
+            tokens = turns_tokens(turns)
+            report_stages.append({"stage": stage.describe(), "tokens_saved": current - tokens})
+            current = tokens
+        messages = [message for turn in turns for message in turn]
+        return messages, {
+            "tokens_before": before,
+            "tokens_after": current,
+            "tokens_saved": before - current,
+            "stages": report_stages
+        }
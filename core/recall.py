@@ -0,0 +1,267 @@
+"""
+历史召回模块
+为对话记录建立本地 BM25 索引（中日韩文字按二元组切分，英文数字按词切分），
+在上下文窗口之外按相关度召回较早的对话；索引以追加写的方式持久化到磁盘，重启后只需校验指纹
+"""
+import hashlib
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from core.pruning import is_system_trigger
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+")
+INDEX_FORMAT = 2
+# 索引文件中过期的行超过有效行数加上该值时整体改写
+COMPACT_SLACK_LINES = 256
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """切分检索词：英文/数字按词（忽略单字符），中日韩文字按相邻二元组（单字时保留单字）"""
+    for match in _TOKEN_RE.finditer((text or "").lower()):
+        run = match.group()
+        if run[0].isascii():
+            if len(run) > 1:
+                yield run
+        elif len(run) == 1:
+            yield run
+        else:
+            for i in range(len(run) - 1):
+                yield run[i:i + 2]
+
+
+def record_text(record: Dict) -> str:
+    """提取记录中参与检索的文字：用户输入（不含系统触发提示）与回复内容，忽略工具消息"""
+    if "messages" not in record:
+        return f"{record.get('user_input', '')}\n{record.get('response', '')}"
+    parts = []
+    for message in record.get("messages") or []:
+        role = message.get("role")
+        content = message.get("content")
+        if role not in ("user", "assistant") or not isinstance(content, str) or not content:
+            continue
+        if is_system_trigger(message):
+            continue
+        parts.append(content)
+    return "\n".join(parts)
+
+
+def _fingerprint(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class RecallIndex:
+    """
+    对话记录的 BM25 倒排索引
+
+    记录变化时由 Memory 通过 mark_dirty 通知（None 表示整体变化，例如清空），
+    实际重建推迟到下一次 search/refresh，只处理变化过的记录与新增记录。
+    纯 Python 实现，不依赖网络或第三方库。
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, file_path: Optional[str] = None):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        # 记录序号 -> 词频 / 文本指纹 / 词数
+        self._docs: List[Dict[str, int]] = []
+        self._fingerprints: List[str] = []
+        self._lengths: List[int] = []
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._total_length = 0
+        self._dirty: Set[int] = set()
+        # 首次刷新时需要按指纹校验全部记录（磁盘上的索引可能已过期）
+        self._reset = True
+        # 索引文件中（文件头之后）的行数；为 None 时下次保存整体改写（文件不存在或为旧格式）
+        self._file_lines: Optional[int] = None
+        self._load()
+
+    def mark_dirty(self, record_index: Optional[int] = None):
+        """标记记录已变化（None 表示全部）"""
+        with self._lock:
+            if record_index is None:
+                self._reset = True
+                self._dirty.clear()
+            else:
+                self._dirty.add(record_index)
+
+    def refresh(self, history: List[Dict]) -> int:
+        """把索引同步到 history，返回重新切分的记录数"""
+        with self._lock:
+            return self._refresh_locked(history)
+
+    def search(
+        self,
+        query: str,
+        history: List[Dict],
+        top_k: int = 3,
+        limit: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        按 BM25 相关度检索
+
+        Args:
+            query: 查询文本
+            history: 当前历史记录
+            top_k: 返回条数
+            limit: 只考虑序号小于 limit 的记录
+
+        Returns:
+            [(记录序号, 得分)]，按得分从高到低
+        """
+        terms = set(tokenize(query))
+        if not terms or top_k <= 0:
+            return []
+        with self._lock:
+            self._refresh_locked(history)
+            limit = len(self._docs) if limit is None else min(limit, len(self._docs))
+            if limit <= 0:
+                return []
+            count = len(self._docs)
+            avg_length = self._total_length / count if count else 0.0
+            scores: Dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                for record_index, tf in postings.items():
+                    if record_index >= limit:
+                        continue
+                    norm = self.K1 * (1 - self.B + self.B * self._lengths[record_index] / avg_length) if avg_length else self.K1
+                    scores[record_index] = scores.get(record_index, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def _refresh_locked(self, history: List[Dict]) -> int:
+        length = None
+        if self._reset:
+            indices = range(len(history))
+            if len(self._docs) > len(history):
+                length = len(history)
+            self._truncate(len(history))
+            self._reset = False
+            self._dirty.clear()
+        else:
+            # 重试时 history 可能只是前缀：超出范围的脏记录留到下次
+            pending = {i for i in self._dirty if i < len(history)}
+            self._dirty -= pending
+            indices = sorted(pending | set(range(len(self._docs), len(history))))
+        changed = []
+        for record_index in indices:
+            text = record_text(history[record_index])
+            fingerprint = _fingerprint(text)
+            if record_index < len(self._fingerprints) and self._fingerprints[record_index] == fingerprint:
+                continue
+            terms: Dict[str, int] = {}
+            for term in tokenize(text):
+                terms[term] = terms.get(term, 0) + 1
+            self._set_doc(record_index, fingerprint, terms)
+            changed.append(record_index)
+        if changed or length is not None:
+            self._persist(changed, length)
+        return len(changed)
+
+    def _set_doc(self, record_index: int, fingerprint: str, terms: Dict[str, int]):
+        while len(self._docs) <= record_index:
+            self._docs.append({})
+            self._fingerprints.append("")
+            self._lengths.append(0)
+        for term in self._docs[record_index]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(record_index, None)
+                if not postings:
+                    del self._postings[term]
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[record_index] = tf
+        length = sum(terms.values())
+        self._total_length += length - self._lengths[record_index]
+        self._docs[record_index] = terms
+        self._fingerprints[record_index] = fingerprint
+        self._lengths[record_index] = length
+
+    def _load(self):
+        """读取持久化的索引（同一序号以最后一行为准；格式不符或损坏时忽略，首次刷新时重建）"""
+        if not self.file_path or not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, "rb") as f:
+                header = json.loads(f.readline())
+                if not isinstance(header, dict):
+                    return
+                if header.get("format") != INDEX_FORMAT:
+                    return
+                lines = 0
+                for line in f:
+                    lines += 1
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        # 上次写到一半中断的行
+                        continue
+                    if not isinstance(item, dict):
+                        continue
+                    if isinstance(item.get("l"), int):
+                        self._truncate(item["l"])
+                    elif isinstance(item.get("i"), int) and item["i"] >= 0:
+                        self._set_doc(item["i"], item.get("fp", ""), item.get("tf") or {})
+            self._file_lines = lines
+        except Exception:
+            self._docs, self._fingerprints, self._lengths = [], [], []
+            self._postings, self._total_length = {}, 0
+            self._file_lines = None
+
+    def _truncate(self, length: int):
+        for record_index in range(length, len(self._docs)):
+            self._set_doc(record_index, "", {})
+        del self._docs[length:]
+        del self._fingerprints[length:]
+        del self._lengths[length:]
+
+    def _doc_line(self, record_index: int) -> str:
+        item = {"i": record_index, "fp": self._fingerprints[record_index], "tf": self._docs[record_index]}
+        return json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def _persist(self, indices: List[int], length: Optional[int]):
+        """
+        只把变化的记录追加到索引文件末尾（缩短时先写长度标记），
+        文件不存在、格式不符或过期的行过多时才整体改写
+        """
+        if not self.file_path:
+            return
+        if self._file_lines is None or self._file_lines > 2 * len(self._docs) + COMPACT_SLACK_LINES:
+            self._save()
+            return
+        lines = [json.dumps({"l": length}) + "\n"] if length is not None else []
+        lines.extend(self._doc_line(record_index) for record_index in indices)
+        try:
+            with open(self.file_path, "ab+") as f:
+                # 上次异常退出可能留下没有换行的半行，先补上换行
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write("".join(lines).encode("utf-8"))
+            self._file_lines += len(lines)
+        except Exception as e:
+            print(f"保存召回索引失败: {e}")
+
+    def _save(self):
+        """整体改写索引文件（先写临时文件再替换）"""
+        temp_path = f"{self.file_path}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"format": INDEX_FORMAT}) + "\n")
+                f.writelines(self._doc_line(record_index) for record_index in range(len(self._docs)))
+            os.replace(temp_path, self.file_path)
+            self._file_lines = len(self._docs)
+        except Exception as e:
+            print(f"保存召回索引失败: {e}")
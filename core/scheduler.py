@@ -2,19 +2,37 @@
 任务调度器模块
 负责管理任务截止时间和自动触发催促
 """
+import heapq
 import json
 import os
 import re
 import threading
 import time
 from datetime import datetime, timedelta
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 from colorama import Fore, Style
 
 
+class ScheduledTask:
+    """调度任务（到期时间使用 time.monotonic 时钟）"""
+
+    __slots__ = ("name", "due", "interval_s", "callback", "seq")
+
+    def __init__(self, name: str, due: float, interval_s: Optional[float], callback: Callable, seq: int):
+        self.name = name
+        self.due = due
+        self.interval_s = interval_s
+        self.callback = callback
+        self.seq = seq
+
+
 class TaskScheduler:
-    """任务调度器 - 管理任务截止时间并在到期时触发回调"""
+    """任务调度器 - 用最小堆管理多个命名任务，并在到期时触发回调"""
+
+    # 内置任务名
+    DEADLINE_TASK = "deadline"
+    LEAD_TASK = "deadline.lead"
     
     # 匹配截止时间的正则表达式
     DEADLINE_PATTERNS = [
@@ -31,12 +49,18 @@ class TaskScheduler:
     
     def __init__(self, state_file: str = "data/task_state.json"):
         self.state_file = state_file
-        self.deadline: Optional[datetime] = None
         self.interval_minutes: Optional[int] = None  # 存储间隔时间，用于循环触发
         self.callback: Optional[Callable] = None
-        self._stop_event = threading.Event()
+        self.lead_callback: Optional[Callable] = None
+        self.lead_seconds = 0.0
+        # 堆中存放 (due, seq, name)，任务被替换或删除后旧条目惰性丢弃
+        self._heap: List[Tuple[float, int, str]] = []
+        self._tasks: Dict[str, ScheduledTask] = {}
+        self._seq = 0
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._stopped = True
         self._thread: Optional[threading.Thread] = None
-        self._lock = threading.Lock()
         
         self._ensure_dir()
         self._load_state()
@@ -55,19 +79,25 @@ class TaskScheduler:
                     data = json.load(f)
                     self.interval_minutes = data.get("interval_minutes")
                     if data.get("deadline"):
-                        self.deadline = datetime.fromisoformat(data["deadline"])
+                        deadline = datetime.fromisoformat(data["deadline"])
+                        delay = (deadline - datetime.now()).total_seconds()
                         # 如果加载的截止时间已经过期，基于间隔重新计算下一个截止时间
-                        if self.deadline <= datetime.now() and self.interval_minutes:
-                            self._reset_deadline()
+                        if delay <= 0 and self.interval_minutes:
+                            self._arm_deadline(self.interval_minutes * 60)
+                            self._save_state()
+                        else:
+                            self._arm_deadline(max(0.0, delay))
             except Exception:
-                self.deadline = None
+                self._tasks.clear()
+                self._heap.clear()
                 self.interval_minutes = None
     
     def _save_state(self):
         """保存截止时间状态到文件"""
         try:
+            deadline = self.deadline
             data = {
-                "deadline": self.deadline.isoformat() if self.deadline else None,
+                "deadline": deadline.isoformat() if deadline else None,
                 "interval_minutes": self.interval_minutes,
                 "updated_at": datetime.now().isoformat()
             }
@@ -75,6 +105,122 @@ class TaskScheduler:
                 json.dump(data, f, ensure_ascii=False, indent=2)
         except Exception as e:
             print(f"{Fore.RED}保存任务状态失败: {e}{Style.RESET_ALL}")
+
+    @staticmethod
+    def _to_wall(due: float) -> datetime:
+        """把 monotonic 到期时间换算为墙上时间（仅用于展示和持久化）"""
+        return datetime.now() + timedelta(seconds=due - time.monotonic())
+
+    @property
+    def deadline(self) -> Optional[datetime]:
+        """当前截止时间（墙上时间），未设置时为 None"""
+        with self._lock:
+            task = self._tasks.get(self.DEADLINE_TASK)
+            return self._to_wall(task.due) if task else None
+
+    def add_task(
+        self,
+        name: str,
+        delay_s: float,
+        callback: Callable,
+        interval_s: Optional[float] = None
+    ) -> ScheduledTask:
+        """
+        添加或替换命名任务
+        
+        Args:
+            name: 任务名，同名任务会被覆盖
+            delay_s: 距首次触发的秒数
+            callback: 到期时在调度线程中调用的回调
+            interval_s: 循环间隔秒数，None 表示一次性任务
+        """
+        with self._cond:
+            self._seq += 1
+            task = ScheduledTask(name, time.monotonic() + max(0.0, delay_s), interval_s, callback, self._seq)
+            self._tasks[name] = task
+            heapq.heappush(self._heap, (task.due, task.seq, name))
+            self._compact()
+            self._cond.notify_all()
+            return task
+
+    def remove_task(self, name: str) -> bool:
+        """删除命名任务"""
+        with self._cond:
+            task = self._tasks.pop(name, None)
+            if task is None:
+                return False
+            self._compact()
+            self._cond.notify_all()
+            return True
+
+    def list_tasks(self, limit: int = 10) -> List[dict]:
+        """
+        按到期顺序列出最近的 limit 个任务
+
+        从堆顶向下展开，只访问 O(k) 个堆节点（k = limit），代价 O(k log k)，与任务总数无关；
+        失效条目的子树仍需展开，不能计入 k，所以堆中有失效条目时先重建（O(n)，之后再列出不再重建）。
+        """
+        with self._lock:
+            if len(self._heap) > len(self._tasks):
+                self._rebuild()
+            now = time.monotonic()
+            result = []
+            frontier = [(self._heap[0], 0)] if self._heap else []
+            while frontier and len(result) < limit:
+                (due, seq, name), index = heapq.heappop(frontier)
+                task = self._tasks[name]
+                result.append({
+                    "name": name,
+                    "due": self._to_wall(due).isoformat(),
+                    "remaining_seconds": max(0.0, due - now),
+                    "interval_seconds": task.interval_s
+                })
+                for child in (2 * index + 1, 2 * index + 2):
+                    if child < len(self._heap):
+                        heapq.heappush(frontier, (self._heap[child], child))
+            return result
+
+    def _compact(self):
+        """堆中失效条目过多时重建，避免频繁覆盖导致堆膨胀"""
+        if len(self._heap) > 2 * len(self._tasks) + 16:
+            self._rebuild()
+
+    def _rebuild(self):
+        """只用有效任务重建堆"""
+        self._heap = [(task.due, task.seq, task.name) for task in self._tasks.values()]
+        heapq.heapify(self._heap)
+
+    def _peek(self) -> Optional[ScheduledTask]:
+        """返回最早到期的有效任务，顺带弹出失效条目"""
+        while self._heap:
+            due, seq, name = self._heap[0]
+            task = self._tasks.get(name)
+            if task is not None and task.seq == seq:
+                return task
+            heapq.heappop(self._heap)
+        return None
+
+    def _arm_deadline(self, delay_s: float):
+        """（重新）安排截止任务及其提前触发任务"""
+        interval_s = self.interval_minutes * 60 if self.interval_minutes else None
+        self.add_task(self.DEADLINE_TASK, delay_s, self._fire_deadline, interval_s=interval_s)
+        self._arm_lead()
+
+    def _arm_lead(self):
+        task = self._tasks.get(self.DEADLINE_TASK)
+        if task is None or self.lead_callback is None or self.lead_seconds <= 0:
+            self.remove_task(self.LEAD_TASK)
+            return
+        delay = task.due - self.lead_seconds - time.monotonic()
+        self.add_task(self.LEAD_TASK, delay, self._fire_lead)
+
+    def _fire_deadline(self):
+        if self.callback is not None:
+            self.callback()
+
+    def _fire_lead(self):
+        if self.lead_callback is not None:
+            self.lead_callback()
     
     def parse_deadline(self, text: str) -> Optional[int]:
         """
@@ -112,100 +258,114 @@ class TaskScheduler:
                 return
             
             self.interval_minutes = minutes
-            self.deadline = datetime.now() + timedelta(minutes=minutes)
+            self._arm_deadline(minutes * 60)
             self._save_state()
             print(f"{Fore.CYAN}[调度器] 已设置截止时间: {self.deadline.strftime('%H:%M:%S')} ({minutes}分钟后，循环催促){Style.RESET_ALL}")
     
-    def _reset_deadline(self):
-        """重置截止时间到下一个周期（用于循环催促）"""
-        if self.interval_minutes:
-            self.deadline = datetime.now() + timedelta(minutes=self.interval_minutes)
-            self._save_state()
-    
     def clear_deadline(self):
         """清除当前截止时间（停止循环催促）"""
         with self._lock:
-            if self.deadline:
+            if self.remove_task(self.DEADLINE_TASK):
                 print(f"{Fore.CYAN}[调度器] 截止时间已清除，循环催促停止{Style.RESET_ALL}")
-            self.deadline = None
+            self.remove_task(self.LEAD_TASK)
             self.interval_minutes = None
             self._save_state()
     
     def is_overdue(self) -> bool:
         """检查是否已超时"""
         with self._lock:
-            if self.deadline is None:
+            task = self._tasks.get(self.DEADLINE_TASK)
+            if task is None:
                 return False
-            return datetime.now() >= self.deadline
+            return time.monotonic() >= task.due
     
     def get_remaining_seconds(self) -> Optional[float]:
         """获取剩余秒数，如果没有截止时间返回 None"""
         with self._lock:
-            if self.deadline is None:
+            task = self._tasks.get(self.DEADLINE_TASK)
+            if task is None:
                 return None
-            remaining = (self.deadline - datetime.now()).total_seconds()
-            return max(0, remaining)
+            return max(0, task.due - time.monotonic())
 
-    def get_status(self) -> dict:
-        """获取调度器状态信息"""
+    def get_status(self, limit: int = 10) -> dict:
+        """获取调度器状态信息（附带最近 limit 个待触发任务）"""
         with self._lock:
-            if self.deadline is None:
+            task = self._tasks.get(self.DEADLINE_TASK)
+            tasks = self.list_tasks(limit)
+            if task is None:
                 return {
                     "active": False,
                     "deadline": None,
                     "interval_minutes": None,
-                    "remaining_seconds": None
+                    "remaining_seconds": None,
+                    "tasks": tasks
                 }
-            remaining = (self.deadline - datetime.now()).total_seconds()
             return {
                 "active": True,
-                "deadline": self.deadline.isoformat(),
+                "deadline": self._to_wall(task.due).isoformat(),
                 "interval_minutes": self.interval_minutes,
-                "remaining_seconds": max(0, remaining)
+                "remaining_seconds": max(0, task.due - time.monotonic()),
+                "tasks": tasks
             }
     
-    def start(self, callback: Callable):
+    def start(self, callback: Callable, lead_callback: Optional[Callable] = None, lead_seconds: float = 0.0):
         """
         启动后台调度线程
         
         Args:
             callback: 截止时间到达时调用的回调函数
+            lead_callback: 截止时间前 lead_seconds 秒调用的回调函数（可选）
+            lead_seconds: 提前量（秒）
         """
-        self.callback = callback
-        self._stop_event.clear()
-        self._thread = threading.Thread(target=self._monitor_loop, daemon=True)
+        with self._cond:
+            self.callback = callback
+            self.lead_callback = lead_callback
+            self.lead_seconds = max(0.0, float(lead_seconds or 0))
+            self._arm_lead()
+            self._stopped = False
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
         self._thread.start()
     
     def stop(self):
         """停止调度器"""
-        self._stop_event.set()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout=2)
     
-    def _monitor_loop(self):
-        """后台监控循环"""
-        while not self._stop_event.is_set():
-            should_trigger = False
-            callback = None
-            
-            with self._lock:
-                if (self.deadline is not None and 
-                    datetime.now() >= self.deadline and 
-                    self.callback is not None):
-                    should_trigger = True
-                    callback = self.callback
-                    # 重置到下一个周期（循环催促）
-                    self._reset_deadline()
-            
-            if should_trigger:
-                # 在锁外部调用回调
-                try:
-                    callback()
-                except Exception as e:
-                    print(f"{Fore.RED}[调度器] 回调执行出错: {e}{Style.RESET_ALL}")
+    def _run_loop(self):
+        """后台调度循环：睡到最早任务到期，任务增删时立即唤醒"""
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    task = self._peek()
+                    if task is None:
+                        self._cond.wait()
+                        continue
+                    delay = task.due - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+
+                heapq.heappop(self._heap)
+                if task.interval_s:
+                    # 循环任务：从当前时刻起重新计时
+                    self.add_task(task.name, task.interval_s, task.callback, interval_s=task.interval_s)
+                else:
+                    del self._tasks[task.name]
+                if task.name == self.DEADLINE_TASK:
+                    self._save_state()
+                    self._arm_lead()
+                callback = task.callback
             
-            # 每秒检查一次
-            self._stop_event.wait(1.0)
+            # 在锁外部调用回调
+            try:
+                callback()
+            except Exception as e:
+                print(f"{Fore.RED}[调度器] 任务 {task.name} 回调执行出错: {e}{Style.RESET_ALL}")
     
     def trigger_now(self):
         """立即触发回调（用于手动测试）"""
@@ -0,0 +1,209 @@
+"""
+历史全文检索模块
+按消息维护倒排索引（中日韩二元组 + 英文词，与召回索引相同的切分方式），
+记录变化时增量更新，检索结果带高亮片段
+"""
+import heapq
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from core.pruning import is_system_trigger
+from core.recall import tokenize
+
+# 文档编号 = 记录序号 << MESSAGE_BITS | 消息序号
+MESSAGE_BITS = 12
+SNIPPET_RADIUS = 40
+
+
+def iter_searchable(record: Dict) -> Iterator[Tuple[int, str, str]]:
+    """遍历记录中可检索的消息：(消息序号, 角色, 内容)，跳过工具消息与系统触发提示"""
+    if "messages" not in record:
+        yield 0, "user", record.get("user_input", "")
+        yield 1, "assistant", record.get("response", "")
+        return
+    for message_index, message in enumerate(record.get("messages") or []):
+        role = message.get("role")
+        content = message.get("content")
+        if role not in ("user", "assistant") or not isinstance(content, str) or not content:
+            continue
+        if is_system_trigger(message) or message_index >= 1 << MESSAGE_BITS:
+            continue
+        yield message_index, role, content
+
+
+def make_snippet(content: str, needles: List[str]) -> Tuple[str, List[List[int]]]:
+    """截取第一个命中附近的片段，并返回片段内各命中位置 [[start, end], ...]"""
+    lowered = content.lower()
+    first = min((lowered.find(needle) for needle in needles if needle in lowered), default=0)
+    start = max(0, first - SNIPPET_RADIUS)
+    end = min(len(content), first + SNIPPET_RADIUS * 2)
+    prefix = "…" if start > 0 else ""
+    snippet = prefix + content[start:end] + ("…" if end < len(content) else "")
+    lowered_snippet = snippet.lower()
+    spans = []
+    for needle in needles:
+        position = lowered_snippet.find(needle)
+        while position != -1:
+            spans.append([position, position + len(needle)])
+            position = lowered_snippet.find(needle, position + len(needle))
+    spans.sort()
+    return snippet, spans
+
+
+class HistorySearchIndex:
+    """
+    消息级倒排索引
+
+    与召回索引一样通过 Memory 的监听者接口接收变化通知（mark_dirty），
+    下一次检索时只重建变化过的记录与新增记录。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings: Dict[str, Set[int]] = {}
+        # 记录序号 -> 该记录各消息的检索词集合（用于增量删除）
+        self._record_terms: List[Dict[int, Set[str]]] = []
+        self._dirty: Set[int] = set()
+        self._reset = True
+
+    def mark_dirty(self, record_index: Optional[int] = None):
+        """标记记录已变化（None 表示全部）"""
+        with self._lock:
+            if record_index is None:
+                self._reset = True
+                self._dirty.clear()
+            else:
+                self._dirty.add(record_index)
+
+    def refresh(self, history: List[Dict]) -> int:
+        """把索引同步到 history，返回重建的记录数"""
+        with self._lock:
+            return self._refresh_locked(history)
+
+    def search(
+        self,
+        query: str,
+        history: List[Dict],
+        limit: int = 20,
+        before: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        检索包含查询中全部词语的消息，按时间从新到旧返回
+
+        Args:
+            query: 查询文本（空格分隔的多个词需全部出现）
+            history: 当前历史记录
+            limit: 最多返回条数
+            before: 只返回记录序号小于 before 的结果（用于翻页）
+
+        Returns:
+            {"results": [...], "next_before": 下一页的 before 或 None}
+        """
+        needles = [part for part in (query or "").lower().split() if part]
+        if not needles or limit <= 0:
+            return {"results": [], "next_before": None}
+        # 单个汉字等不足一个二元组的词不进索引，只在确认阶段按子串匹配
+        terms = {term for needle in needles for term in tokenize(needle) if len(term) > 1}
+        end = len(history) if before is None else max(0, min(before, len(history)))
+        if terms:
+            with self._lock:
+                self._refresh_locked(history)
+                postings = [self._postings.get(term) for term in terms]
+                if not all(postings):
+                    return {"results": [], "next_before": None}
+                postings.sort(key=len)
+                candidates = postings[0].intersection(*postings[1:])
+            if end < len(history):
+                cutoff = end << MESSAGE_BITS
+                candidates = [doc for doc in candidates if doc < cutoff]
+            mask = (1 << MESSAGE_BITS) - 1
+            ordered = (
+                (doc >> MESSAGE_BITS, doc & mask)
+                for doc in self._newest_first(candidates, limit * 2 + 16)
+            )
+        else:
+            # 查询过短无法使用索引：从新到旧逐条扫描
+            ordered = (
+                (record_index, message_index)
+                for record_index in range(end - 1, -1, -1)
+                for message_index, _, _ in reversed(list(iter_searchable(history[record_index])))
+            )
+        results = []
+        next_before = None
+        for record_index, message_index in ordered:
+            if record_index >= len(history):
+                continue
+            # 翻页按记录切分：同一条记录的命中总在同一页
+            if len(results) >= limit and record_index != results[-1]["record_index"]:
+                next_before = results[-1]["record_index"]
+                break
+            match = self._verify(history[record_index], message_index, needles)
+            if match is None:
+                continue
+            role, content = match
+            snippet, highlights = make_snippet(content, needles)
+            results.append({
+                "record_index": record_index,
+                "message_index": message_index,
+                "role": role,
+                "timestamp": history[record_index].get("timestamp", ""),
+                "snippet": snippet,
+                "highlights": highlights
+            })
+        return {"results": results, "next_before": next_before}
+
+    @staticmethod
+    def _newest_first(candidates: Iterable[int], head: int) -> Iterator[int]:
+        """按文档编号从大到小产出；通常只需要前几页，先取 head 个，不够再整体排序"""
+        top = heapq.nlargest(head, candidates)
+        yield from top
+        if len(top) == head:
+            floor = top[-1]
+            yield from sorted((doc for doc in candidates if doc < floor), reverse=True)
+
+    @staticmethod
+    def _verify(record: Dict, message_index: int, needles: List[str]) -> Optional[Tuple[str, str]]:
+        """二元组只能粗筛，这里确认每个查询词都作为连续文本出现"""
+        for index, role, content in iter_searchable(record):
+            if index == message_index:
+                lowered = content.lower()
+                if all(needle in lowered for needle in needles):
+                    return role, content
+                return None
+        return None
+
+    def _refresh_locked(self, history: List[Dict]) -> int:
+        if self._reset:
+            self._postings.clear()
+            self._record_terms = []
+            indices = range(len(history))
+            self._reset = False
+            self._dirty.clear()
+        else:
+            # 重试时 history 可能只是前缀：超出范围的脏记录留到下次
+            pending = {i for i in self._dirty if i < len(history)}
+            self._dirty -= pending
+            indices = sorted(pending | set(range(len(self._record_terms), len(history))))
+        for record_index in indices:
+            self._index_record(record_index, history[record_index])
+        return len(indices)
+
+    def _index_record(self, record_index: int, record: Dict):
+        while len(self._record_terms) <= record_index:
+            self._record_terms.append({})
+        for message_index, terms in self._record_terms[record_index].items():
+            doc = record_index << MESSAGE_BITS | message_index
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.discard(doc)
+                    if not postings:
+                        del self._postings[term]
+        message_terms = {}
+        for message_index, _, content in iter_searchable(record):
+            terms = set(tokenize(content))
+            doc = record_index << MESSAGE_BITS | message_index
+            for term in terms:
+                self._postings.setdefault(term, set()).add(doc)
+            message_terms[message_index] = terms
+        self._record_terms[record_index] = message_terms
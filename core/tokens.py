@@ -0,0 +1,203 @@
+"""
+Token 估算模块
+离线估算文本/消息的 token 数：按中日韩字符、英文单词、数字和标点分别计数，
+再乘以按模型校准的系数；校准系数根据上游返回的真实 usage 持续修正
+"""
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_DIGIT_RE = re.compile(r"[0-9]+")
+_PUNCT_RE = re.compile(r"[^\sA-Za-z0-9぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+
+# 各类字符的基础权重（主流中文模型分词器的经验值）
+CJK_WEIGHT = 0.7
+WORD_WEIGHT = 1.3
+DIGITS_PER_TOKEN = 3
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD = 4
+
+# 按模型名称关键字给出的初始校准系数，真实 usage 到达后逐步修正
+MODEL_FACTORS = {
+    "deepseek": 1.0,
+    "qwen": 1.05,
+    "glm": 0.95,
+    "gpt": 1.15,
+}
+FACTOR_SMOOTHING = 0.2
+FACTOR_RANGE = (0.3, 3.0)
+
+
+def count_raw(text: str) -> float:
+    """未校准的估算值"""
+    if not text:
+        return 0.0
+    cjk = len(_CJK_RE.findall(text))
+    words = len(_WORD_RE.findall(text))
+    digits = sum((len(run) + DIGITS_PER_TOKEN - 1) // DIGITS_PER_TOKEN for run in _DIGIT_RE.findall(text))
+    punct = len(_PUNCT_RE.findall(text))
+    return cjk * CJK_WEIGHT + words * WORD_WEIGHT + digits + punct
+
+
+def _model_key(model: str) -> str:
+    name = (model or "").lower()
+    for key in MODEL_FACTORS:
+        if key in name:
+            return key
+    return name or "default"
+
+
+class TokenEstimator:
+    """
+    带缓存的 token 估算器
+
+    文本的基础估算值按内容缓存（LRU），重复出现的历史消息、文档和提示词
+    只计算一次；校准系数只在读取时相乘，修正系数不会使缓存失效。
+    """
+
+    def __init__(self, model: str = "", state_file: Optional[str] = None, cache_size: int = 8192):
+        self.model = model
+        self.state_file = state_file
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, float]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        # 模型关键字 -> {"factor": 系数, "samples": 已校准次数}
+        self._calibration: Dict[str, Dict[str, float]] = {}
+        self._load_state()
+
+    def configure(self, model: Optional[str] = None, state_file: Optional[str] = None):
+        """切换当前模型或校准文件"""
+        with self._lock:
+            if model is not None:
+                self.model = model
+            if state_file is not None and state_file != self.state_file:
+                self.state_file = state_file
+                self._calibration = {}
+        if state_file is not None:
+            self._load_state()
+
+    @property
+    def factor(self) -> float:
+        key = _model_key(self.model)
+        entry = self._calibration.get(key)
+        if entry:
+            return entry["factor"]
+        return MODEL_FACTORS.get(key, 1.0)
+
+    def raw(self, text: str) -> float:
+        """文本的基础估算值（按内容缓存）"""
+        if not text:
+            return 0.0
+        with self._lock:
+            value = self._cache.get(text)
+            if value is not None:
+                self._cache.move_to_end(text)
+                self._hits += 1
+                return value
+            self._misses += 1
+        value = count_raw(text)
+        with self._lock:
+            self._cache[text] = value
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def message_raw(self, message: Dict[str, Any]) -> float:
+        """单条消息的基础估算值（含工具调用与格式开销）"""
+        total = MESSAGE_OVERHEAD + self.raw(message.get("content") or "")
+        for call in message.get("tool_calls") or []:
+            function = call.get("function") or {}
+            total += self.raw(function.get("name") or "") + self.raw(function.get("arguments") or "")
+        return total
+
+    def count(self, text: str) -> int:
+        return int(round(self.raw(text) * self.factor))
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        return int(round(self.message_raw(message) * self.factor))
+
+    def count_messages(self, messages: Iterable[Dict[str, Any]]) -> int:
+        return int(round(sum(self.message_raw(message) for message in messages) * self.factor))
+
+    def observe(self, estimated_raw: float, actual_tokens: int) -> float:
+        """
+        用一次真实 usage 修正当前模型的校准系数
+
+        Args:
+            estimated_raw: 本次请求的基础估算值（未乘系数）
+            actual_tokens: 上游返回的 prompt_tokens
+
+        Returns:
+            修正后的系数
+        """
+        if estimated_raw <= 0 or not actual_tokens or actual_tokens <= 0:
+            return self.factor
+        ratio = min(FACTOR_RANGE[1], max(FACTOR_RANGE[0], actual_tokens / estimated_raw))
+        key = _model_key(self.model)
+        with self._lock:
+            entry = self._calibration.get(key)
+            if entry is None:
+                entry = {"factor": ratio, "samples": 0}
+            else:
+                entry["factor"] = entry["factor"] * (1 - FACTOR_SMOOTHING) + ratio * FACTOR_SMOOTHING
+            entry["samples"] += 1
+            entry["factor"] = round(entry["factor"], 4)
+            self._calibration[key] = entry
+            factor = entry["factor"]
+        self._save_state()
+        return factor
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._calibration.get(_model_key(self.model)) or {}
+            return {
+                "model": self.model,
+                "factor": self.factor,
+                "calibration_samples": int(entry.get("samples", 0)),
+                "cache_entries": len(self._cache),
+                "cache_hits": self._hits,
+                "cache_misses": self._misses,
+            }
+
+    def _load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                with self._lock:
+                    self._calibration = {
+                        key: {"factor": float(value["factor"]), "samples": int(value.get("samples", 0))}
+                        for key, value in data.items()
+                        if isinstance(value, dict) and "factor" in value
+                    }
+        except Exception:
+            pass
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        with self._lock:
+            data = json.dumps(self._calibration, ensure_ascii=False, indent=2)
+        try:
+            with open(self.state_file, "w", encoding="utf-8") as f:
+                f.write(data)
+        except Exception as e:
+            print(f"保存 token 校准数据失败: {e}")
+
+
+# 全局估算器（模型与校准文件由 BossAgent 配置）
+token_estimator = TokenEstimator()
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    return token_estimator.count(text)
@@ -53,7 +53,9 @@ function startBackend(port) {
     windowsHide: true,
     env: {
       ...process.env,
-      BOSS_DATA_DIR: app.getPath("userData")
+      BOSS_DATA_DIR: app.getPath("userData"),
+      // asyncio 内核才提供 /ws 通道
+      BOSS_SERVER_CORE: process.env.BOSS_SERVER_CORE || "asyncio"
     }
   });
   writeBackendLog(`data_dir: ${app.getPath("userData")}`);
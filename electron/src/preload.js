@@ -10,6 +10,7 @@ contextBridge.exposeInMainWorld("bossApi", {
   startupTimeoutMs: parseNumber(process.env.BOSS_STARTUP_TIMEOUT_MS, 30000),
   requestTimeoutMs: parseNumber(process.env.BOSS_REQUEST_TIMEOUT_MS, 12000),
   eventsTimeoutMs: parseNumber(process.env.BOSS_EVENTS_TIMEOUT_MS, 8000),
+  eventStreamIdleTimeoutMs: parseNumber(process.env.BOSS_EVENT_STREAM_IDLE_TIMEOUT_MS, 40000),
   streamTimeoutMs: parseNumber(process.env.BOSS_STREAM_TIMEOUT_MS, 150000),
   selectDirectory: () => ipcRenderer.invoke("select-directory")
 });
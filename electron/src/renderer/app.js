@@ -29,10 +29,24 @@ const toolRowsByMessageId = new Map();
 const DEFAULT_REQUEST_TIMEOUT_MS = Number(window.bossApi.requestTimeoutMs || 12000);
 const EVENTS_TIMEOUT_MS = Number(window.bossApi.eventsTimeoutMs || 8000);
 const STREAM_TIMEOUT_MS = Number(window.bossApi.streamTimeoutMs || 150000);
+const EVENT_STREAM_IDLE_TIMEOUT_MS = Number(window.bossApi.eventStreamIdleTimeoutMs || 40000);
+const EVENT_STREAM_RETRY_MS = 1000;
+const STREAM_RESUME_ATTEMPTS = 5;
+const HISTORY_RELOAD_MS = 1000;
+const socketUrl = `${apiBase.replace(/^http/, "ws")}/ws`;
 let polling = false;
+// 已打开的 WebSocket 通道；不可用时对话和事件走 HTTP
+let socket = null;
+// 通过 WebSocket 发起、尚未结束的对话：message_id -> { resolve, reject, timeoutId }
+const socketTurns = new Map();
+let schedulerSnapshot = null;
+// 已处理的最后一个事件序号；断线重连时从这里继续
+let eventCursor = null;
 let uiBusy = false;
 let contextMenu = null;
 let contextMenuTarget = null;
+// 历史尚未完整加载时，重新获取历史的定时器
+let historyReloadTimer = null;
 const startupDeadline =
   Date.now() + (Number(window.bossApi.startupTimeoutMs) || 30000);
 
@@ -350,14 +364,39 @@ function showContextMenu(x, y, bubble) {
       hideContextMenu();
       setStatus("思考中...");
       setUiBusy(true);
-      streamRetry(Number(recordIndex), targetBubble).catch(() => {
+      // 重试生成的是新分支，原回答之后的对话留在旧分支上（右键回答可切换回去），完成后按服务端的当前分支重绘
+      streamRetry(Number(recordIndex), targetBubble).then(() => loadHistory()).catch(() => {
         setUiBusy(false);
         setStatus("未连接", false);
       });
     });
 
+    // 重试留下的同级分支：在各版本回答之间切换，切换后按服务端的当前分支重绘
+    const branchBtns = [["prev", -1], ["next", 1]].map(([action, step]) => {
+      const btn = document.createElement("button");
+      btn.type = "button";
+      btn.className = "context-menu-btn";
+      btn.dataset.action = `branch-${action}`;
+      btn.style.display = "none";
+      btn.addEventListener("click", () => {
+        const target = contextMenuTarget;
+        hideContextMenu();
+        if (!target || !target.branches || uiBusy) {
+          return;
+        }
+        const { nodes, active } = target.branches;
+        const nodeId = nodes[nodes.indexOf(active) + step];
+        if (nodeId === undefined) {
+          return;
+        }
+        switchBranch(Number(target.recordIndex), nodeId);
+      });
+      return btn;
+    });
+
     contextMenu.appendChild(editBtn);
     contextMenu.appendChild(retryBtn);
+    branchBtns.forEach(btn => contextMenu.appendChild(btn));
     document.body.appendChild(contextMenu);
   }
 
@@ -369,10 +408,48 @@ function showContextMenu(x, y, bubble) {
     retryBtn.style.display = canRetry ? "block" : "none";
   }
 
-  contextMenuTarget = { bubble, recordIndex };
+  const target = { bubble, recordIndex, branches: null };
+  contextMenuTarget = target;
   contextMenu.style.left = `${x}px`;
   contextMenu.style.top = `${y}px`;
   contextMenu.classList.add("visible");
+  renderBranchButtons(target);
+}
+
+function renderBranchButtons(target) {
+  const prevBtn = contextMenu.querySelector('[data-action="branch-prev"]');
+  const nextBtn = contextMenu.querySelector('[data-action="branch-next"]');
+  prevBtn.style.display = "none";
+  nextBtn.style.display = "none";
+  const { bubble, recordIndex } = target;
+  if (bubble.dataset.role !== "assistant" || recordIndex === undefined || recordIndex === null || recordIndex === "") {
+    return;
+  }
+  apiFetch(`/history/branches?index=${encodeURIComponent(recordIndex)}`).then(branches => {
+    // 菜单已关闭或换了目标
+    if (contextMenuTarget !== target || !Array.isArray(branches.nodes) || branches.nodes.length < 2) {
+      return;
+    }
+    target.branches = branches;
+    const position = branches.nodes.indexOf(branches.active);
+    const total = branches.nodes.length;
+    prevBtn.textContent = `上一版本（${position + 1}/${total}）`;
+    nextBtn.textContent = `下一版本（${position + 1}/${total}）`;
+    prevBtn.style.display = position > 0 ? "block" : "none";
+    nextBtn.style.display = position < total - 1 ? "block" : "none";
+  }).catch(() => {});
+}
+
+async function switchBranch(recordIndex, nodeId) {
+  try {
+    await apiFetch("/history/branch/switch", {
+      method: "POST",
+      body: JSON.stringify({ record_index: recordIndex, node_id: nodeId })
+    });
+    await loadHistory();
+  } catch (err) {
+    setStatus("切换分支失败", false);
+  }
 }
 
 function hideContextMenu() {
@@ -427,6 +504,10 @@ function handleStreamEvent(event, fallbackMessageId) {
     renderScheduler(event.data);
     return;
   }
+  if (event.type === "queued") {
+    setStatus(`排队中，前面还有 ${event.position} 个请求...`);
+    return;
+  }
   if (event.type === "done") {
     if (event.response) {
       const bubble = messageMap.get(messageId);
@@ -461,28 +542,79 @@ function handleStreamEvent(event, fallbackMessageId) {
   }
 }
 
-async function streamChat(message, messageId) {
-  const controller = new AbortController();
-  const timeoutId = setTimeout(() => controller.abort(), STREAM_TIMEOUT_MS);
-  let reader = null;
-  try {
-    const response = await fetch(`${apiBase}/chat/stream`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ message, message_id: messageId }),
-      signal: controller.signal
-    });
-    if (!response.ok) {
-      throw new Error(`请求失败: ${response.status}`);
+function finishSocketTurn(messageId, err) {
+  const turn = socketTurns.get(messageId);
+  if (!turn) {
+    return;
+  }
+  socketTurns.delete(messageId);
+  clearTimeout(turn.timeoutId);
+  if (err) {
+    turn.reject(err);
+  } else {
+    turn.resolve();
+  }
+}
+
+function socketTurn(payload, messageId) {
+  return new Promise((resolve, reject) => {
+    const timeoutId = setTimeout(() => {
+      if (socket) {
+        socket.send(JSON.stringify({ type: "cancel", message_id: messageId }));
+      }
+      finishSocketTurn(messageId, new Error("timeout"));
+    }, STREAM_TIMEOUT_MS);
+    socketTurns.set(messageId, { resolve, reject, timeoutId, progress: { count: 0, done: false } });
+    socket.send(JSON.stringify(payload));
+  });
+}
+
+function handleSocketMessage(data) {
+  const messageId = data.message_id;
+  if (typeof data.seq !== "number" && messageId && socketTurns.has(messageId)) {
+    if (data.type === "error" && data.kind === "queue_full") {
+      finishSocketTurn(messageId, new Error("请求过多，队列已满，请稍后再试"));
+      return;
     }
-    if (!response.body) {
-      const data = await response.json();
-      handleStreamEvent({ type: "done", message_id: data.message_id || messageId, response: data.response }, messageId);
+    const progress = socketTurns.get(messageId).progress;
+    progress.count += 1;
+    progress.done = data.type === "done";
+    handleStreamEvent(data, messageId);
+    if (data.type === "done") {
+      finishSocketTurn(messageId);
+    }
+    return;
+  }
+  if (data.type === "pong" || data.type === "cancelled" || data.type === "response") {
+    return;
+  }
+  handleServerEvent(data);
+}
+
+// 逐行解析 NDJSON 响应；progress 记录已处理的事件数和是否已收到 done，断线后据此续传
+async function readNdjson(response, messageId, progress) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder("utf-8");
+  let buffer = "";
+  const handleLine = line => {
+    const trimmed = line.trim();
+    if (!trimmed) {
       return;
     }
-    reader = response.body.getReader();
-    const decoder = new TextDecoder("utf-8");
-    let buffer = "";
+    let event = null;
+    try {
+      event = JSON.parse(trimmed);
+    } catch (err) {
+      // ignore malformed fragments
+      return;
+    }
+    progress.count += 1;
+    if (event.type === "done") {
+      progress.done = true;
+    }
+    handleStreamEvent(event, messageId);
+  };
+  try {
     while (true) {
       const { value, done } = await reader.read();
       if (done) {
@@ -491,97 +623,62 @@ async function streamChat(message, messageId) {
       buffer += decoder.decode(value, { stream: true });
       const lines = buffer.split("\n");
       buffer = lines.pop() || "";
-      lines.forEach(line => {
-        const trimmed = line.trim();
-        if (!trimmed) {
-          return;
-        }
-        try {
-          handleStreamEvent(JSON.parse(trimmed), messageId);
-        } catch (err) {
-          // ignore malformed fragments
-        }
-      });
+      lines.forEach(handleLine);
     }
-    if (buffer.trim()) {
-      try {
-        handleStreamEvent(JSON.parse(buffer.trim()), messageId);
-      } catch (err) {
-        // ignore trailing fragments
-      }
-    }
-    if (uiBusy) {
-      setUiBusy(false);
-    }
-  } catch (err) {
-    if (err && err.name === "AbortError") {
-      throw new Error("timeout");
-    }
-    throw err;
+    handleLine(buffer);
   } finally {
-    clearTimeout(timeoutId);
     try {
-      reader?.cancel();
+      reader.cancel();
     } catch (err) {
       // ignore
     }
   }
 }
 
-async function streamRetry(recordIndex, bubble) {
-  const messageId = generateMessageId();
-  messageMap.set(messageId, bubble);
-  bubble.dataset.messageId = messageId;
+// 连接中断时从已收到的位置续传，服务端不会重新生成
+async function resumeStream(messageId, progress) {
+  for (let attempt = 0; attempt < STREAM_RESUME_ATTEMPTS && !progress.done; attempt += 1) {
+    await new Promise(resolve => setTimeout(resolve, EVENT_STREAM_RETRY_MS));
+    try {
+      const query = `message_id=${encodeURIComponent(messageId)}&offset=${progress.count}`;
+      const response = await fetch(`${apiBase}/chat/stream/resume?${query}`);
+      if (response.status === 404) {
+        return false;
+      }
+      if (response.ok && response.body) {
+        await readNdjson(response, messageId, progress);
+      }
+    } catch (err) {
+      // retry
+    }
+  }
+  return progress.done;
+}
+
+async function postStream(path, payload, messageId, onJson) {
   const controller = new AbortController();
   const timeoutId = setTimeout(() => controller.abort(), STREAM_TIMEOUT_MS);
-  let reader = null;
+  const progress = { count: 0, done: false };
   try {
-    const response = await fetch(`${apiBase}/history/retry/stream`, {
+    const response = await fetch(`${apiBase}${path}`, {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ record_index: recordIndex, message_id: messageId }),
+      body: JSON.stringify(payload),
       signal: controller.signal
     });
+    if (response.status === 429) {
+      throw new Error("请求过多，队列已满，请稍后再试");
+    }
     if (!response.ok) {
       throw new Error(`请求失败: ${response.status}`);
     }
     if (!response.body) {
-      const data = await response.json();
-      handleStreamEvent(
-        { type: "done", message_id: data.message_id || messageId, response: data.response, saved: data.saved, record_index: recordIndex },
-        messageId
-      );
+      onJson(await response.json());
       return;
     }
-    reader = response.body.getReader();
-    const decoder = new TextDecoder("utf-8");
-    let buffer = "";
-    while (true) {
-      const { value, done } = await reader.read();
-      if (done) {
-        break;
-      }
-      buffer += decoder.decode(value, { stream: true });
-      const lines = buffer.split("\n");
-      buffer = lines.pop() || "";
-      lines.forEach(line => {
-        const trimmed = line.trim();
-        if (!trimmed) {
-          return;
-        }
-        try {
-          handleStreamEvent(JSON.parse(trimmed), messageId);
-        } catch (err) {
-          // ignore malformed fragments
-        }
-      });
-    }
-    if (buffer.trim()) {
-      try {
-        handleStreamEvent(JSON.parse(buffer.trim()), messageId);
-      } catch (err) {
-        // ignore trailing fragments
-      }
+    await readNdjson(response, messageId, progress);
+    if (!progress.done && progress.count > 0) {
+      await resumeStream(messageId, progress);
     }
     if (uiBusy) {
       setUiBusy(false);
@@ -590,17 +687,39 @@ async function streamRetry(recordIndex, bubble) {
     if (err && err.name === "AbortError") {
       throw new Error("timeout");
     }
+    if (progress.count > 0 && await resumeStream(messageId, progress)) {
+      return;
+    }
     throw err;
   } finally {
     clearTimeout(timeoutId);
-    try {
-      reader?.cancel();
-    } catch (err) {
-      // ignore
-    }
   }
 }
 
+async function streamChat(message, messageId) {
+  if (socket) {
+    return socketTurn({ type: "chat", message, message_id: messageId }, messageId);
+  }
+  await postStream("/chat/stream", { message, message_id: messageId }, messageId, data => {
+    handleStreamEvent({ type: "done", message_id: data.message_id || messageId, response: data.response }, messageId);
+  });
+}
+
+async function streamRetry(recordIndex, bubble) {
+  const messageId = generateMessageId();
+  messageMap.set(messageId, bubble);
+  bubble.dataset.messageId = messageId;
+  if (socket) {
+    return socketTurn({ type: "retry", record_index: recordIndex, message_id: messageId }, messageId);
+  }
+  await postStream("/history/retry/stream", { record_index: recordIndex, message_id: messageId }, messageId, data => {
+    handleStreamEvent(
+      { type: "done", message_id: data.message_id || messageId, response: data.response, saved: data.saved, record_index: recordIndex },
+      messageId
+    );
+  });
+}
+
 function generateMessageId() {
   if (window.crypto && window.crypto.randomUUID) {
     return window.crypto.randomUUID();
@@ -654,8 +773,13 @@ function formatDuration(seconds) {
   return `${String(mins).padStart(2, "0")}:${String(secs).padStart(2, "0")}`;
 }
 
-async function loadHistory() {
-  const data = await apiFetch("/history");
+async function loadHistory(prefetched = null) {
+  const data = prefetched || await apiFetch("/history");
+  clearTimeout(historyReloadTimer);
+  if (data.complete === false) {
+    // 后端仍在加载较早的记录：先显示已加载的最近部分，稍后重新获取完整历史
+    historyReloadTimer = setTimeout(() => loadHistory().catch(() => {}), HISTORY_RELOAD_MS);
+  }
   messageMap.clear();
   messagesEl.innerHTML = "";
 
@@ -723,16 +847,16 @@ async function loadHistory() {
   });
 }
 
-async function loadConfig() {
-  const data = await apiFetch("/config");
+async function loadConfig(prefetched = null) {
+  const data = prefetched || await apiFetch("/config");
   modelInput.value = data.llm_model || "";
   baseUrlInput.value = data.openai_base_url || "";
   apiKeyInput.value = data.openai_api_key || "";
   docsDirInput.value = data.documents_dir || "";
 }
 
-async function loadDocuments() {
-  const data = await apiFetch("/documents");
+async function loadDocuments(prefetched = null) {
+  const data = prefetched || await apiFetch("/documents");
   if (data.count === 0) {
     docList.textContent = "未找到 .docx 文案文件";
     return;
@@ -740,13 +864,27 @@ async function loadDocuments() {
   docList.innerHTML = data.files.map(name => `<div>${name}</div>`).join("");
 }
 
-async function loadPrompts() {
-  const data = await apiFetch("/prompts");
+async function loadPrompts(prefetched = null) {
+  const data = prefetched || await apiFetch("/prompts");
   systemPromptInput.value = data.system_prompt || "";
   contextPromptInput.value = data.context_intro || "";
 }
 
 function renderScheduler(data) {
+  schedulerSnapshot = { data, receivedAt: Date.now() };
+  paintScheduler();
+}
+
+function paintScheduler() {
+  if (!schedulerSnapshot) {
+    return;
+  }
+  const { receivedAt } = schedulerSnapshot;
+  const data = { ...schedulerSnapshot.data };
+  if (data.active && data.remaining_seconds !== null && data.remaining_seconds !== undefined) {
+    // 本地倒计时，只在服务端推送 scheduler_update 时重新校准
+    data.remaining_seconds = Math.max(0, data.remaining_seconds - (Date.now() - receivedAt) / 1000);
+  }
   if (!data.active) {
     timerStatus.textContent = "未设置";
     timerRemaining.textContent = "--:--";
@@ -774,11 +912,12 @@ function renderScheduler(data) {
   }
 }
 
-async function loadScheduler() {
+async function loadScheduler(prefetched = null) {
   try {
-    const data = await apiFetch("/scheduler");
+    const data = prefetched || await apiFetch("/scheduler");
     renderScheduler(data);
   } catch (err) {
+    schedulerSnapshot = null;
     timerStatus.textContent = "未连接";
     timerRemaining.textContent = "--:--";
     timerMeta.textContent = "";
@@ -881,62 +1020,223 @@ async function clearHistory() {
   setStatus("对话已清空");
 }
 
+function handleServerEvent(event) {
+  if (!event) {
+    return;
+  }
+  if (typeof event.seq === "number") {
+    if (eventCursor !== null && event.type !== "heartbeat" && event.seq <= eventCursor) {
+      return;
+    }
+    eventCursor = event.seq;
+  }
+  if (event.type === "gap") {
+    // 落后于服务端事件缓冲区，部分事件已丢失，直接按历史记录重建
+    eventCursor = event.next;
+    loadHistory().catch(() => {});
+    loadScheduler();
+    return;
+  }
+  if (event.conversation_id && event.conversation_id !== "default") {
+    // 其他对话的后台事件，本窗口只显示默认对话
+    return;
+  }
+  if (event.type === "heartbeat" || event.type === "queued" || event.type === "history_delta" ||
+      event.type === "warmup" || event.type === "reconfigured") {
+    return;
+  }
+  if (event.type === "scheduler_update") {
+    if (event.data) {
+      renderScheduler(event.data);
+    }
+    return;
+  }
+  if (event.type === "chunk") {
+    appendChunk(event.message_id, event.content || "");
+    return;
+  }
+  if (event.type === "replace") {
+    replaceMessage(event.message_id, event.content || "");
+    return;
+  }
+  if (event.type === "tool") {
+    appendToolEvent(event);
+    return;
+  }
+  if (event.type === "error") {
+    showError(event.message_id, event.content || "未知错误");
+    return;
+  }
+  if (event.type === "auto_followup") {
+    appendMessage("assistant", event.message || "");
+    return;
+  }
+  if (event.message) {
+    appendMessage("assistant", event.message);
+    return;
+  }
+  if (event.content) {
+    appendMessage("assistant", event.content);
+  }
+}
+
+function handleEventsError(err) {
+  if (isTimeoutText(String(err))) {
+    if (isStartingUp()) {
+      setStatus("后端启动中...", true);
+    }
+    return;
+  }
+  if (isStartingUp()) {
+    setStatus("后端启动中...", true);
+  } else {
+    setStatus("未连接", false);
+  }
+}
+
 async function pollEvents() {
   if (polling) {
     return;
   }
   polling = true;
   try {
-    const data = await apiFetch("/events", {}, EVENTS_TIMEOUT_MS);
-    if (Array.isArray(data.items)) {
-      data.items.forEach(event => {
-        if (!event) {
-          return;
-        }
-        if (event.type === "chunk") {
-          appendChunk(event.message_id, event.content || "");
-          return;
-        }
-        if (event.type === "replace") {
-          replaceMessage(event.message_id, event.content || "");
-          return;
-        }
-        if (event.type === "tool") {
-          appendToolEvent(event);
-          return;
-        }
-        if (event.type === "error") {
-          showError(event.message_id, event.content || "未知错误");
-          return;
-        }
-        if (event.type === "auto_followup") {
-          appendMessage("assistant", event.message || "");
-          return;
-        }
-        if (event.message) {
-          appendMessage("assistant", event.message);
+    const query = eventCursor === null ? "" : `?after=${eventCursor}`;
+    const data = await apiFetch(`/events${query}`, {}, EVENTS_TIMEOUT_MS);
+    if (data.gap) {
+      handleServerEvent({ type: "gap", next: data.next });
+    } else if (Array.isArray(data.items)) {
+      data.items.forEach(handleServerEvent);
+    }
+    if (typeof data.next === "number") {
+      eventCursor = data.next;
+    }
+    await loadScheduler();
+  } catch (err) {
+    handleEventsError(err);
+  } finally {
+    polling = false;
+  }
+}
+
+async function readEventStream() {
+  const controller = new AbortController();
+  let watchdogId = null;
+  // 超过两个心跳周期没有任何数据，视为连接已失效
+  const armWatchdog = () => {
+    clearTimeout(watchdogId);
+    watchdogId = setTimeout(() => controller.abort(), EVENT_STREAM_IDLE_TIMEOUT_MS);
+  };
+  let reader = null;
+  try {
+    armWatchdog();
+    const query = eventCursor === null ? "" : `?after=${eventCursor}`;
+    const response = await fetch(`${apiBase}/events/stream${query}`, { signal: controller.signal });
+    if (response.status === 404) {
+      return false;
+    }
+    if (!response.ok || !response.body) {
+      throw new Error(`请求失败: ${response.status}`);
+    }
+    await loadScheduler();
+    reader = response.body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    let buffer = "";
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) {
+        break;
+      }
+      armWatchdog();
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split("\n");
+      buffer = lines.pop() || "";
+      lines.forEach(line => {
+        const trimmed = line.trim();
+        if (!trimmed) {
           return;
         }
-        if (event.content) {
-          appendMessage("assistant", event.content);
+        try {
+          handleServerEvent(JSON.parse(trimmed));
+        } catch (err) {
+          // ignore malformed fragments
         }
       });
     }
-    await loadScheduler();
-  } catch (err) {
-    if (isTimeoutText(String(err))) {
-      if (isStartingUp()) {
-        setStatus("后端启动中...", true);
-      }
+    return true;
+  } finally {
+    clearTimeout(watchdogId);
+    try {
+      reader?.cancel();
+    } catch (err) {
+      // ignore
+    }
+  }
+}
+
+// 打开 WebSocket 并订阅事件，连接断开后返回；从未连上时返回 false
+function runSocket() {
+  return new Promise(resolve => {
+    let ws = null;
+    try {
+      ws = new WebSocket(socketUrl);
+    } catch (err) {
+      resolve(false);
       return;
     }
-    if (isStartingUp()) {
-      setStatus("后端启动中...", true);
-    } else {
-      setStatus("未连接", false);
+    let opened = false;
+    let watchdogId = null;
+    // 超过两个心跳周期没有任何数据，视为连接已失效
+    const armWatchdog = () => {
+      clearTimeout(watchdogId);
+      watchdogId = setTimeout(() => ws.close(), EVENT_STREAM_IDLE_TIMEOUT_MS);
+    };
+    ws.onopen = () => {
+      opened = true;
+      socket = ws;
+      armWatchdog();
+      ws.send(JSON.stringify({ type: "subscribe", after: eventCursor }));
+      loadScheduler().catch(() => {});
+    };
+    ws.onmessage = message => {
+      armWatchdog();
+      try {
+        handleSocketMessage(JSON.parse(message.data));
+      } catch (err) {
+        // ignore malformed messages
+      }
+    };
+    ws.onclose = () => {
+      clearTimeout(watchdogId);
+      if (socket === ws) {
+        socket = null;
+      }
+      // 进行中的对话改走 HTTP 续传，服务端不会重新生成
+      Array.from(socketTurns.entries()).forEach(([messageId, turn]) => {
+        resumeStream(messageId, turn.progress).then(done => {
+          finishSocketTurn(messageId, done ? null : new Error("连接已断开"));
+        });
+      });
+      resolve(opened);
+    };
+  });
+}
+
+async function runEventStream() {
+  while (true) {
+    try {
+      const opened = await runSocket();
+      if (!opened) {
+        const supported = await readEventStream();
+        if (!supported) {
+          // 旧后端没有推送接口，退回轮询
+          setInterval(pollEvents, 500);
+          return;
+        }
+      }
+    } catch (err) {
+      handleEventsError(err);
     }
-  } finally {
-    polling = false;
+    await new Promise(resolve => setTimeout(resolve, EVENT_STREAM_RETRY_MS));
   }
 }
 
@@ -969,14 +1269,64 @@ pickDirBtn.addEventListener("click", async () => {
   }
 });
 
+// 启动时一次性拉取的接口及对应的渲染函数
+const STARTUP_LOADERS = [
+  ["/config", loadConfig],
+  ["/prompts", loadPrompts],
+  ["/history", loadHistory],
+  ["/documents", loadDocuments],
+  ["/scheduler", loadScheduler]
+];
+
+// /health 只说明端口已监听；智能体在后台构建完成后 /ready 才返回 200
+async function waitForReady() {
+  while (true) {
+    let data = null;
+    try {
+      const response = await fetchWithTimeout(`${apiBase}/ready?wait=10`, {}, 15000);
+      if (response.ok || response.status === 404) {
+        return;
+      }
+      data = await response.json();
+    } catch (err) {
+      if (!isStartingUp()) {
+        throw err;
+      }
+      await new Promise(resolve => setTimeout(resolve, 500));
+      continue;
+    }
+    if (data && data.error) {
+      throw new Error(data.error);
+    }
+  }
+}
+
+async function loadAll() {
+  let results = new Map();
+  try {
+    const data = await apiFetch("/batch", {
+      method: "POST",
+      body: JSON.stringify({ requests: STARTUP_LOADERS.map(([path]) => ({ id: path, path })) })
+    });
+    (data.items || []).forEach(item => {
+      if (item.status === 200) {
+        results.set(item.id, item.body);
+      }
+    });
+  } catch (err) {
+    // 旧后端没有 /batch，逐个请求
+    results = new Map();
+  }
+  for (const [path, loader] of STARTUP_LOADERS) {
+    await loader(results.get(path) || null);
+  }
+}
+
 async function init() {
   setStatus("后端启动中...", true);
   try {
-    await loadConfig();
-    await loadPrompts();
-    await loadHistory();
-    await loadDocuments();
-    await loadScheduler();
+    await waitForReady();
+    await loadAll();
     setStatus("已连接");
   } catch (err) {
     if (isStartingUp()) {
@@ -985,7 +1335,8 @@ async function init() {
       setStatus("未连接", false);
     }
   }
-  setInterval(pollEvents, 500);
+  setInterval(paintScheduler, 1000);
+  runEventStream();
 }
 
 init();
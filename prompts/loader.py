@@ -17,7 +17,19 @@ class PromptLoader:
         self.context_intro_file = context_intro_file
         self._system_prompt = None
         self._context_intro = None
+        # 与时间无关的提示词片段缓存：(文档内容, 拼好的文本)
+        self._static_tail = None
     
+    def reload(self, system_prompt_file: str = None, context_intro_file: str = None):
+        """切换提示词文件路径（可选）并丢弃全部缓存，下次使用时重新读取"""
+        if system_prompt_file:
+            self.system_prompt_file = system_prompt_file
+        if context_intro_file:
+            self.context_intro_file = context_intro_file
+        self._system_prompt = None
+        self._context_intro = None
+        self._static_tail = None
+
     def load_system_prompt(self) -> str:
         """加载系统提示词"""
         if self._system_prompt is not None:
@@ -56,9 +68,9 @@ class PromptLoader:
 
     
     @staticmethod
-    def get_time_info() -> dict:
-        """获取当前时间信息"""
-        now = datetime.now()
+    def get_time_info(now: datetime = None) -> dict:
+        """获取时间信息（默认当前时间，也可指定时间点用于预生成）"""
+        now = now or datetime.now()
         weekdays = ["星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"]
         hour = now.hour
         
@@ -93,12 +105,19 @@ class PromptLoader:
         # 构建内容
         content = f"{self.load_system_prompt()}\n\n"
         content += f"【当前时间信息】\n今天是：{time_info['date_str']} {time_info['weekday']}\n\n"
-        
+        content += self.build_static_tail(document_context)
+        return content
+
+    def build_static_tail(self, document_context: str = "") -> str:
+        """拼装时间信息之后的固定部分（引导语 + 文档），按文档内容缓存"""
+        cached = self._static_tail
+        if cached is not None and cached[0] is document_context:
+            return cached[1]
+        tail = ""
         context_intro = self.load_context_intro()
         if context_intro:
-            content += f"【背景设定/引导】\n{context_intro}\n\n"
-
+            tail += f"【背景设定/引导】\n{context_intro}\n\n"
         if document_context:
-            content += f"【参考文档内容】\n{document_context}"
-        
-        return content
+            tail += f"【参考文档内容】\n{document_context}"
+        self._static_tail = (document_context, tail)
+        return tail
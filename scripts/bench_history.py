@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+History store memory benchmark.
+
+Generates a synthetic conversation history (user turns, replies, periodic
+tool rounds and system-trigger prompts) and, in a fresh interpreter per
+measurement, reports load time and resident-set growth for:
+
+- dict:    the legacy history file (plain record array) json-loaded as
+           nested dicts, as the store used to hold it
+- compact: core.memory.Memory loading the same history in its current file
+           format (slotted records, shared string table)
+
+plus how long the compact store takes to materialize every record as a dict
+(the cost paid by callers that walk the whole history), and for:
+
+- tail:    the same store opened tail-first (the most recent 200 records
+           read synchronously, older ones streamed in on a background
+           thread): time until the store is usable and until fully loaded
+
+Usage: python scripts/bench_history.py [--sizes 10000 100000]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRIGGER = "（系统自动触发：用户请求你主动追问。" + "请结合此前的对话内容，以老板的口吻追问任务进度，语气简洁有压迫感。" * 6 + "）"
+
+MEASURE = r"""
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+mode, path = sys.argv[1], sys.argv[2]
+if mode in ("compact", "tail"):
+    from core.memory import Memory
+before = rss_kb()
+began = time.perf_counter()
+if mode == "dict":
+    with open(path, encoding="utf-8") as f:
+        store = json.load(f)
+    count = len(store)
+else:
+    store = Memory(path, tail_records=200 if mode == "tail" else 0)
+    count = len(store.get_all())
+load_ms = (time.perf_counter() - began) * 1000
+result = {{"records": count, "load_ms": load_ms}}
+if mode == "tail":
+    store.wait_loaded()
+    result["full_ms"] = (time.perf_counter() - began) * 1000
+result["rss_kb"] = rss_kb() - before
+if mode == "compact":
+    began = time.perf_counter()
+    for record in store.get_all():
+        pass
+    result["materialize_ms"] = (time.perf_counter() - began) * 1000
+print(json.dumps(result))
+"""
+
+
+def make_history(count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    words = ["进度", "报告", "截止", "客户", "合同", "代码", "测试", "上线", "复盘", "预算", "需求", "排期"]
+    records = []
+    for i in range(count):
+        stamp = f"2025-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{i % 59:02d}"
+        if i % 10 == 0:
+            user = TRIGGER
+        else:
+            user = "".join(rng.choice(words) for _ in range(rng.randint(4, 30)))
+        messages = [{"role": "user", "content": user}]
+        if i % 7 == 0:
+            call_id = f"call_{i}"
+            messages.append({"role": "assistant", "content": "", "tool_calls": [{
+                "id": call_id, "type": "function",
+                "function": {"name": "set_deadline", "arguments": json.dumps({"minutes": rng.randint(5, 90)})}
+            }]})
+            messages.append({"role": "tool", "tool_call_id": call_id, "content": "已设置截止时间"})
+        reply = "".join(rng.choice(words) for _ in range(rng.randint(20, 120)))
+        messages.append({"role": "assistant", "content": reply})
+        records.append({"timestamp": stamp, "request_input": user, "messages": messages})
+    return records
+
+
+def convert(legacy_path: str, path: str):
+    """Rewrite a legacy history file in the store's current format."""
+    script = (
+        "import shutil, sys; sys.path.insert(0, {root!r}); from core.memory import Memory; "
+        "shutil.copyfile({src!r}, {dst!r}); Memory({dst!r}).save()"
+    ).format(root=ROOT, src=legacy_path, dst=path)
+    subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True)
+
+
+def measure(mode: str, path: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE.format(root=ROOT), mode, path],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History store memory benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="boss-bench-history-")
+    for size in args.sizes:
+        legacy_path = os.path.join(workdir, f"legacy_{size}.json")
+        path = os.path.join(workdir, f"history_{size}.json")
+        with open(legacy_path, "w", encoding="utf-8") as f:
+            json.dump(make_history(size), f, ensure_ascii=False)
+        convert(legacy_path, path)
+        print(f"\n{size} records ({os.path.getsize(legacy_path) / 1024 / 1024:.1f} MB legacy, "
+              f"{os.path.getsize(path) / 1024 / 1024:.1f} MB current format)")
+        for mode, source in (("dict", legacy_path), ("compact", path), ("tail", path)):
+            stats = measure(mode, source)
+            line = f"  {mode:8s} load {stats['load_ms']:8.0f} ms   rss +{stats['rss_kb'] / 1024:7.1f} MB"
+            if "full_ms" in stats:
+                line += f"   fully loaded after {stats['full_ms']:6.0f} ms"
+            if "materialize_ms" in stats:
+                line += f"   materialize all {stats['materialize_ms']:6.0f} ms"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Backend cold-start benchmark.
+
+1. Import-time profile of `import server` (python -X importtime), summarised
+   as total time plus the slowest modules by cumulative and self time.
+2. Wall-clock time from spawning server.py until /health answers (socket
+   bound) and until /ready answers 200 (agent constructed).
+
+Usage: python scripts/bench_startup.py [--runs 3] [--top 15]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_profile(top: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((self_us, cumulative_us, depth, name.strip()))
+    if not rows:
+        print("import profile unavailable:", result.stderr.strip()[-500:])
+        return
+    total = sum(cumulative for _, cumulative, depth, _ in rows if depth == 0)
+    print(f"import server: {total / 1000:.1f} ms total, {len(rows)} modules")
+    print(f"\nslowest by cumulative time (top {top}):")
+    for self_us, cumulative_us, depth, name in sorted(rows, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:9.1f} ms  {'  ' * depth}{name}")
+    print(f"\nslowest by self time (top {top}):")
+    for self_us, cumulative_us, depth, name in sorted(rows, key=lambda r: r[0], reverse=True)[:top]:
+        print(f"  {self_us / 1000:9.1f} ms  {name}")
+    heavy = ("openai", "httpx", "docx", "pyfiglet", "lxml")
+    loaded = sorted({name for _, _, _, name in rows if name.split(".")[0] in heavy and "." not in name})
+    print("\nheavy modules imported eagerly:", ", ".join(loaded) or "none")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_status(url: str, deadline: float, want: int = 200):
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == want:
+                    return True
+        except urllib.error.HTTPError:
+            pass
+        except OSError:
+            pass
+        time.sleep(0.005)
+    return False
+
+
+def startup_run(timeout: float = 60.0):
+    port = _free_port()
+    env = dict(os.environ, BOSS_DATA_DIR=tempfile.mkdtemp(prefix="boss-bench-"))
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "server.py", "--port", str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = started + timeout
+        base = f"http://127.0.0.1:{port}"
+        health = _wait_status(f"{base}/health", deadline)
+        health_ms = (time.monotonic() - started) * 1000
+        ready = health and _wait_status(f"{base}/ready", deadline)
+        ready_ms = (time.monotonic() - started) * 1000
+        return (health_ms if health else None), (ready_ms if ready else None)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    import_profile(args.top)
+    print(f"\nspawn -> /health and /ready ({args.runs} runs):")
+    for run in range(args.runs):
+        health_ms, ready_ms = startup_run()
+        health_text = "timeout" if health_ms is None else f"{health_ms:.0f} ms"
+        ready_text = "timeout" if ready_ms is None else f"{ready_ms:.0f} ms"
+        print(f"  run {run + 1}: health {health_text}, ready {ready_text}")
+
+
+if __name__ == "__main__":
+    main()
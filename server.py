@@ -5,192 +5,1015 @@ Local HTTP server for Electron integration.
 Provides chat, config, history, and document endpoints.
 """
 import argparse
+import asyncio
+import base64
+import gzip
+import hashlib
 import json
 import os
+import struct
 import threading
 import time
 import uuid
 import traceback
+import zlib
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlencode, urlparse
 
 from config import settings
-from core import BossAgent
+from core import EventBus, EventLog, GenerationCancelled, Subscription
+from core.coalesce import ChunkCoalescer
+from core.conversations import DEFAULT_CONVERSATION, ConversationManager, is_valid_conversation_id
+from core.tokens import token_estimator
 from ui.null_ui import NullUI
 
 
+# 事件流空闲时的心跳间隔（秒）
+EVENT_STREAM_HEARTBEAT_S = 15.0
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# 小于该大小的响应不值得压缩
+GZIP_MIN_BYTES = 1024
+# 单个 /batch 请求最多包含的子请求数
+BATCH_MAX_ITEMS = 16
+# 智能体仍在构建时，普通请求最多等待的秒数，超时返回 503
+STARTUP_WAIT_S = 10.0
+# GET /ready?wait= 允许的最长等待
+READY_MAX_WAIT_S = 30.0
+# 请求体逐块读取的路由（不整体缓冲，也不受请求体大小上限约束）
+STREAMED_BODY_PATHS = frozenset(("/history/import",))
+# 逐块读取请求体/解压时每块的字节数，以及导入时单行的最大字节数
+BODY_READ_BYTES = 64 * 1024
+IMPORT_MAX_LINE_BYTES = 16 * 1024 * 1024
+# 导入结果中最多列出的无效行号
+IMPORT_MAX_ERRORS = 20
+
+
+class QueueFullError(Exception):
+    """Raised when the generation queue cannot accept another request."""
+
+
+class _Ticket:
+    __slots__ = ("kind", "message_id", "conversation_id", "cancelled")
+
+    def __init__(self, kind: str, message_id: str = None, conversation_id: str = DEFAULT_CONVERSATION):
+        self.kind = kind
+        self.message_id = message_id
+        self.conversation_id = conversation_id
+        self.cancelled = False
+
+
+class GenerationQueue:
+    """
+    FIFO queue that runs one LLM generation at a time with a bounded backlog.
+
+    Background prefetches do not take a place in the backlog, and a user turn
+    pre-empts them: queued ones are dropped and a running one is flagged so it
+    stops at its next event.
+    """
+
+    # 可被抢占的后台生成，不计入排队上限
+    PREEMPTIBLE_KINDS = frozenset(("auto_followup_prefetch",))
+    # 用户发起的生成，入队时抢占后台生成
+    PREEMPTING_KINDS = frozenset(("chat", "retry"))
+
+    def __init__(self, max_depth: int):
+        self.max_depth = max(0, int(max_depth))
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._active = None
+
+    def reserve(self, kind: str, merge: bool = False, message_id: str = None,
+                conversation_id: str = DEFAULT_CONVERSATION):
+        """Take a place in line. Returns None when merged into a pending ticket of the same kind and conversation."""
+        with self._cond:
+            if merge and any(ticket.kind == kind and ticket.conversation_id == conversation_id
+                             for ticket in self._pending):
+                return None
+            waiting = sum(1 for ticket in self._pending if ticket.kind not in self.PREEMPTIBLE_KINDS)
+            busy = waiting or (self._active is not None and self._active.kind not in self.PREEMPTIBLE_KINDS)
+            if busy and kind not in self.PREEMPTIBLE_KINDS and waiting >= self.max_depth:
+                raise QueueFullError(kind)
+            if kind in self.PREEMPTING_KINDS:
+                self._preempt_locked()
+            ticket = _Ticket(kind, message_id, conversation_id)
+            self._pending.append(ticket)
+            return ticket
+
+    def _preempt_locked(self):
+        """Cancel queued prefetches and flag a running one (it checks ticket.cancelled between events)."""
+        preempted = False
+        for ticket in self._pending:
+            if ticket.kind in self.PREEMPTIBLE_KINDS:
+                ticket.cancelled = preempted = True
+        if self._active is not None and self._active.kind in self.PREEMPTIBLE_KINDS:
+            self._active.cancelled = preempted = True
+        if preempted:
+            self._cond.notify_all()
+
+    def wait_turn(self, ticket: _Ticket, on_position=None):
+        """Block until the ticket is at the head, reporting how many generations are ahead."""
+        reported = None
+        while True:
+            with self._cond:
+                while True:
+                    if ticket.cancelled:
+                        self._pending.remove(ticket)
+                        self._cond.notify_all()
+                        raise GenerationCancelled(ticket.message_id)
+                    if self._active is None and self._pending[0] is ticket:
+                        self._pending.popleft()
+                        self._active = ticket
+                        return
+                    position = self._pending.index(ticket) + (1 if self._active is not None else 0)
+                    if position != reported:
+                        break
+                    self._cond.wait()
+            reported = position
+            if on_position:
+                # 在锁外回调，避免慢客户端拖住整个队列
+                on_position(position)
+
+    def cancel(self, message_id: str) -> bool:
+        """Cancel a ticket that is still waiting in line."""
+        with self._cond:
+            for ticket in self._pending:
+                if ticket.message_id == message_id:
+                    ticket.cancelled = True
+                    self._cond.notify_all()
+                    return True
+            return False
+
+    def release(self, ticket: _Ticket):
+        with self._cond:
+            if self._active is ticket:
+                self._active = None
+            else:
+                try:
+                    self._pending.remove(ticket)
+                except ValueError:
+                    pass
+            self._cond.notify_all()
+
+
+class _TurnRecord:
+    """Every event of one generation, so late or reconnecting clients can replay and follow it."""
+
+    def __init__(self, message_id: str, kind: str):
+        self.message_id = message_id
+        self.kind = kind
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def append(self, event: dict):
+        with self._cond:
+            if self.done:
+                return
+            self.events.append(event)
+            if event.get("type") == "done":
+                self.done = True
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def finish(self, error: str = "generation_failed"):
+        """Close a turn that ended without a done event (followers get an error)."""
+        with self._cond:
+            if self.done:
+                return
+        self.append({"type": "error", "message_id": self.message_id, "content": error})
+        with self._cond:
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def follow(self, offset: int, send_event, poll_s: float = 1.0):
+        """Send events from offset on, then keep following until the turn is done."""
+        index = max(0, int(offset or 0))
+        state = getattr(send_event, "state", None)
+        while True:
+            with self._cond:
+                while index >= len(self.events) and not self.done:
+                    if state is not None and state["closed"]:
+                        return
+                    self._cond.wait(poll_s)
+                batch = self.events[index:]
+                index += len(batch)
+                finished = self.done
+            for event in batch:
+                send_event(event)
+            if finished and index >= len(self.events):
+                return
+
+    def wait_done(self) -> dict:
+        """Block until the turn finishes; returns its last event."""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+            return self.events[-1] if self.events else {}
+
+
+class TurnCache:
+    """
+    In-flight and recently finished generations keyed by message_id.
+    A repeated submission attaches to the existing turn instead of generating
+    again; finished turns are kept for ttl_s and at most max_items of them.
+    """
+
+    def __init__(self, ttl_s: float, max_items: int):
+        self.ttl_s = max(0.0, ttl_s)
+        self.max_items = max(1, int(max_items))
+        self._lock = threading.Lock()
+        self._turns = {}
+
+    def claim(self, message_id: str, kind: str):
+        """Return (record, created): the existing turn for message_id, or a new one."""
+        with self._lock:
+            self._purge()
+            record = self._turns.get(message_id)
+            if record is not None:
+                return record, False
+            record = _TurnRecord(message_id, kind)
+            self._turns[message_id] = record
+            return record, True
+
+    def get(self, message_id: str):
+        with self._lock:
+            self._purge()
+            return self._turns.get(message_id)
+
+    def drop(self, message_id: str):
+        with self._lock:
+            self._turns.pop(message_id, None)
+
+    def _purge(self):
+        now = time.monotonic()
+        finished = [
+            (record.finished_at, message_id)
+            for message_id, record in self._turns.items()
+            if record.finished_at is not None
+        ]
+        finished.sort()
+        excess = len(finished) - self.max_items
+        for index, (finished_at, message_id) in enumerate(finished):
+            if index < excess or now - finished_at > self.ttl_s:
+                del self._turns[message_id]
+
+
 class AgentService:
     """Wraps BossAgent for HTTP usage."""
 
     def __init__(self):
         self._lock = threading.Lock()
-        self._events = deque()
-        self._events_lock = threading.Lock()
+        # 智能体在后台线程中构建，端口可以先监听、先响应 /health
+        self._ready = threading.Event()
+        self._startup_error = None
+        self._startup_began = time.monotonic()
+        self._startup_elapsed = None
+        self._queue = GenerationQueue(settings.max_queue_depth)
+        # 正在生成的消息，以及被请求取消的消息
+        self._active_message_id = None
+        self._cancel_requested = set()
+        # 按对话缓存的 /history 响应
+        self._history_responses = {}
+        self._turns = TurnCache(settings.turn_cache_ttl_s, settings.turn_cache_size)
+        self._events = EventLog(settings.event_log_capacity)
+        # 生成端与消费者之间的事件总线；metrics 订阅者统计各类事件数量
+        self._bus = EventBus()
+        self._event_counts = {}
+        self._event_counts_lock = threading.Lock()
+        self._stream_totals = {}
+        self._prune_totals = {"turns": 0, "tokens_saved": 0, "stages": {}}
+        self._bus.subscribe(
+            "metrics",
+            self._count_event,
+            capacity=settings.event_queue_capacity,
+            policy=Subscription.DROP_OLDEST
+        )
         self._agent = None
-        self._start_agent()
+        self._conversations = None
+        # 按对话预生成的定时追问；该对话的历史版本号变化即作废
+        self._history_epochs = {}
+        self._prefetches = {}
+        self._prefetch_lock = threading.Lock()
+        threading.Thread(target=self._build_agent, name="agent-startup", daemon=True).start()
+
+    def _build_agent(self):
+        try:
+            with self._lock:
+                self._start_agent()
+        except Exception:
+            self._startup_error = traceback.format_exc()
+            print(f"[server] agent startup failed\n{self._startup_error}")
+        finally:
+            self._startup_elapsed = time.monotonic() - self._startup_began
+            self._ready.set()
+
+    @property
+    def agent(self):
+        """The agent, blocking until background construction has finished."""
+        if not self._ready.is_set():
+            self._ready.wait()
+        if self._agent is None:
+            raise RuntimeError("agent unavailable")
+        return self._agent
+
+    @property
+    def conversations(self) -> ConversationManager:
+        """The conversation cache, blocking until background construction has finished."""
+        if not self._ready.is_set():
+            self._ready.wait()
+        if self._conversations is None:
+            raise RuntimeError("agent unavailable")
+        return self._conversations
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """Wait for startup; returns whether the agent is usable."""
+        self._ready.wait(timeout)
+        return self._ready.is_set() and self._agent is not None
+
+    def get_ready_status(self) -> dict:
+        ready = self._ready.is_set()
+        return {
+            "ready": ready and self._agent is not None,
+            "starting": not ready,
+            "error": self._startup_error,
+            "startup_ms": None if self._startup_elapsed is None else round(self._startup_elapsed * 1000, 1),
+        }
 
     def _start_agent(self):
-        if self._agent is not None:
-            self._agent.shutdown()
-        self._agent = BossAgent(ui=NullUI())
-        self._agent.scheduler.start(self._on_deadline_reached)
+        # 首次使用时才导入，openai/httpx 等依赖不拖慢端口监听
+        from core.agent import BossAgent
 
-    def _on_deadline_reached(self):
-        threading.Thread(target=self._auto_followup_worker, daemon=True).start()
+        if self._conversations is not None:
+            self._conversations.close_all()
+        self._invalidate_prefetch()
+        self._conversations = ConversationManager(
+            settings.conversation_cache_size,
+            on_load=self._start_scheduler,
+            on_evict=self._forget_conversation
+        )
+        conversation = self._conversations.acquire(DEFAULT_CONVERSATION)
+        self._agent = BossAgent(ui=NullUI(), conversation=conversation)
+        self._conversations.release(conversation)
+        # 设置了截止时间的对话需要常驻，定时追问才能按时触发
+        self._conversations.load_scheduled()
+        if settings.warmup_enabled:
+            threading.Thread(target=self._warm_up, args=(self._agent,), name="warmup", daemon=True).start()
 
-    def _auto_followup_worker(self):
-        with self._lock:
-            response = self._agent.handle_auto_followup()
+    def _start_scheduler(self, conversation):
+        """Start a freshly loaded conversation's scheduler with callbacks bound to its id."""
+        conversation_id = conversation.id
+        lead_seconds = settings.followup_prefetch_s
+        conversation.scheduler.start(
+            lambda: self._on_deadline_reached(conversation_id),
+            lead_callback=(lambda: self._on_deadline_approaching(conversation_id)) if lead_seconds > 0 else None,
+            lead_seconds=lead_seconds
+        )
+
+    def _forget_conversation(self, conversation):
+        """Drop the cached response and pending prefetch of an evicted conversation."""
+        self._history_responses.pop(conversation.id, None)
+        self._history_epochs.pop(conversation.id, None)
+        with self._prefetch_lock:
+            self._prefetches.pop(conversation.id, None)
+
+    @contextmanager
+    def _use_conversation(self, conversation_id: str, create: bool = True):
+        """Keep a conversation resident while a request writes to it; KeyError when it does not exist and create is False."""
+        conversation = self.conversations.acquire(conversation_id, create=create)
+        try:
+            yield conversation
+        finally:
+            self.conversations.release(conversation)
+
+    @contextmanager
+    def _locked_conversation(self, conversation_id: str, create: bool = False):
+        """Hold the agent lock with the agent bound to a resident conversation."""
+        with self._use_conversation(conversation_id, create=create) as conversation, self._lock:
+            self.agent.bind_conversation(conversation)
+            yield conversation
+
+    def _conversation(self, conversation_id: str):
+        """
+        Load (or mark as recently used) a conversation for a read-only request.
+        Reads do not pin it: an evicted store stays readable, only writers must not overlap a reload.
+        """
+        conversation = self.conversations.acquire(conversation_id, create=False)
+        self.conversations.release(conversation)
+        return conversation
+
+    def _warm_up(self, agent, only: set = None):
+        """
+        Pay the first-turn costs in the background: parse documents, assemble the
+        prompt, then open a pooled connection to the upstream API.
+        Each stage reports a warmup event; later stages still run if one fails.
+        `only` limits the run to the named stages (after a reconfigure).
+        """
+        conversation = self._conversations.get(DEFAULT_CONVERSATION)
+        stages = (
+            ("documents", lambda: {"chars": len(agent.load_document_context()),
+                                   "tokens": agent.doc_loader.get_token_count(),
+                                   "files": agent.doc_loader.get_file_count()}),
+            ("prompt", lambda: {"chars": agent.warm_up_prompt()}),
+            ("recall", lambda: {"indexed": conversation.recall.refresh(conversation.memory.get_all())}),
+            ("search", lambda: {"indexed": conversation.search_index.refresh(conversation.memory.get_all())}),
+            ("upstream", lambda: {"models": agent.llm.warm_up()} if agent.llm.is_ready else None),
+        )
+        began = time.monotonic()
+        for stage, run in stages:
+            if only is not None and stage not in only:
+                continue
+            if agent is not self._agent:
+                # 配置已更新，新的智能体会自行预热
+                return
+            stage_began = time.monotonic()
+            event = {"type": "warmup", "stage": stage}
+            try:
+                detail = run()
+                event["status"] = "skipped" if detail is None else "done"
+                if detail:
+                    event.update(detail)
+            except Exception as err:
+                event["status"] = "failed"
+                event["error"] = str(err)
+            event["elapsed_ms"] = round((time.monotonic() - stage_began) * 1000, 1)
+            self._push_event(event)
+        self._push_event({
+            "type": "warmup",
+            "stage": "complete",
+            "elapsed_ms": round((time.monotonic() - began) * 1000, 1)
+        })
+
+    def _invalidate_prefetch(self, conversation_id: str = None):
+        """Mark pre-generated followups as stale, of one conversation or all (call with the agent lock held)."""
+        targets = list(self._history_epochs) if conversation_id is None else [conversation_id]
+        for target in targets:
+            self._history_epochs[target] = self._history_epochs.get(target, 0) + 1
+        with self._prefetch_lock:
+            if conversation_id is None:
+                self._prefetches.clear()
+            else:
+                self._prefetches.pop(conversation_id, None)
+
+    @contextmanager
+    def _generation_turn(self, ticket: _Ticket, on_position=None):
+        """
+        Wait for the ticket's turn, then hold the agent lock for the generation
+        with the agent bound to the ticket's conversation, which stays resident until the turn ends.
+        """
+        try:
+            with self._use_conversation(ticket.conversation_id) as conversation:
+                self._queue.wait_turn(ticket, on_position=on_position)
+                with self._lock:
+                    self.agent.bind_conversation(conversation)
+                    self._active_message_id = ticket.message_id
+                    try:
+                        yield conversation
+                    finally:
+                        self._active_message_id = None
+                        self._cancel_requested.discard(ticket.message_id)
+        finally:
+            self._queue.release(ticket)
+
+    def _check_cancelled(self, message_id: str):
+        if message_id in self._cancel_requested:
+            raise GenerationCancelled(message_id)
+
+    def cancel(self, message_id: str) -> bool:
+        """Cancel a queued or running generation; the running one stops at its next event."""
+        if not message_id:
+            return False
+        if self._queue.cancel(message_id):
+            return True
+        if message_id == self._active_message_id:
+            self._cancel_requested.add(message_id)
+            return True
+        return False
+
+    def _queued_callback(self, send_event, message_id: str):
+        def on_position(position: int):
+            send_event({"type": "queued", "message_id": message_id, "position": position})
+        return on_position
+
+    def _on_deadline_reached(self, conversation_id: str = DEFAULT_CONVERSATION):
+        # 同一对话已有排队中的自动追问时直接合并，不重复堆积
+        try:
+            ticket = self._queue.reserve("auto_followup", merge=True, conversation_id=conversation_id)
+        except QueueFullError:
+            print("[server] generation queue full, auto followup dropped")
+            return
+        if ticket is None:
+            return
+        threading.Thread(target=self._auto_followup_worker, args=(ticket,), daemon=True).start()
+
+    def _on_deadline_approaching(self, conversation_id: str = DEFAULT_CONVERSATION):
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return
+        status = conversation.scheduler.get_status()
+        if not status.get("deadline"):
+            return
+        deadline = datetime.fromisoformat(status["deadline"])
+        # 预生成不占排队名额，不会因队列已满被拒绝
+        ticket = self._queue.reserve("auto_followup_prefetch", merge=True, conversation_id=conversation_id)
+        if ticket is None:
+            return
+        slot = {"epoch": None, "prepared": None, "ready": threading.Event()}
+        with self._prefetch_lock:
+            self._prefetches[conversation_id] = slot
+        threading.Thread(target=self._prefetch_worker, args=(ticket, slot, deadline), daemon=True).start()
+
+    def _prefetch_worker(self, ticket: _Ticket, slot: dict, deadline: datetime):
+        def check_preempted(event: dict):
+            # 用户发起的生成会抢占预生成：在下一个事件处停止，让出智能体锁
+            if ticket.cancelled:
+                raise GenerationCancelled(ticket.message_id)
+
+        try:
+            with self._generation_turn(ticket):
+                slot["epoch"] = self._history_epochs.get(ticket.conversation_id, 0)
+                slot["prepared"] = self.agent.prepare_auto_followup(at=deadline, event_callback=check_preempted)
+        except GenerationCancelled:
+            # 被抢占的预生成直接放弃，到点时按常规流程生成追问
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            slot["ready"].set()
+
+    def _take_prefetch(self, conversation_id: str):
+        with self._prefetch_lock:
+            slot = self._prefetches.pop(conversation_id, None)
+        if slot is None:
+            return None
+        # 预生成还没结束时等它完成，比重新生成更快
+        slot["ready"].wait(timeout=settings.llm_timeout_s)
+        return slot
+
+    def _auto_followup_worker(self, ticket: _Ticket):
+        conversation_id = ticket.conversation_id
+        slot = self._take_prefetch(conversation_id)
+        with self._generation_turn(ticket) as conversation:
+            if slot and slot["prepared"] and slot["epoch"] == self._history_epochs.get(conversation_id, 0):
+                response = self.agent.commit_auto_followup(slot["prepared"])
+            else:
+                response = self.agent.handle_auto_followup()
+            self._history_epochs[conversation_id] = self._history_epochs.get(conversation_id, 0) + 1
+            if response:
+                self._push_history_delta("append", len(self.agent.memory.get_all()) - 1)
+            status = conversation.scheduler.get_status()
         if response:
             self._push_event({
                 "type": "auto_followup",
+                "conversation_id": conversation_id,
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
                 "message": response
             })
+        # 截止任务已重新计时，通知客户端刷新倒计时
+        self._push_event({"type": "scheduler_update", "conversation_id": conversation_id, "data": status})
 
     def _push_event(self, event: dict):
-        with self._events_lock:
-            self._events.append(event)
+        self._events.append(event)
 
-    def get_history(self):
-        with self._lock:
-            if self._agent.memory.is_empty():
-                self._agent.handle_startup()
-            items = self._agent.memory.get_all()
-            return [
-                {"record_index": index, **record}
-                for index, record in enumerate(items)
-            ]
-
-    def get_history_record(self, record_index: int) -> dict:
-        with self._lock:
-            items = self._agent.memory.get_all()
-            if record_index < 0 or record_index >= len(items):
-                return {}
-            return items[record_index]
+    def _push_history_delta(self, op: str, record_index: int = None):
+        """Publish a change to the bound conversation's history so connected clients can patch their view in place."""
+        event = {"type": "history_delta", "conversation_id": self.agent.conversation.id, "op": op}
+        if record_index is not None:
+            items = self.agent.memory.get_all()
+            if 0 <= record_index < len(items):
+                event["record_index"] = record_index
+                event["record"] = items[record_index]
+        self._push_event(event)
 
-    def chat(self, message: str, message_id: str = None) -> dict:
-        message_id = message_id or str(uuid.uuid4())
+    def get_history_encoded(self, conversation_id: str = DEFAULT_CONVERSATION) -> "EncodedResponse":
+        """The /history body assembled from the memory's cached record bytes, reused while unchanged."""
+        with self._locked_conversation(conversation_id) as conversation:
+            memory = conversation.memory
+            if memory.is_empty():
+                self.agent.handle_startup()
+            # While older records are still loading in the background, serve the
+            # loaded tail right away and mark it incomplete; its ETag differs from
+            # the full listing so the client refetches once loading is done.
+            start = memory.loaded_start
+            etag = memory.etag if not start else f'{memory.etag[:-1]}-from{start}"'
+            cached = self._history_responses.get(conversation.id)
+            if cached is not None and cached.etag == etag:
+                return cached
+            body = b'{"items":' + memory.encoded_items(start)
+            if start:
+                body += b',"start":' + str(start).encode("ascii") + b',"complete":false'
+            body += b"}"
+            response = EncodedResponse(200, body, etag)
+            self._history_responses[conversation.id] = response
+            return response
 
-        def event_callback(event: dict):
-            if "message_id" not in event:
-                event["message_id"] = message_id
-            self._push_event(event)
+    def get_history_record(self, record_index: int, conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        items = self._conversation(conversation_id).memory.get_all()
+        if record_index < 0 or record_index >= len(items):
+            return {}
+        return items[record_index]
 
-        with self._lock:
-            before = len(self._agent.memory.get_all())
-            if message is None:
-                message = ""
-            if not message.strip():
-                response = self._agent.handle_proactive_followup(event_callback=event_callback, message_id=message_id)
+    def export_history(self, conversation_id: str = DEFAULT_CONVERSATION):
+        """History as NDJSON byte chunks, read straight from the store; runs beside generation without the agent lock."""
+        return self._conversation(conversation_id).memory.iter_export(BODY_READ_BYTES)
+
+    def import_history(self, lines, conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        """
+        Append records from NDJSON lines. Records are committed in batches of
+        history_import_batch, each with a single store write under the agent lock,
+        so generation can interleave between batches. Invalid lines are skipped.
+        Importing into an unknown conversation creates it.
+        """
+        with self._use_conversation(conversation_id) as conversation:
+            return self._import_history(lines, conversation)
+
+    def _import_history(self, lines, conversation) -> dict:
+        batch_size = max(1, settings.history_import_batch)
+        result = {"imported": 0, "skipped": 0, "batches": 0, "invalid_lines": [], "complete": True}
+        batch = []
+
+        def commit():
+            with self._lock:
+                self._invalidate_prefetch(conversation.id)
+                start = conversation.memory.import_records(batch)
+                self._push_event({"type": "history_delta", "conversation_id": conversation.id, "op": "import",
+                                  "record_index": start, "count": len(batch)})
+            result["imported"] += len(batch)
+            result["batches"] += 1
+            batch.clear()
+
+        try:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                record = _import_record(line)
+                if record is None:
+                    result["skipped"] += 1
+                    if len(result["invalid_lines"]) < IMPORT_MAX_ERRORS:
+                        result["invalid_lines"].append(number)
+                    continue
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    commit()
+        except (ValueError, OSError, zlib.error, TimeoutError) as err:
+            # 请求体读取或解压失败：已提交的批次保留，未满的一批丢弃
+            result["complete"] = False
+            result["error"] = str(err) or type(err).__name__
+            return result
+        if batch:
+            commit()
+        return result
+
+    def search_history(self, query: str, limit: int = 20, before: int = None,
+                       conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        """Full-text search over history messages, newest first; runs beside generation without the agent lock."""
+        began = time.perf_counter()
+        conversation = self._conversation(conversation_id)
+        result = conversation.search_index.search(query, conversation.memory.get_all(), limit=limit, before=before)
+        result["elapsed_ms"] = round((time.perf_counter() - began) * 1000, 2)
+        return result
+
+    def _count_event(self, event: dict):
+        with self._event_counts_lock:
+            kind = event.get("type") or "unknown"
+            self._event_counts[kind] = self._event_counts.get(kind, 0) + 1
+
+    @contextmanager
+    def _turn_events(self, record: _TurnRecord, send_event):
+        """
+        Route one turn's events through the bus: the generator publishes without
+        blocking and a subscriber thread feeds send_event. Leaving the block waits
+        until every queued event has been delivered.
+
+        Each event is appended to the turn record before it is published, so the
+        record used for resume and duplicate replay is always complete. If the
+        client falls so far behind that its queue overflows, its subscriber stops
+        taking events from the bus and catches up from the record instead.
+        """
+        message_id = record.message_id
+
+        def deliver(event: dict):
+            if event.get("type") == Subscription.OVERFLOW:
+                record.follow(event["accepted"], send_event)
             else:
-                response = self._agent.handle_user_input(message, event_callback=event_callback, message_id=message_id)
-            after = len(self._agent.memory.get_all())
-            saved = after > before
-        record_index = after - 1 if saved else None
-        return {"message_id": message_id, "response": response, "saved": saved, "record_index": record_index}
+                send_event(event)
+
+        def publish(event: dict):
+            if event.get("message_id") != message_id:
+                event = {**event, "message_id": message_id}
+            record.append(event)
+            self._bus.publish(event)
+
+        subscription = self._bus.subscribe(
+            f"turn:{message_id}",
+            deliver,
+            capacity=settings.event_queue_capacity,
+            policy=Subscription.MERGE,
+            accept=lambda event: event.get("message_id") == message_id
+        )
+        try:
+            yield publish
+        finally:
+            # 先结束记录，溢出后改从记录补齐的订阅者才能在退订前读到结尾
+            record.finish()
+            self._bus.unsubscribe(subscription)
+
+    def _record_turn_stats(self) -> dict:
+        """Per-turn stats carried by the done event: stream coalescing, history pruning, token estimates."""
+        return {
+            "stream": self._record_stream_stats(),
+            "context": self._record_prune_report(),
+            "tokens": self.agent.get_token_report()
+        }
+
+    def _record_stream_stats(self) -> dict:
+        """Chunk coalescing stats of the turn that just finished, added to the running totals."""
+        stats = self.agent.get_stream_stats()
+        with self._event_counts_lock:
+            turns = self._stream_totals.get("turns", 0) + 1
+            self._stream_totals = ChunkCoalescer.merge_stats([self._stream_totals, stats])
+            self._stream_totals["turns"] = turns
+            self._stream_totals.pop("first_emit_ms", None)
+        return stats
+
+    def _record_prune_report(self) -> dict:
+        """History pruning report of the turn that just finished, added to per-stage running totals."""
+        report = self.agent.get_prune_report()
+        with self._event_counts_lock:
+            totals = self._prune_totals
+            totals["turns"] += 1
+            totals["tokens_saved"] += report.get("tokens_saved", 0)
+            for stage in report.get("stages", []):
+                totals["stages"][stage["stage"]] = totals["stages"].get(stage["stage"], 0) + stage["tokens_saved"]
+        return report
 
-    def chat_stream(self, message: str, send_event, message_id: str = None) -> str:
+    def get_event_stats(self) -> dict:
+        # 存储统计只针对默认对话，其余对话见 conversations
+        memory = self.conversations.get(DEFAULT_CONVERSATION).memory
+        with self._event_counts_lock:
+            counts = dict(self._event_counts)
+            stream_totals = dict(self._stream_totals)
+            prune_totals = {**self._prune_totals, "stages": dict(self._prune_totals["stages"])}
+        return {
+            "bus": self._bus.get_stats(),
+            "event_counts": counts,
+            "stream": stream_totals,
+            "context_pruning": prune_totals,
+            "tokens": token_estimator.get_stats(),
+            "history_store": {
+                **memory.get_intern_stats(),
+                "records": len(memory.get_all()),
+                "loaded": memory.is_loaded
+            },
+            "conversations": self.conversations.get_stats(),
+            "event_log": {"capacity": self._events.capacity, "last_seq": self._events.last_seq}
+        }
+
+    @contextmanager
+    def _tracked_turn(self, message_id: str, kind: str, send_event):
+        """
+        Record a turn's events in the turn cache while delivering them.
+        Yields None when message_id is already known: the caller should
+        attach to that turn instead of generating again.
+        """
+        record, created = self._turns.claim(message_id, kind)
+        if not created:
+            yield None
+            return
+        try:
+            with self._turn_events(record, send_event) as publish:
+                yield publish
+        except QueueFullError:
+            # 未被接受的提交不占用 message_id，稍后可以原样重试
+            self._turns.drop(message_id)
+            raise
+
+    def has_turn(self, message_id: str) -> bool:
+        return self._turns.get(message_id) is not None
+
+    def resume_stream(self, message_id: str, offset: int, send_event):
+        """Replay a turn's events from offset and follow it until it is done."""
+        record = self._turns.get(message_id)
+        if record is None:
+            send_event({"type": "error", "kind": "unknown_message", "message_id": message_id, "content": "unknown_message"})
+            return
+        record.follow(offset, send_event)
+
+    def chat(self, message: str, message_id: str = None, conversation_id: str = DEFAULT_CONVERSATION) -> dict:
         message_id = message_id or str(uuid.uuid4())
+        with self._tracked_turn(message_id, "chat", self._push_event) as publish:
+            if publish is not None:
+                done = self._run_turn(message, publish, message_id, conversation_id)
+        if publish is None:
+            # 同一 message_id 的重复提交：等待原来的生成结束，返回同样的结果
+            record = self._turns.get(message_id)
+            done = record.wait_done() if record is not None else {}
+        return {key: value for key, value in done.items() if key != "type"}
+
+    def _run_turn(self, message: str, publish, message_id: str, conversation_id: str) -> dict:
+        """
+        Run one chat turn, publishing every event including the final done event,
+        which is also returned: chat() answers with it, chat_stream() only forwards.
+        """
+        ticket = self._queue.reserve("chat", message_id=message_id, conversation_id=conversation_id)
 
         def event_callback(event: dict):
+            self._check_cancelled(message_id)
             if "message_id" not in event:
                 event["message_id"] = message_id
-            send_event(event)
+            publish(event)
 
-        with self._lock:
-            before = len(self._agent.memory.get_all())
-            if message is None:
-                message = ""
-            if not message.strip():
-                response = self._agent.handle_proactive_followup(event_callback=event_callback, message_id=message_id)
-            else:
-                response = self._agent.handle_user_input(message, event_callback=event_callback, message_id=message_id)
-            after = len(self._agent.memory.get_all())
-            saved = after > before
+        try:
+            with self._generation_turn(ticket, on_position=self._queued_callback(publish, message_id)):
+                self._invalidate_prefetch(conversation_id)
+                before = len(self.agent.memory.get_all())
+                if message is None:
+                    message = ""
+                if not message.strip():
+                    response = self.agent.handle_proactive_followup(event_callback=event_callback, message_id=message_id)
+                else:
+                    response = self.agent.handle_user_input(message, event_callback=event_callback, message_id=message_id)
+                after = len(self.agent.memory.get_all())
+                saved = after > before
+                turn_stats = self._record_turn_stats()
+                if saved:
+                    self._push_history_delta("append", after - 1)
+        except GenerationCancelled:
+            done = {"type": "done", "message_id": message_id, "response": "", "saved": False,
+                    "record_index": None, "cancelled": True}
+            publish(done)
+            return done
         record_index = after - 1 if saved else None
-        send_event({
+        done = {
             "type": "done",
             "message_id": message_id,
             "response": response,
             "saved": saved,
-            "record_index": record_index
-        })
+            "record_index": record_index,
+            **turn_stats
+        }
+        publish(done)
+        return done
+
+    def chat_stream(self, message: str, send_event, message_id: str = None,
+                    conversation_id: str = DEFAULT_CONVERSATION) -> str:
+        message_id = message_id or str(uuid.uuid4())
+        with self._tracked_turn(message_id, "chat", send_event) as publish:
+            if publish is not None:
+                self._run_turn(message, publish, message_id, conversation_id)
+                return message_id
+        # 同一 message_id 的重复提交：接上正在进行的生成或重放已缓存的输出
+        self.resume_stream(message_id, 0, send_event)
         return message_id
 
-    def retry_record_stream(self, record_index: int, send_event, message_id: str = None):
+    def retry_record_stream(self, record_index: int, send_event, message_id: str = None,
+                            conversation_id: str = DEFAULT_CONVERSATION):
         message_id = message_id or str(uuid.uuid4())
+        with self._tracked_turn(message_id, "retry", send_event) as publish:
+            if publish is not None:
+                return self._retry_record_stream(record_index, publish, message_id, conversation_id)
+        self.resume_stream(message_id, 0, send_event)
+
+    def _retry_record_stream(self, record_index: int, send_event, message_id: str, conversation_id: str):
+        ticket = self._queue.reserve("retry", message_id=message_id, conversation_id=conversation_id)
 
         def event_callback(event: dict):
+            self._check_cancelled(message_id)
             if "message_id" not in event:
                 event["message_id"] = message_id
             event["record_index"] = record_index
             send_event(event)
 
-        with self._lock:
-            history = self._agent.memory.get_all()
-            if record_index < 0 or record_index >= len(history):
-                send_event({"type": "error", "content": "invalid_record", "message_id": message_id, "record_index": record_index})
-                return
-            request_input = history[record_index].get("request_input", "")
-            # 临时只使用重试前的历史
-            original_history = self._agent.memory.history
-            self._agent.memory.history = history[:record_index]
-            try:
-                response, conversation_messages, should_save = self._agent.generate_response(
+        try:
+            with self._generation_turn(ticket, on_position=self._queued_callback(send_event, message_id)):
+                history = self.agent.memory.get_all()
+                if record_index < 0 or record_index >= len(history):
+                    send_event({"type": "error", "content": "invalid_record", "message_id": message_id, "record_index": record_index})
+                    return
+                self._invalidate_prefetch(conversation_id)
+                request_input = history[record_index].get("request_input", "")
+                # 只使用重试点之前的历史；其他读取者看到的仍是完整历史
+                response, conversation_messages, should_save = self.agent.generate_response(
                     request_input,
                     event_callback=event_callback,
-                    message_id=message_id
+                    message_id=message_id,
+                    history_limit=record_index
                 )
-            finally:
-                self._agent.memory.history = original_history
-            if should_save:
-                self._agent.memory.replace_record(record_index, conversation_messages, request_input=request_input)
+                turn_stats = self._record_turn_stats()
+                if should_save:
+                    # 新回答作为同级分支保存，原回答及其后的对话保留为可切换回去的分支
+                    self.agent.memory.branch(record_index, conversation_messages, request_input=request_input)
+                    self._push_history_delta("branch", record_index)
+        except GenerationCancelled:
+            send_event({"type": "done", "message_id": message_id, "response": "", "saved": False,
+                        "record_index": record_index, "cancelled": True})
+            return
 
         send_event({
             "type": "done",
             "message_id": message_id,
             "response": response,
             "saved": should_save,
-            "record_index": record_index
+            "record_index": record_index,
+            **turn_stats
         })
 
-    def update_history_message(self, record_index: int, message_index: int, role: str, content: str) -> dict:
-        with self._lock:
-            updated = self._agent.memory.update_message(
+    def update_history_message(self, record_index: int, message_index: int, role: str, content: str,
+                               conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        with self._locked_conversation(conversation_id):
+            self._invalidate_prefetch(conversation_id)
+            updated = self.agent.memory.update_message(
                 record_index=record_index,
                 message_index=message_index,
                 role=role,
                 content=content
             )
+            if updated:
+                self._push_history_delta("replace", record_index)
             return {"ok": bool(updated)}
 
-    def clear_history(self):
-        with self._lock:
-            self._agent.memory.clear()
-            self._agent.scheduler.clear_deadline()
-            with self._events_lock:
-                self._events.clear()
-
-    def get_events(self):
-        events = []
-        with self._events_lock:
-            while self._events:
-                events.append(self._events.popleft())
-        return events
+    def get_history_branches(self, record_index: int, conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        return self._conversation(conversation_id).memory.get_branches(record_index) or {}
+
+    def switch_history_branch(self, record_index: int, node_id: int,
+                              conversation_id: str = DEFAULT_CONVERSATION) -> dict:
+        """Make another sibling at record_index the active branch; later records follow that branch."""
+        with self._locked_conversation(conversation_id):
+            switched = self.agent.memory.switch_branch(record_index, node_id)
+            if switched:
+                self._invalidate_prefetch(conversation_id)
+                self._push_history_delta("branch", record_index)
+            return {"ok": switched, "length": len(self.agent.memory.get_all())}
+
+    def clear_history(self, conversation_id: str = DEFAULT_CONVERSATION):
+        with self._locked_conversation(conversation_id):
+            self._invalidate_prefetch(conversation_id)
+            self.agent.memory.clear()
+            self.agent.scheduler.clear_deadline()
+            self._push_history_delta("clear")
+
+    def list_conversations(self) -> dict:
+        """Every known conversation; resident ones carry their record count and scheduler state."""
+        manager = self.conversations
+        resident = {conversation.id: conversation for conversation in manager.resident()}
+        items = []
+        for conversation_id in manager.list_ids():
+            conversation = resident.get(conversation_id)
+            if conversation is not None:
+                items.append(conversation.get_summary())
+            else:
+                items.append({"conversation_id": conversation_id, "resident": False})
+        return {"items": items, "capacity": manager.capacity}
+
+    def get_events(self, after: int = None, limit: int = None) -> dict:
+        """Read events after a cursor without consuming them (see EventLog.read)."""
+        return self._events.read(after, limit=limit)
+
+    def wait_events(self, after: int, timeout: float) -> dict:
+        """Block until events newer than the cursor are pushed (or timeout)."""
+        return self._events.wait(after, timeout)
+
+    def subscribe_events(self, listener):
+        """Call listener() from the pushing thread whenever an event is appended."""
+        self._events.add_listener(listener)
+
+    def unsubscribe_events(self, listener):
+        self._events.remove_listener(listener)
 
     def get_config(self):
         return settings.get_runtime_config()
 
+    def _reconfigure(self, changed: set):
+        """Apply changed settings to the running agent in place (call with the agent lock held)."""
+        if not changed:
+            return
+        applied = self.agent.reconfigure(changed)
+        # 模型、提示词或文档变化后，已预生成的追问不再可用
+        self._invalidate_prefetch()
+        stages = set()
+        if "documents" in applied or "prompts" in applied:
+            stages.update(("documents", "prompt"))
+        if "connection" in applied:
+            stages.add("upstream")
+        if stages and settings.warmup_enabled:
+            threading.Thread(target=self._warm_up, args=(self._agent, stages), name="warmup", daemon=True).start()
+        self._push_event({"type": "reconfigured", "changed": sorted(changed), "applied": applied})
+
     def update_config(self, updates: dict):
         with self._lock:
+            before = settings.get_runtime_config()
             config = settings.update_runtime_config(updates)
-            self._start_agent()
-            return config
+            self._reconfigure({key for key, value in config.items() if before.get(key) != value})
+        return config
 
-    def get_scheduler_status(self):
-        return self._agent.scheduler.get_status()
+    def get_scheduler_status(self, conversation_id: str = DEFAULT_CONVERSATION):
+        return self._conversation(conversation_id).scheduler.get_status()
 
     def list_documents(self):
         documents_dir = settings.documents_dir
@@ -232,6 +1055,7 @@ class AgentService:
             "system_prompt": ("system_prompt.txt", "system_prompt_file"),
             "context_intro": ("context_intro.txt", "context_intro_file")
         }
+        changed = False
         for key, (filename, attr) in mapping.items():
             if key not in updates:
                 continue
@@ -241,14 +1065,471 @@ class AgentService:
                 with open(override_path, "w", encoding="utf-8") as f:
                     f.write(value)
                 setattr(settings, attr, override_path)
+                changed = True
             except Exception:
                 pass
 
-        with self._lock:
-            self._start_agent()
+        if changed:
+            with self._lock:
+                self._reconfigure({"prompts"})
         return self.get_prompts()
 
 
+CORS_HEADERS = (
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+    ("Access-Control-Allow-Headers", "Content-Type"),
+)
+
+
+class JsonResponse:
+    """A complete JSON response."""
+
+    __slots__ = ("status", "payload")
+
+    def __init__(self, status: int, payload):
+        self.status = status
+        self.payload = payload
+
+
+class EncodedResponse:
+    """
+    A pre-encoded JSON body, optionally with a strong ETag.
+    The transport answers If-None-Match with 304 and gzips large bodies on request.
+    """
+
+    __slots__ = ("status", "body", "etag", "_gzipped")
+
+    def __init__(self, status: int, body: bytes, etag: str = None):
+        self.status = status
+        self.body = body
+        self.etag = etag
+        self._gzipped = None
+
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+    def render(self, if_none_match: str = "", accept_encoding: str = ""):
+        """Return (status, headers, body) for the given request headers."""
+        headers = [
+            ("Content-Type", "application/json; charset=utf-8"),
+            ("Cache-Control", "no-cache"),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if self.etag:
+            headers.append(("ETag", self.etag))
+            tags = [tag.strip() for tag in (if_none_match or "").split(",")]
+            if self.etag in tags or "*" in tags:
+                return 304, headers, b""
+        body = self.body
+        if len(body) >= GZIP_MIN_BYTES and "gzip" in (accept_encoding or "").lower():
+            body = self.gzipped()
+            headers.append(("Content-Encoding", "gzip"))
+        headers.append(("Content-Length", str(len(body))))
+        return self.status, headers, body
+
+
+class StreamResponse:
+    """An NDJSON response produced by a blocking call: producer(send_event)."""
+
+    __slots__ = ("producer",)
+
+    def __init__(self, producer):
+        self.producer = producer
+
+
+class ByteStreamResponse:
+    """
+    A body produced chunk by chunk from an iterator of bytes, never held in full.
+    download_gzip sends a .gz file; otherwise the body is gzipped on the fly when the client accepts it.
+    """
+
+    __slots__ = ("chunks", "content_type", "filename", "download_gzip")
+
+    def __init__(self, chunks, content_type: str, filename: str = None, download_gzip: bool = False):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.filename = filename
+        self.download_gzip = download_gzip
+
+    def prepare(self, accept_encoding: str = ""):
+        """Return (headers, body chunk iterator) for the given Accept-Encoding."""
+        headers = [("Cache-Control", "no-cache")]
+        filename = self.filename
+        if self.download_gzip:
+            compress = True
+            headers.append(("Content-Type", "application/gzip"))
+            filename = f"{filename}.gz" if filename else None
+        else:
+            compress = "gzip" in (accept_encoding or "").lower()
+            headers.append(("Content-Type", self.content_type))
+            headers.append(("Vary", "Accept-Encoding"))
+            if compress:
+                headers.append(("Content-Encoding", "gzip"))
+        if filename:
+            headers.append(("Content-Disposition", f'attachment; filename="{filename}"'))
+        return headers, self._gzip_chunks() if compress else iter(self.chunks)
+
+    def _gzip_chunks(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in self.chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class RequestBodyStream:
+    """
+    A request body consumed incrementally as NDJSON lines instead of being buffered.
+    read(n) is the transport's blocking read; a gzip Content-Encoding is inflated on the fly.
+    """
+
+    def __init__(self, read, length: int, gzipped: bool = False):
+        self._read = read
+        self.remaining = max(0, length)
+        self._inflater = zlib.decompressobj(31) if gzipped else None
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining <= 0
+
+    def _chunks(self):
+        while self.remaining > 0:
+            data = self._read(min(BODY_READ_BYTES, self.remaining))
+            if not data:
+                raise ValueError("request body ended early")
+            self.remaining -= len(data)
+            if self._inflater is None:
+                yield data
+                continue
+            # 限制每次解压的输出，压缩比很高的请求体也不会一次展开
+            data = self._inflater.decompress(data, BODY_READ_BYTES)
+            while True:
+                yield data
+                if not self._inflater.unconsumed_tail:
+                    break
+                data = self._inflater.decompress(self._inflater.unconsumed_tail, BODY_READ_BYTES)
+        if self._inflater is not None:
+            yield self._inflater.flush()
+
+    def __iter__(self):
+        pending = b""
+        for data in self._chunks():
+            if not data:
+                continue
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            if len(pending) > IMPORT_MAX_LINE_BYTES:
+                raise ValueError("line too long")
+            yield from lines
+        if pending:
+            yield pending
+
+
+class EventStreamResponse:
+    """The long-lived event log stream, starting after the given cursor."""
+
+    __slots__ = ("after",)
+
+    def __init__(self, after: int = None):
+        self.after = after
+
+
+def _query_int(query: str, key: str):
+    """Parse an optional integer query parameter; raises ValueError when malformed."""
+    values = parse_qs(query).get(key)
+    if not values or values[0] == "":
+        return None
+    return int(values[0])
+
+
+def _conversation_id(value):
+    """The requested conversation, the default one when absent; None when the id is malformed."""
+    if value is None or value == "":
+        return DEFAULT_CONVERSATION
+    return value if is_valid_conversation_id(value) else None
+
+
+def _parse_json_body(body: bytes) -> dict:
+    if not body:
+        return {}
+    try:
+        data = json.loads(body.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _import_record(line: bytes):
+    """Parse one exported NDJSON line into a record; None when it is not a valid record."""
+    try:
+        data = json.loads(line)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    data.pop("record_index", None)
+    messages = data.get("messages")
+    if isinstance(messages, list):
+        if not all(isinstance(message, dict) and isinstance(message.get("role"), str) for message in messages):
+            return None
+        return data
+    # 旧格式记录
+    if isinstance(data.get("user_input"), str) and isinstance(data.get("response"), str):
+        return data
+    return None
+
+
+def run_stream_producer(producer, send_event) -> bool:
+    """
+    Run a StreamResponse producer with the shared error handling.
+    Returns False when the request was rejected before anything was sent,
+    so the caller can answer with a plain 429 instead.
+    """
+    try:
+        producer(send_event)
+    except QueueFullError:
+        if not send_event.state["started"]:
+            return False
+        send_event({"type": "error", "kind": "queue_full", "content": "queue_full"})
+    except Exception:
+        send_event({"type": "error", "content": traceback.format_exc()})
+    return True
+
+
+_batch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="batch")
+
+
+def _batch_item(service: AgentService, item) -> bytes:
+    """Run one read-only sub-request and encode it as {"id", "status", "body"}."""
+    if not isinstance(item, dict) or not isinstance(item.get("path"), str):
+        item_id, status, payload = None, 400, {"error": "invalid_request"}
+    else:
+        item_id = item.get("id", item["path"])
+        parsed = urlparse(item["path"])
+        query = item.get("query")
+        if isinstance(query, dict):
+            query = urlencode(query)
+        try:
+            response = route_request(service, "GET", parsed.path, query or parsed.query)
+        except Exception as err:
+            traceback.print_exc()
+            response = JsonResponse(500, {"error": "internal_error", "detail": str(err)})
+        if isinstance(response, EncodedResponse):
+            head = json.dumps({"id": item_id, "status": response.status}, ensure_ascii=False).encode("utf-8")
+            return head[:-1] + b',"body":' + response.body + b"}"
+        if isinstance(response, JsonResponse):
+            status, payload = response.status, response.payload
+        else:
+            status, payload = 400, {"error": "not_batchable"}
+    return json.dumps({"id": item_id, "status": status, "body": payload}, ensure_ascii=False).encode("utf-8")
+
+
+def run_batch(service: AgentService, items: list) -> EncodedResponse:
+    """
+    Answer several GET routes in one response. Sub-requests run concurrently
+    and fail individually: each result carries its own status.
+    """
+    futures = [_batch_executor.submit(_batch_item, service, item) for item in items]
+    parts = [future.result() for future in futures]
+    return EncodedResponse(200, b'{"items":[' + b",".join(parts) + b"]}")
+
+
+def route_request(service: AgentService, method: str, path: str, query: str, body: bytes = b""):
+    """Map a request onto the service. Shared by the threaded and asyncio servers."""
+    invalid = JsonResponse(400, {"error": "invalid_request"})
+    if method == "GET" and path == "/health":
+        return JsonResponse(200, {"status": "ok"})
+    if method == "GET" and path == "/ready":
+        try:
+            wait = float(parse_qs(query).get("wait", ["0"])[0] or 0)
+        except ValueError:
+            return invalid
+        service.wait_ready(min(max(wait, 0.0), READY_MAX_WAIT_S))
+        status = service.get_ready_status()
+        return JsonResponse(200 if status["ready"] else 503, status)
+    if not service.wait_ready(STARTUP_WAIT_S):
+        return JsonResponse(503, {"error": "starting", **service.get_ready_status()})
+    # 对话与历史相关的路由按 conversation_id 区分（GET 取查询参数，POST 取请求体字段），缺省为默认对话
+    missing = JsonResponse(404, {"error": "conversation_not_found"})
+    if method == "GET":
+        conversation_id = _conversation_id((parse_qs(query).get("conversation_id") or [None])[0])
+        if conversation_id is None:
+            return invalid
+        if path.startswith("/history") or path == "/scheduler":
+            if not service.conversations.exists(conversation_id):
+                return missing
+        if path == "/config":
+            return JsonResponse(200, service.get_config())
+        if path == "/conversations":
+            return JsonResponse(200, service.list_conversations())
+        if path == "/history":
+            return service.get_history_encoded(conversation_id)
+        if path == "/history/export":
+            download_gzip = (parse_qs(query).get("gzip") or [""])[0].lower() in ("1", "true")
+            return ByteStreamResponse(
+                service.export_history(conversation_id), "application/x-ndjson; charset=utf-8",
+                filename="history.ndjson", download_gzip=download_gzip
+            )
+        if path == "/history/search":
+            try:
+                limit = _query_int(query, "limit")
+                before = _query_int(query, "before")
+            except ValueError:
+                return invalid
+            text = (parse_qs(query).get("q") or [""])[0]
+            if not text.strip():
+                return invalid
+            limit = 20 if limit is None else max(1, min(limit, 200))
+            return JsonResponse(200, service.search_history(text, limit=limit, before=before,
+                                                            conversation_id=conversation_id))
+        if path == "/history/record":
+            try:
+                index = _query_int(query, "index")
+            except ValueError:
+                return invalid
+            if index is None:
+                return invalid
+            record = service.get_history_record(index, conversation_id)
+            if not record:
+                return JsonResponse(404, {"error": "not_found"})
+            return JsonResponse(200, record)
+        if path == "/history/branches":
+            try:
+                index = _query_int(query, "index")
+            except ValueError:
+                return invalid
+            if index is None:
+                return invalid
+            branches = service.get_history_branches(index, conversation_id)
+            if not branches:
+                return JsonResponse(404, {"error": "not_found"})
+            return JsonResponse(200, branches)
+        if path == "/events":
+            try:
+                after = _query_int(query, "after")
+                limit = _query_int(query, "limit")
+            except ValueError:
+                return invalid
+            return JsonResponse(200, service.get_events(after, limit=limit))
+        if path == "/chat/stream/resume":
+            message_id = (parse_qs(query).get("message_id") or [""])[0]
+            try:
+                offset = _query_int(query, "offset") or 0
+            except ValueError:
+                return invalid
+            if not message_id:
+                return invalid
+            if not service.has_turn(message_id):
+                return JsonResponse(404, {"error": "not_found"})
+            return StreamResponse(lambda send_event: service.resume_stream(message_id, offset, send_event))
+        if path == "/events/stats":
+            return JsonResponse(200, service.get_event_stats())
+        if path == "/events/stream":
+            try:
+                after = _query_int(query, "after")
+            except ValueError:
+                return invalid
+            return EventStreamResponse(after)
+        if path == "/documents":
+            return JsonResponse(200, service.list_documents())
+        if path == "/scheduler":
+            return JsonResponse(200, service.get_scheduler_status(conversation_id))
+        if path == "/prompts":
+            return JsonResponse(200, service.get_prompts())
+        return JsonResponse(404, {"error": "not_found"})
+
+    if method != "POST":
+        return JsonResponse(405, {"error": "method_not_allowed"})
+    if path == "/history/import":
+        # 请求体是 NDJSON，conversation_id 放在查询参数中；导入到不存在的对话时新建
+        conversation_id = _conversation_id((parse_qs(query).get("conversation_id") or [None])[0])
+        if conversation_id is None:
+            return invalid
+        lines = body if isinstance(body, RequestBodyStream) else body.splitlines()
+        result = service.import_history(lines, conversation_id)
+        return JsonResponse(200 if result["complete"] else 400, result)
+    data = _parse_json_body(body)
+    conversation_id = _conversation_id(data.get("conversation_id"))
+    if conversation_id is None:
+        return invalid
+    if path.startswith("/history/") and not service.conversations.exists(conversation_id):
+        return missing
+    if path == "/batch":
+        items = data.get("requests")
+        if not isinstance(items, list) or len(items) > BATCH_MAX_ITEMS:
+            return invalid
+        return run_batch(service, items)
+    if path == "/chat":
+        try:
+            payload = service.chat(data.get("message", ""), message_id=data.get("message_id"),
+                                   conversation_id=conversation_id)
+        except QueueFullError:
+            return JsonResponse(429, {"error": "queue_full"})
+        return JsonResponse(200, payload)
+    if path == "/chat/stream":
+        message = data.get("message", "")
+        message_id = data.get("message_id")
+        return StreamResponse(
+            lambda send_event: service.chat_stream(message, send_event=send_event, message_id=message_id,
+                                                   conversation_id=conversation_id)
+        )
+    if path == "/chat/stream/resume":
+        message_id = data.get("message_id")
+        offset = data.get("offset") or 0
+        if not message_id or not isinstance(offset, int):
+            return invalid
+        if not service.has_turn(str(message_id)):
+            return JsonResponse(404, {"error": "not_found"})
+        return StreamResponse(lambda send_event: service.resume_stream(str(message_id), offset, send_event))
+    if path == "/chat/cancel":
+        message_id = data.get("message_id")
+        if not message_id:
+            return invalid
+        return JsonResponse(200, {"ok": service.cancel(str(message_id))})
+    if path == "/history/retry/stream":
+        record_index = data.get("record_index")
+        message_id = data.get("message_id")
+        if record_index is None:
+            return invalid
+        return StreamResponse(
+            lambda send_event: service.retry_record_stream(int(record_index), send_event=send_event,
+                                                           message_id=message_id, conversation_id=conversation_id)
+        )
+    if path == "/config":
+        return JsonResponse(200, service.update_config(data))
+    if path == "/prompts":
+        return JsonResponse(200, service.update_prompts(data))
+    if path == "/history/clear":
+        service.clear_history(conversation_id)
+        return JsonResponse(200, {"ok": True})
+    if path == "/history/branch/switch":
+        record_index = data.get("record_index")
+        node_id = data.get("node_id")
+        if not isinstance(record_index, int) or not isinstance(node_id, int):
+            return invalid
+        return JsonResponse(200, service.switch_history_branch(record_index, node_id, conversation_id))
+    if path == "/history/update":
+        record_index = data.get("record_index")
+        message_index = data.get("message_index")
+        role = data.get("role")
+        content = data.get("content", "")
+        if record_index is None or role is None:
+            return invalid
+        result = service.update_history_message(
+            record_index=int(record_index),
+            message_index=None if message_index is None else int(message_index),
+            role=str(role),
+            content=str(content),
+            conversation_id=conversation_id
+        )
+        return JsonResponse(200, result)
+    return JsonResponse(404, {"error": "not_found"})
+
+
 def make_handler(service: AgentService):
     class Handler(BaseHTTPRequestHandler):
         def _send_json(self, status: int, payload: dict):
@@ -256,176 +1537,713 @@ def make_handler(service: AgentService):
             self.send_response(status)
             self.send_header("Content-Type", "application/json; charset=utf-8")
             self.send_header("Content-Length", str(len(body)))
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type")
+            for name, value in CORS_HEADERS:
+                self.send_header(name, value)
             self.end_headers()
             self.wfile.write(body)
 
-        def _read_json(self) -> dict:
+        def _send_encoded(self, response: EncodedResponse):
+            status, headers, body = response.render(
+                self.headers.get("If-None-Match", ""), self.headers.get("Accept-Encoding", "")
+            )
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            for name, value in CORS_HEADERS:
+                self.send_header(name, value)
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def _read_body(self) -> bytes:
             length = int(self.headers.get("Content-Length", 0))
             if length <= 0:
-                return {}
-            raw = self.rfile.read(length)
-            try:
-                return json.loads(raw.decode("utf-8"))
-            except json.JSONDecodeError:
-                return {}
+                return b""
+            return self.rfile.read(length)
 
-        def do_OPTIONS(self):
-            self.send_response(204)
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type")
-            self.end_headers()
+        def _body_stream(self) -> RequestBodyStream:
+            gzipped = "gzip" in self.headers.get("Content-Encoding", "").lower()
+            return RequestBodyStream(self.rfile.read, int(self.headers.get("Content-Length", 0)), gzipped)
 
-        def do_GET(self):
-            parsed = urlparse(self.path)
-            path = parsed.path
-            if path == "/health":
-                self._send_json(200, {"status": "ok"})
-                return
-            if path == "/config":
-                self._send_json(200, service.get_config())
-                return
-            if path == "/history":
-                self._send_json(200, {"items": service.get_history()})
+        def _send_byte_stream(self, response: ByteStreamResponse):
+            headers, chunks = response.prepare(self.headers.get("Accept-Encoding", ""))
+            self.send_response(200)
+            for name, value in headers:
+                self.send_header(name, value)
+            # HTTP/1.0 且无 Content-Length，只能靠关闭连接结束响应
+            self.send_header("Connection", "close")
+            for name, value in CORS_HEADERS:
+                self.send_header(name, value)
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionError):
                 return
-            if path == "/history/record":
-                params = dict(part.split("=", 1) for part in parsed.query.split("&") if "=" in part)
-                if "index" not in params:
-                    self._send_json(400, {"error": "invalid_request"})
-                    return
+
+        def _ndjson_sender(self):
+            """Build a send_event callback; headers go out with the first event."""
+            state = {"started": False, "closed": False}
+
+            def send_event(event: dict):
                 try:
-                    index = int(params["index"])
-                except ValueError:
-                    self._send_json(400, {"error": "invalid_request"})
+                    if not state["started"]:
+                        state["started"] = True
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+                        self.send_header("Cache-Control", "no-cache")
+                        # HTTP/1.0 且无 Content-Length，只能靠关闭连接结束响应
+                        self.send_header("Connection", "close")
+                        for name, value in CORS_HEADERS:
+                            self.send_header(name, value)
+                        self.end_headers()
+                    payload = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
+                    self.wfile.write(payload)
+                    self.wfile.flush()
+                except BrokenPipeError:
+                    state["closed"] = True
                     return
-                record = service.get_history_record(index)
-                if not record:
-                    self._send_json(404, {"error": "not_found"})
+                except Exception:
+                    state["closed"] = True
                     return
-                self._send_json(200, record)
-                return
-            if path == "/events":
-                self._send_json(200, {"items": service.get_events()})
+
+            send_event.state = state
+            return send_event
+
+        def _stream_events(self, after: int = None):
+            """Long-lived NDJSON stream: events as soon as they are pushed, heartbeats when idle."""
+            send_event = self._ndjson_sender()
+            cursor = service.get_events(after)["next"] if after is None else after
+            send_event({"type": "heartbeat", "seq": cursor})
+            while not send_event.state["closed"]:
+                batch = service.wait_events(cursor, EVENT_STREAM_HEARTBEAT_S)
+                if batch["gap"]:
+                    send_event({"type": "gap", "after": cursor, "next": batch["next"]})
+                    cursor = batch["next"]
+                if not batch["items"]:
+                    send_event({"type": "heartbeat", "seq": cursor})
+                    continue
+                for event in batch["items"]:
+                    send_event(event)
+                cursor = batch["next"]
+
+        def _dispatch(self, method: str):
+            parsed = urlparse(self.path)
+            if method != "POST":
+                body = b""
+            elif parsed.path in STREAMED_BODY_PATHS:
+                body = self._body_stream()
+            else:
+                body = self._read_body()
+            response = route_request(service, method, parsed.path, parsed.query, body)
+            if isinstance(response, StreamResponse):
+                if not run_stream_producer(response.producer, self._ndjson_sender()):
+                    self._send_json(429, {"error": "queue_full"})
                 return
-            if path == "/documents":
-                self._send_json(200, service.list_documents())
+            if isinstance(response, EventStreamResponse):
+                self._stream_events(response.after)
                 return
-            if path == "/scheduler":
-                self._send_json(200, service.get_scheduler_status())
+            if isinstance(response, EncodedResponse):
+                self._send_encoded(response)
                 return
-            if path == "/prompts":
-                self._send_json(200, service.get_prompts())
+            if isinstance(response, ByteStreamResponse):
+                self._send_byte_stream(response)
                 return
-            self._send_json(404, {"error": "not_found"})
+            self._send_json(response.status, response.payload)
+
+        def do_OPTIONS(self):
+            self.send_response(204)
+            for name, value in CORS_HEADERS:
+                self.send_header(name, value)
+            self.end_headers()
+
+        def do_GET(self):
+            self._dispatch("GET")
 
         def do_POST(self):
-            path = urlparse(self.path).path
-            if path == "/chat":
-                data = self._read_json()
-                message = data.get("message", "")
-                message_id = data.get("message_id")
-                payload = service.chat(message, message_id=message_id)
-                self._send_json(200, payload)
-                return
-            if path == "/chat/stream":
-                data = self._read_json()
-                message = data.get("message", "")
-                message_id = data.get("message_id")
-                self.send_response(200)
-                self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
-                self.send_header("Cache-Control", "no-cache")
-                self.send_header("Connection", "keep-alive")
-                self.send_header("Access-Control-Allow-Origin", "*")
-                self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-                self.send_header("Access-Control-Allow-Headers", "Content-Type")
-                self.end_headers()
-
-                def send_event(event: dict):
-                    try:
-                        payload = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
-                        self.wfile.write(payload)
-                        self.wfile.flush()
-                    except BrokenPipeError:
-                        return
-                    except Exception:
-                        return
+            self._dispatch("POST")
 
-                try:
-                    service.chat_stream(message, send_event=send_event, message_id=message_id)
-                except Exception:
-                    send_event({"type": "error", "content": traceback.format_exc()})
-                return
-            if path == "/history/retry/stream":
-                data = self._read_json()
-                record_index = data.get("record_index")
-                message_id = data.get("message_id")
-                if record_index is None:
-                    self._send_json(400, {"error": "invalid_request"})
-                    return
-                self.send_response(200)
-                self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
-                self.send_header("Cache-Control", "no-cache")
-                self.send_header("Connection", "keep-alive")
-                self.send_header("Access-Control-Allow-Origin", "*")
-                self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-                self.send_header("Access-Control-Allow-Headers", "Content-Type")
-                self.end_headers()
-
-                def send_event(event: dict):
-                    try:
-                        payload = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
-                        self.wfile.write(payload)
-                        self.wfile.flush()
-                    except BrokenPipeError:
-                        return
-                    except Exception:
-                        return
+        def log_message(self, format, *args):
+            return
+
+    return Handler
+
+
+class _AsyncRequest:
+    __slots__ = ("method", "target", "version", "headers", "body")
+
+    def __init__(self, method: str, target: str, version: str, headers: dict, body: bytes):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+
+class _TrackedWriter:
+    """StreamWriter wrapper that remembers whether any response bytes were written."""
+
+    __slots__ = ("_writer", "started")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+        self.started = False
 
+    def write(self, data: bytes):
+        self.started = True
+        self._writer.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self._writer, name)
+
+
+class WebSocketConnection:
+    """
+    Server side of RFC 6455 over asyncio streams.
+
+    Handles masked client frames, extended lengths, fragmented messages and
+    the ping/pong/close control frames. Writes are serialized so worker
+    threads and the event follower can share one connection.
+    """
+
+    MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+    WRITE_TIMEOUT_S = 60.0
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._write_lock = asyncio.Lock()
+
+    @staticmethod
+    def accept_key(key: str) -> str:
+        digest = hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()
+        return base64.b64encode(digest).decode("ascii")
+
+    @staticmethod
+    def _unmask(payload: bytes, mask: bytes) -> bytes:
+        if not payload:
+            return payload
+        length = len(payload)
+        key = (mask * (length // 4 + 1))[:length]
+        return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+    async def _read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+        if length > self.MAX_MESSAGE_BYTES:
+            raise ValueError("websocket frame too large")
+        mask = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(length) if length else b""
+        if mask:
+            payload = self._unmask(payload, mask)
+        return bool(first & 0x80), first & 0x0F, payload
+
+    async def recv(self):
+        """Return the next text message, or None once the peer has closed."""
+        fragments = []
+        size = 0
+        while True:
+            try:
+                fin, opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                return None
+            if opcode == 0x8:
+                await self.close(struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else 1000)
+                return None
+            if opcode == 0x9:
+                await self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            size += len(payload)
+            if size > self.MAX_MESSAGE_BYTES:
+                await self.close(1009)
+                return None
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode("utf-8", errors="replace")
+
+    async def _send_frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        async with self._write_lock:
+            if self.closed and opcode != 0x8:
+                raise ConnectionError("websocket closed")
+            self.writer.write(head + payload)
+            await asyncio.wait_for(self.writer.drain(), self.WRITE_TIMEOUT_S)
+
+    async def send_json(self, message: dict):
+        await self.send_bytes(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+    async def send_bytes(self, data: bytes):
+        """Send already encoded UTF-8 JSON as a text frame."""
+        await self._send_frame(0x1, data)
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self._send_frame(0x8, struct.pack("!H", code))
+        except Exception:
+            pass
+
+
+class WebSocketSession:
+    """
+    One /ws client: typed JSON envelopes in both directions.
+
+    Client -> server: chat, retry, resume, cancel, subscribe, request, ping.
+    Server -> client: the same chunk/tool/queued/done/error events as the
+    NDJSON streams, event log entries (with seq) once subscribed, and
+    response/cancelled/pong/error replies. Several turns may be in flight;
+    the generation queue orders them exactly as for HTTP requests.
+    """
+
+    def __init__(self, server: "AsyncHTTPServer", connection: WebSocketConnection):
+        self.server = server
+        self.service = server.service
+        self.connection = connection
+        self._tasks = set()
+        self._follower = None
+
+    async def run(self):
+        try:
+            while True:
+                text = await self.connection.recv()
+                if text is None:
+                    break
                 try:
-                    service.retry_record_stream(int(record_index), send_event=send_event, message_id=message_id)
-                except Exception:
-                    send_event({"type": "error", "content": traceback.format_exc()})
-                return
-            if path == "/config":
-                data = self._read_json()
-                config = service.update_config(data)
-                self._send_json(200, config)
+                    message = json.loads(text)
+                except json.JSONDecodeError:
+                    message = None
+                if not isinstance(message, dict):
+                    await self.connection.send_json({"type": "error", "kind": "invalid_request", "content": "invalid_request"})
+                    continue
+                await self._dispatch(message)
+        finally:
+            if self._follower:
+                self._follower.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            await self.connection.close()
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(self._guard(coroutine))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @staticmethod
+    async def _guard(coroutine):
+        # 客户端断开后的写入失败不需要上报
+        try:
+            await coroutine
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    async def _dispatch(self, message: dict):
+        kind = message.get("type")
+        if kind == "ping":
+            await self.connection.send_json({"type": "pong", "id": message.get("id")})
+        elif kind == "subscribe":
+            if self._follower:
+                self._follower.cancel()
+            after = message.get("after")
+            after = int(after) if isinstance(after, (int, float)) else None
+            self._follower = asyncio.ensure_future(self._guard(self.server.follow_events(after, self.connection.send_json)))
+        elif kind == "chat":
+            text = message.get("message", "")
+            message_id = message.get("message_id") or str(uuid.uuid4())
+            conversation_id = _conversation_id(message.get("conversation_id"))
+            if conversation_id is None:
+                await self.connection.send_json({"type": "error", "kind": "invalid_request", "message_id": message_id, "content": "invalid_request"})
                 return
-            if path == "/prompts":
-                data = self._read_json()
-                prompts = service.update_prompts(data)
-                self._send_json(200, prompts)
+            self._spawn(self._run_turn(
+                message_id,
+                lambda send_event: self.service.chat_stream(text, send_event=send_event, message_id=message_id,
+                                                            conversation_id=conversation_id)
+            ))
+        elif kind == "retry":
+            record_index = message.get("record_index")
+            message_id = message.get("message_id") or str(uuid.uuid4())
+            conversation_id = _conversation_id(message.get("conversation_id"))
+            if not isinstance(record_index, int) or conversation_id is None:
+                await self.connection.send_json({"type": "error", "kind": "invalid_request", "message_id": message_id, "content": "invalid_request"})
                 return
-            if path == "/history/clear":
-                service.clear_history()
-                self._send_json(200, {"ok": True})
+            self._spawn(self._run_turn(
+                message_id,
+                lambda send_event: self.service.retry_record_stream(record_index, send_event=send_event,
+                                                                    message_id=message_id, conversation_id=conversation_id)
+            ))
+        elif kind == "resume":
+            message_id = message.get("message_id")
+            offset = message.get("offset") or 0
+            if not message_id or not isinstance(offset, int):
+                await self.connection.send_json({"type": "error", "kind": "invalid_request", "message_id": message_id, "content": "invalid_request"})
                 return
-            if path == "/history/update":
-                data = self._read_json()
-                record_index = data.get("record_index")
-                message_index = data.get("message_index")
-                role = data.get("role")
-                content = data.get("content", "")
-                if record_index is None or role is None:
-                    self._send_json(400, {"error": "invalid_request"})
-                    return
-                result = service.update_history_message(
-                    record_index=int(record_index),
-                    message_index=None if message_index is None else int(message_index),
-                    role=str(role),
-                    content=str(content)
-                )
-                self._send_json(200, result)
+            self._spawn(self._run_turn(
+                message_id,
+                lambda send_event: self.service.resume_stream(str(message_id), offset, send_event)
+            ))
+        elif kind == "cancel":
+            message_id = message.get("message_id")
+            ok = self.service.cancel(str(message_id)) if message_id else False
+            await self.connection.send_json({"type": "cancelled", "message_id": message_id, "ok": ok})
+        elif kind == "request":
+            self._spawn(self._run_request(message))
+        else:
+            await self.connection.send_json({"type": "error", "kind": "unknown_type", "content": f"unknown type: {kind}"})
+
+    async def _run_turn(self, message_id: str, producer):
+        loop = asyncio.get_running_loop()
+        connection = self.connection
+        state = {"started": False, "closed": False}
+
+        def send_event(event: dict):
+            # 在工作线程中调用：等待写入完成，慢客户端会反压生成端
+            if state["closed"]:
                 return
-            self._send_json(404, {"error": "not_found"})
+            state["started"] = True
+            try:
+                asyncio.run_coroutine_threadsafe(connection.send_json(event), loop).result(connection.WRITE_TIMEOUT_S)
+            except Exception:
+                state["closed"] = True
 
-        def log_message(self, format, *args):
+        send_event.state = state
+        accepted = await loop.run_in_executor(self.server.executor, run_stream_producer, producer, send_event)
+        if not accepted:
+            await connection.send_json({"type": "error", "kind": "queue_full", "message_id": message_id, "content": "queue_full"})
+
+    async def _run_request(self, message: dict):
+        """Generic request/response over the socket, answered through the shared router."""
+        loop = asyncio.get_running_loop()
+        method = str(message.get("method") or "GET").upper()
+        parsed = urlparse(str(message.get("path") or "/"))
+        query = message.get("query")
+        if isinstance(query, dict):
+            query = urlencode(query)
+        body = message.get("body")
+        body = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b""
+        response = await loop.run_in_executor(
+            self.server.executor, route_request, self.service, method, parsed.path, query or parsed.query, body
+        )
+        if isinstance(response, EncodedResponse):
+            # 直接拼接已编码的正文，避免重新序列化
+            head = json.dumps({"type": "response", "id": message.get("id"), "status": response.status},
+                              ensure_ascii=False).encode("utf-8")
+            await self.connection.send_bytes(head[:-1] + b',"body":' + response.body + b"}")
             return
+        if isinstance(response, JsonResponse):
+            status, payload = response.status, response.payload
+        else:
+            # 流式接口请使用 chat/retry/subscribe 消息
+            status, payload = 400, {"error": "use_websocket_message"}
+        await self.connection.send_json({"type": "response", "id": message.get("id"), "status": status, "body": payload})
 
-    return Handler
+
+class AsyncHTTPServer:
+    """
+    asyncio HTTP/1.1 server with the same routes as the threaded handler.
+
+    Connections are kept alive between requests, streaming responses use
+    chunked transfer encoding, and every write awaits drain() so a slow
+    client pushes back on the producer instead of buffering without bound.
+    Idle keep-alive connections and event stream subscribers cost no threads;
+    blocking service calls run on a small worker pool. GET /ws upgrades to a
+    WebSocket carrying chat turns, cancels and events on one connection.
+    """
+
+    MAX_HEADER_BYTES = 64 * 1024
+    MAX_BODY_BYTES = 16 * 1024 * 1024
+    WRITE_TIMEOUT_S = 60.0
+    READ_TIMEOUT_S = 60.0
+
+    def __init__(self, service: AgentService, host: str, port: int, max_workers: int = 16):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http-worker")
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=self.MAX_HEADER_BYTES
+        )
+        print(f"[server] listening on http://{self.host}:{self.port} (asyncio)")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                if not await self._handle_request(request, reader, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            # 客户端在两次请求之间关闭了连接
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        # 逐块读取的请求体留给路由处理，这里不读入
+        streamed = method.upper() == "POST" and urlparse(target).path in STREAMED_BODY_PATHS
+        if length < 0 or (length > self.MAX_BODY_BYTES and not streamed):
+            raise ValueError("invalid content length")
+        body = await reader.readexactly(length) if length and not streamed else b""
+        return _AsyncRequest(method.upper(), target, version.strip(), headers, body)
+
+    @staticmethod
+    def _head(status: int, headers, keep_alive: bool) -> bytes:
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        lines.extend(f"{name}: {value}" for name, value in CORS_HEADERS)
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _write_json(self, writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(self._head(status, (
+            ("Content-Type", "application/json; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ), keep_alive) + body)
+        await writer.drain()
+
+    async def _handle_request(self, request: _AsyncRequest, reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter) -> bool:
+        """
+        Answer one request; returns whether the connection may be reused.
+
+        An unexpected error is answered with 500 while nothing has been written
+        yet; once the response has started the connection is simply closed.
+        """
+        tracked = _TrackedWriter(writer)
+        try:
+            return await self._respond(request, reader, tracked)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            raise
+        except Exception as err:
+            traceback.print_exc()
+            if not tracked.started:
+                await self._write_json(writer, 500, {"error": "internal_error", "detail": str(err)}, False)
+            return False
+
+    async def _respond(self, request: _AsyncRequest, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> bool:
+        keep_alive = request.keep_alive
+        if request.method == "OPTIONS":
+            writer.write(self._head(204, (("Content-Length", "0"),), keep_alive))
+            await writer.drain()
+            return keep_alive
+        parsed = urlparse(request.target)
+        if parsed.path == "/ws" and request.method == "GET":
+            return await self._upgrade_websocket(request, reader, writer)
+        loop = asyncio.get_running_loop()
+        body = request.body
+        if request.method == "POST" and parsed.path in STREAMED_BODY_PATHS:
+            body = await self._body_stream(request, reader, writer)
+        response = await loop.run_in_executor(
+            self.executor, route_request, self.service, request.method, parsed.path, parsed.query, body
+        )
+        if isinstance(body, RequestBodyStream) and not body.exhausted:
+            # 请求体没有读完，连接上剩余的字节无法作为下一个请求解析
+            keep_alive = False
+        if isinstance(response, ByteStreamResponse):
+            return await self._write_byte_stream(request, writer, response) and keep_alive
+        if isinstance(response, StreamResponse):
+            return await self._write_stream(request, writer, response)
+        if isinstance(response, EventStreamResponse):
+            await self._write_event_stream(request, writer, response.after)
+            return False
+        if isinstance(response, EncodedResponse):
+            status, headers, body = response.render(
+                request.headers.get("if-none-match", ""), request.headers.get("accept-encoding", "")
+            )
+            writer.write(self._head(status, headers, keep_alive) + body)
+            await writer.drain()
+            return keep_alive
+        await self._write_json(writer, response.status, response.payload, keep_alive)
+        return keep_alive
+
+    async def _upgrade_websocket(self, request: _AsyncRequest, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> bool:
+        key = request.headers.get("sec-websocket-key")
+        if request.headers.get("upgrade", "").lower() != "websocket" or not key:
+            await self._write_json(writer, 400, {"error": "websocket_upgrade_required"}, request.keep_alive)
+            return request.keep_alive
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {WebSocketConnection.accept_key(key)}\r\n\r\n"
+        ).encode("latin-1"))
+        await writer.drain()
+        await WebSocketSession(self, WebSocketConnection(reader, writer)).run()
+        return False
+
+    async def _body_stream(self, request: _AsyncRequest, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter) -> RequestBodyStream:
+        loop = asyncio.get_running_loop()
+        if request.headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await writer.drain()
+
+        def read(size: int) -> bytes:
+            # 在工作线程中调用，由事件循环读取连接
+            return asyncio.run_coroutine_threadsafe(reader.read(size), loop).result(self.READ_TIMEOUT_S)
+
+        gzipped = "gzip" in request.headers.get("content-encoding", "").lower()
+        return RequestBodyStream(read, int(request.headers.get("content-length") or 0), gzipped)
+
+    async def _write_byte_stream(self, request: _AsyncRequest, writer: asyncio.StreamWriter,
+                                 response: ByteStreamResponse) -> bool:
+        loop = asyncio.get_running_loop()
+        headers, chunks = response.prepare(request.headers.get("accept-encoding", ""))
+        chunked = request.version == "HTTP/1.1"
+        if chunked:
+            headers.append(("Transfer-Encoding", "chunked"))
+        keep_alive = request.keep_alive and chunked
+        writer.write(self._head(200, headers, keep_alive))
+        try:
+            while True:
+                # 每块在工作线程中生成；等待写完再取下一块，内存占用与响应大小无关
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    writer.write(self._frame(request, chunk))
+                    await asyncio.wait_for(writer.drain(), self.WRITE_TIMEOUT_S)
+        except Exception:
+            traceback.print_exc()
+            return False
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return keep_alive
+
+    def _stream_head(self, request: _AsyncRequest) -> bytes:
+        headers = [
+            ("Content-Type", "application/x-ndjson; charset=utf-8"),
+            ("Cache-Control", "no-cache"),
+        ]
+        if request.version == "HTTP/1.1":
+            headers.append(("Transfer-Encoding", "chunked"))
+        return self._head(200, headers, request.keep_alive and request.version == "HTTP/1.1")
+
+    @staticmethod
+    def _frame(request: _AsyncRequest, data: bytes) -> bytes:
+        if request.version != "HTTP/1.1":
+            return data
+        return b"%x\r\n%s\r\n" % (len(data), data)
+
+    async def _write_stream(self, request: _AsyncRequest, writer: asyncio.StreamWriter, response: StreamResponse) -> bool:
+        loop = asyncio.get_running_loop()
+        state = {"started": False, "closed": False}
+
+        async def emit(data: bytes):
+            if not state["started"]:
+                state["started"] = True
+                writer.write(self._stream_head(request))
+            writer.write(self._frame(request, data))
+            await writer.drain()
+
+        def send_event(event: dict):
+            # 在工作线程中调用：等待写入完成，慢客户端会反压生成端
+            if state["closed"]:
+                return
+            payload = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
+            try:
+                asyncio.run_coroutine_threadsafe(emit(payload), loop).result(self.WRITE_TIMEOUT_S)
+            except Exception:
+                state["closed"] = True
+
+        send_event.state = state
+        accepted = await loop.run_in_executor(self.executor, run_stream_producer, response.producer, send_event)
+        if not accepted:
+            await self._write_json(writer, 429, {"error": "queue_full"}, request.keep_alive)
+            return request.keep_alive
+        if state["closed"] or request.version != "HTTP/1.1":
+            return False
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return request.keep_alive
+
+    async def _write_event_stream(self, request: _AsyncRequest, writer: asyncio.StreamWriter, after: int = None):
+        async def emit(event: dict):
+            payload = json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n"
+            writer.write(self._frame(request, payload))
+            await writer.drain()
+
+        writer.write(self._stream_head(request))
+        await self.follow_events(after, emit)
+
+    async def follow_events(self, after, emit):
+        """Feed event log entries after the cursor to emit(), with heartbeats while idle."""
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(wake.set)
+
+        self.service.subscribe_events(notify)
+        try:
+            cursor = self.service.get_events(after)["next"] if after is None else after
+            await emit({"type": "heartbeat", "seq": cursor})
+            while True:
+                wake.clear()
+                batch = self.service.get_events(cursor)
+                if batch["gap"]:
+                    await emit({"type": "gap", "after": cursor, "next": batch["next"]})
+                    cursor = batch["next"]
+                if batch["items"]:
+                    for event in batch["items"]:
+                        await emit(event)
+                    cursor = batch["next"]
+                    continue
+                try:
+                    await asyncio.wait_for(wake.wait(), EVENT_STREAM_HEARTBEAT_S)
+                except asyncio.TimeoutError:
+                    await emit({"type": "heartbeat", "seq": cursor})
+        finally:
+            self.service.unsubscribe_events(notify)
 
 
 def run_server(host: str, port: int):
@@ -440,12 +2258,30 @@ def run_server(host: str, port: int):
         server.server_close()
 
 
+def run_async_server(host: str, port: int):
+    service = AgentService()
+    server = AsyncHTTPServer(service, host, port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
     parser = argparse.ArgumentParser(description="BossAgent local HTTP server")
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--server",
+        choices=["threading", "asyncio"],
+        default=os.getenv("BOSS_SERVER_CORE", "threading"),
+        help="HTTP server core (default: threading)"
+    )
     args = parser.parse_args()
-    run_server(args.host, args.port)
+    if args.server == "asyncio":
+        run_async_server(args.host, args.port)
+    else:
+        run_server(args.host, args.port)
 
 
 if __name__ == "__main__":
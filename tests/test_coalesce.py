@@ -0,0 +1,65 @@
+"""ChunkCoalescer 的单元测试"""
+import time
+import unittest
+
+from core.coalesce import ChunkCoalescer
+
+
+class ChunkCoalescerTest(unittest.TestCase):
+    def test_first_chunk_is_emitted_immediately(self):
+        emitted = []
+        coalescer = ChunkCoalescer(emitted.append, min_interval_s=1, max_interval_s=1)
+        coalescer.add("你")
+        self.assertEqual(emitted, ["你"])
+        coalescer.close(flush=False)
+
+    def test_buffered_chunks_are_merged(self):
+        emitted = []
+        coalescer = ChunkCoalescer(emitted.append, min_interval_s=1, max_interval_s=1)
+        for text in ("a", "b", "c", "d"):
+            coalescer.add(text)
+        stats = coalescer.close()
+        self.assertEqual(emitted, ["a", "bcd"])
+        self.assertEqual(stats["deltas"], 4)
+        self.assertEqual(stats["flushes"], 2)
+
+    def test_flushes_when_max_chars_reached(self):
+        emitted = []
+        coalescer = ChunkCoalescer(emitted.append, min_interval_s=1, max_interval_s=1, max_chars=3)
+        for text in "abcdefg":
+            coalescer.add(text)
+        coalescer.close()
+        self.assertEqual("".join(emitted), "abcdefg")
+        self.assertTrue(all(len(text) <= 3 for text in emitted))
+
+    def test_stalled_buffer_is_flushed_in_background(self):
+        emitted = []
+        coalescer = ChunkCoalescer(emitted.append, min_interval_s=0.01, max_interval_s=0.02)
+        coalescer.add("a")
+        coalescer.add("b")
+        deadline = time.monotonic() + 2
+        while len(emitted) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(emitted, ["a", "b"])
+        coalescer.close()
+
+    def test_close_without_flush_drops_buffer(self):
+        emitted = []
+        coalescer = ChunkCoalescer(emitted.append, min_interval_s=1, max_interval_s=1)
+        coalescer.add("a")
+        coalescer.add("b")
+        coalescer.close(flush=False)
+        coalescer.add("c")
+        self.assertEqual(emitted, ["a"])
+
+    def test_emit_error_is_raised_to_producer(self):
+        def emit(text):
+            raise RuntimeError("closed")
+
+        coalescer = ChunkCoalescer(emit)
+        with self.assertRaises(RuntimeError):
+            coalescer.add("a")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""ConversationManager 的单元测试"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from config import settings
+from core.conversations import DEFAULT_CONVERSATION, ConversationManager, is_valid_conversation_id
+
+
+class ConversationManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        paths = {
+            "data_dir": self.dir.name,
+            "memory_file": os.path.join(self.dir.name, "memory.json"),
+            "task_state_file": os.path.join(self.dir.name, "task_state.json"),
+            "recall_index_file": os.path.join(self.dir.name, "recall_index.json"),
+        }
+        for name, value in paths.items():
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.loaded, self.evicted = [], []
+        self.manager = ConversationManager(
+            2,
+            on_load=lambda conversation: self.loaded.append(conversation.id),
+            on_evict=lambda conversation: self.evicted.append(conversation.id)
+        )
+        self.addCleanup(self.manager.close_all)
+
+    def use(self, conversation_id):
+        conversation = self.manager.acquire(conversation_id)
+        self.manager.release(conversation)
+        return conversation
+
+    def test_conversation_ids(self):
+        self.assertTrue(is_valid_conversation_id("work-2_a"))
+        self.assertFalse(is_valid_conversation_id("../etc"))
+        self.assertFalse(is_valid_conversation_id(""))
+
+    def test_evicts_least_recently_used(self):
+        self.use(DEFAULT_CONVERSATION)
+        self.use("a")
+        self.use("b")
+        self.assertEqual(self.evicted, ["a"])
+        self.assertEqual([c.id for c in self.manager.resident()], [DEFAULT_CONVERSATION, "b"])
+        self.assertEqual(self.manager.get_stats()["evictions"], 1)
+
+    def test_default_and_in_use_conversations_stay_resident(self):
+        self.use(DEFAULT_CONVERSATION)
+        busy = self.manager.acquire("a")
+        self.use("b")
+        self.assertEqual(self.evicted, ["b"])
+        self.manager.release(busy)
+        self.assertIsNotNone(self.manager.get("a"))
+        self.assertIsNotNone(self.manager.get(DEFAULT_CONVERSATION))
+
+    def test_deadline_pins_conversation(self):
+        self.use(DEFAULT_CONVERSATION)
+        with mock.patch("builtins.print"):
+            self.use("a").scheduler.set_deadline(30)
+        self.use("b")
+        self.assertEqual(self.evicted, ["b"])
+
+    def test_evicted_conversation_reloads_from_disk(self):
+        self.use(DEFAULT_CONVERSATION)
+        conversation = self.manager.acquire("a")
+        conversation.memory.add([{"role": "user", "content": "你好"}])
+        self.manager.release(conversation)
+        self.use("b")
+        self.assertIsNone(self.manager.get("a"))
+        self.assertEqual(self.manager.list_ids(), [DEFAULT_CONVERSATION, "a", "b"])
+        self.assertEqual(len(self.use("a").memory.get_all()), 1)
+        self.assertEqual(self.loaded.count("a"), 2)
+
+    def test_acquire_without_create(self):
+        with self.assertRaises(KeyError):
+            self.manager.acquire("missing", create=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
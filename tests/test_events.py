@@ -0,0 +1,119 @@
+"""EventLog 与 EventBus 的单元测试"""
+import threading
+import time
+import unittest
+
+from core.events import EventBus, EventLog, Subscription
+
+
+class EventLogTest(unittest.TestCase):
+    def test_read_after_cursor(self):
+        log = EventLog(capacity=10)
+        for i in range(3):
+            log.append({"type": "chunk", "n": i})
+        batch = log.read(1)
+        self.assertEqual([event["seq"] for event in batch["items"]], [2, 3])
+        self.assertEqual(batch["next"], 3)
+        self.assertFalse(batch["gap"])
+
+    def test_read_without_cursor_returns_position_only(self):
+        log = EventLog()
+        log.append({"type": "chunk"})
+        self.assertEqual(log.read(), {"items": [], "next": 1, "gap": False})
+
+    def test_limit(self):
+        log = EventLog()
+        for _ in range(5):
+            log.append({"type": "chunk"})
+        batch = log.read(0, limit=2)
+        self.assertEqual([event["seq"] for event in batch["items"]], [1, 2])
+        self.assertEqual(batch["next"], 2)
+
+    def test_gap_when_reader_falls_behind(self):
+        log = EventLog(capacity=3)
+        for _ in range(6):
+            log.append({"type": "chunk"})
+        batch = log.read(1)
+        self.assertTrue(batch["gap"])
+        self.assertEqual([event["seq"] for event in batch["items"]], [4, 5, 6])
+
+    def test_gap_when_cursor_is_past_the_end(self):
+        # 服务端重启后序号从头开始，客户端带着旧游标回来
+        log = EventLog()
+        log.append({"type": "chunk"})
+        batch = log.read(50)
+        self.assertEqual(batch, {"items": [], "next": 1, "gap": True})
+        self.assertEqual(log.read(batch["next"]), {"items": [], "next": 1, "gap": False})
+
+    def test_wait_does_not_block_on_stale_cursor(self):
+        log = EventLog()
+        started = time.monotonic()
+        batch = log.wait(10, timeout=2)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(batch["gap"])
+
+    def test_wait_wakes_on_append(self):
+        log = EventLog()
+        threading.Timer(0.05, log.append, args=({"type": "done"},)).start()
+        batch = log.wait(0, timeout=2)
+        self.assertEqual([event["type"] for event in batch["items"]], ["done"])
+
+
+class EventBusTest(unittest.TestCase):
+    def test_merge_policy_coalesces_chunks(self):
+        received = []
+        release = threading.Event()
+
+        def handler(event):
+            release.wait(2)
+            received.append(event)
+
+        bus = EventBus()
+        subscription = bus.subscribe("test", handler, capacity=2, policy=Subscription.MERGE)
+        try:
+            bus.publish({"type": "chunk", "message_id": "m", "content": "a"})
+            time.sleep(0.05)
+            for text in "bcd":
+                bus.publish({"type": "chunk", "message_id": "m", "content": text})
+            release.set()
+        finally:
+            bus.unsubscribe(subscription, timeout=2)
+        self.assertEqual("".join(event["content"] for event in received), "abcd")
+
+
+    def blocked_subscription(self, policy, capacity=2):
+        """订阅者卡在第一个事件上，后续事件只能进入队列"""
+        received = []
+        release = threading.Event()
+
+        def handler(event):
+            release.wait(2)
+            received.append(event)
+
+        bus = EventBus()
+        subscription = bus.subscribe("test", handler, capacity=capacity, policy=policy)
+        bus.publish({"type": "chunk", "message_id": "m", "content": "a"})
+        time.sleep(0.05)
+        return bus, subscription, release, received
+
+    def test_drop_oldest_keeps_essential_events(self):
+        bus, subscription, release, received = self.blocked_subscription(Subscription.DROP_OLDEST)
+        for event in ({"type": "tool"}, {"type": "chunk"}, {"type": "chunk"}, {"type": "done"}):
+            bus.publish({**event, "message_id": "m"})
+        release.set()
+        bus.unsubscribe(subscription, timeout=2)
+        self.assertEqual([event["type"] for event in received], ["chunk", "tool", "done"])
+
+    def test_merge_overflow_ends_with_marker(self):
+        bus, subscription, release, received = self.blocked_subscription(Subscription.MERGE)
+        for event_type in ("tool", "chunk", "tool", "done"):
+            bus.publish({"type": event_type, "message_id": "m"})
+        release.set()
+        bus.unsubscribe(subscription, timeout=2)
+        self.assertEqual([event["type"] for event in received], ["chunk", "tool", "chunk", "overflow"])
+        self.assertEqual(received[-1]["accepted"], 3)
+        self.assertTrue(subscription.get_stats()["overflowed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""生成队列与 TurnCache 的单元测试"""
+import threading
+import time
+import unittest
+from unittest import mock
+
+from config import settings
+from core import EventBus, GenerationCancelled
+from server import AgentService, GenerationQueue, QueueFullError, TurnCache
+
+
+class GenerationQueueTest(unittest.TestCase):
+    def test_runs_in_order_and_reports_positions(self):
+        queue = GenerationQueue(max_depth=4)
+        first = queue.reserve("chat", message_id="a")
+        second = queue.reserve("chat", message_id="b")
+        queue.wait_turn(first)
+        positions = []
+        started = threading.Event()
+
+        def run_second():
+            queue.wait_turn(second, on_position=positions.append)
+            started.set()
+
+        thread = threading.Thread(target=run_second)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(started.is_set())
+        queue.release(first)
+        thread.join(2)
+        self.assertTrue(started.is_set())
+        self.assertEqual(positions, [1])
+        queue.release(second)
+
+    def test_rejects_beyond_max_depth(self):
+        queue = GenerationQueue(max_depth=1)
+        active = queue.reserve("chat")
+        queue.wait_turn(active)
+        queue.reserve("chat")
+        with self.assertRaises(QueueFullError):
+            queue.reserve("chat")
+
+    def test_merges_pending_ticket_of_same_kind_and_conversation(self):
+        queue = GenerationQueue(max_depth=4)
+        queue.wait_turn(queue.reserve("chat"))
+        self.assertIsNotNone(queue.reserve("auto_followup", merge=True, conversation_id="a"))
+        self.assertIsNone(queue.reserve("auto_followup", merge=True, conversation_id="a"))
+        self.assertIsNotNone(queue.reserve("auto_followup", merge=True, conversation_id="b"))
+
+    def test_cancel_waiting_ticket(self):
+        queue = GenerationQueue(max_depth=4)
+        queue.wait_turn(queue.reserve("chat", message_id="a"))
+        waiting = queue.reserve("chat", message_id="b")
+        self.assertTrue(queue.cancel("b"))
+        with self.assertRaises(GenerationCancelled):
+            queue.wait_turn(waiting)
+
+    def test_prefetch_does_not_count_against_depth(self):
+        queue = GenerationQueue(max_depth=0)
+        prefetch = queue.reserve("auto_followup_prefetch")
+        queue.wait_turn(prefetch)
+        queue.reserve("chat")
+
+    def test_user_turn_preempts_prefetch(self):
+        queue = GenerationQueue(max_depth=4)
+        running = queue.reserve("auto_followup_prefetch", conversation_id="a")
+        queue.wait_turn(running)
+        waiting = queue.reserve("auto_followup_prefetch", conversation_id="b")
+        chat = queue.reserve("chat", message_id="m")
+        self.assertTrue(running.cancelled)
+        with self.assertRaises(GenerationCancelled):
+            queue.wait_turn(waiting)
+        queue.release(running)
+        queue.wait_turn(chat)
+        self.assertFalse(chat.cancelled)
+
+    def test_auto_followup_does_not_preempt_prefetch(self):
+        queue = GenerationQueue(max_depth=4)
+        running = queue.reserve("auto_followup_prefetch")
+        queue.wait_turn(running)
+        queue.reserve("auto_followup")
+        self.assertFalse(running.cancelled)
+
+
+class TurnCacheTest(unittest.TestCase):
+    def test_repeated_claim_returns_same_turn(self):
+        cache = TurnCache(ttl_s=60, max_items=10)
+        record, created = cache.claim("m1", "chat")
+        again, created_again = cache.claim("m1", "chat")
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertIs(record, again)
+
+    def test_follow_replays_then_waits_for_done(self):
+        cache = TurnCache(ttl_s=60, max_items=10)
+        record, _ = cache.claim("m1", "chat")
+        record.append({"type": "chunk", "content": "a"})
+        record.append({"type": "chunk", "content": "b"})
+        threading.Timer(0.05, record.append, args=({"type": "done", "response": "ab"},)).start()
+        events = []
+        record.follow(1, events.append, poll_s=0.01)
+        self.assertEqual([event["type"] for event in events], ["chunk", "done"])
+        self.assertEqual(events[0]["content"], "b")
+        self.assertEqual(record.wait_done()["response"], "ab")
+
+    def test_finish_without_done_reports_error(self):
+        cache = TurnCache(ttl_s=60, max_items=10)
+        record, _ = cache.claim("m1", "chat")
+        record.finish()
+        self.assertEqual(record.wait_done()["type"], "error")
+        record.append({"type": "done"})
+        self.assertEqual(record.events[-1]["type"], "error")
+
+    def test_keeps_at_most_max_items_finished_turns(self):
+        cache = TurnCache(ttl_s=60, max_items=2)
+        for message_id in ("a", "b", "c"):
+            record, _ = cache.claim(message_id, "chat")
+            record.append({"type": "done"})
+            time.sleep(0.001)
+        in_flight, _ = cache.claim("d", "chat")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        self.assertIs(cache.get("d"), in_flight)
+
+    def test_expired_turns_are_dropped(self):
+        cache = TurnCache(ttl_s=0, max_items=10)
+        record, _ = cache.claim("a", "chat")
+        record.append({"type": "done"})
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+
+
+class TurnEventsTest(unittest.TestCase):
+    def test_slow_client_receives_every_event(self):
+        service = AgentService.__new__(AgentService)
+        service._bus = EventBus()
+        service._turns = TurnCache(ttl_s=60, max_items=10)
+        received = []
+
+        def send_event(event):
+            time.sleep(0.002)
+            received.append(event)
+
+        # chunk 与 tool 交替，队列无法靠合并腾出空间，订阅者会溢出并改从生成记录补齐
+        with mock.patch.object(settings, "event_queue_capacity", 4):
+            with service._tracked_turn("m1", "chat", send_event) as publish:
+                for i in range(30):
+                    publish({"type": "chunk", "message_id": "m1", "content": str(i)})
+                    publish({"type": "tool", "message_id": "m1", "name": f"t{i}"})
+                publish({"type": "done", "message_id": "m1"})
+        self.assertEqual([event["type"] for event in received], ["chunk", "tool"] * 30 + ["done"])
+        self.assertEqual("".join(event.get("content", "") for event in received), "".join(map(str, range(30))))
+        record = service._turns.get("m1")
+        self.assertEqual(len(record.events), 61)
+
+
+if __name__ == "__main__":
+    unittest.main()
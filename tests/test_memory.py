@@ -0,0 +1,234 @@
+"""Memory 的单元测试"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from core.memory import Memory
+from core.tokens import token_estimator
+
+
+def turn(text):
+    return [{"role": "user", "content": text}, {"role": "assistant", "content": f"回复：{text}"}]
+
+
+class MemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "memory.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make_memory(self, count=0, **kwargs):
+        memory = Memory(self.path, **kwargs)
+        for i in range(count):
+            memory.add(turn(f"第{i}轮"), request_input=f"第{i}轮")
+        return memory
+
+    def contents(self, memory):
+        return [record["messages"][0]["content"] for record in memory.get_all()]
+
+
+class HistoryViewTest(MemoryTestCase):
+    def test_returned_dicts_are_copies(self):
+        memory = self.make_memory(2)
+        record = memory.get_all()[0]
+        record["messages"][0]["content"] = "改掉"
+        self.assertEqual(memory.get_all()[0]["messages"][0]["content"], "第0轮")
+
+    def test_limited_view_does_not_affect_other_readers(self):
+        memory = self.make_memory(5)
+        limited = memory.get_all(limit=2)
+        self.assertEqual(len(limited), 2)
+        self.assertEqual([record["request_input"] for record in limited], ["第0轮", "第1轮"])
+        self.assertEqual(len(memory.get_all()), 5)
+        with self.assertRaises(IndexError):
+            limited[2]
+
+    def test_reload_and_update(self):
+        memory = self.make_memory(3)
+        self.assertTrue(memory.update_message(1, role="assistant", content="新的回复"))
+        reloaded = Memory(self.path)
+        self.assertEqual(self.contents(reloaded), ["第0轮", "第1轮", "第2轮"])
+        self.assertEqual(reloaded.get_all()[1]["messages"][1]["content"], "新的回复")
+
+    def test_repeated_long_strings_are_shared(self):
+        memory = self.make_memory(intern_min_chars=8)
+        text = "很长的重复内容" * 4
+        memory.add(turn(text))
+        memory.add(turn(text))
+        first, second = memory._records[0], memory._records[1]
+        self.assertIs(first.messages[0].content, second.messages[0].content)
+        self.assertEqual(Memory(self.path, intern_min_chars=8).get_all()[1]["messages"][0]["content"], text)
+
+    def test_single_long_strings_survive_full_save(self):
+        memory = self.make_memory(intern_min_chars=8)
+        text = "只出现过一次的长内容" * 4
+        memory.add([{"role": "user", "content": text}])
+        memory.save()
+        memory.add([{"role": "user", "content": text}])
+        self.assertIs(memory._records[0].messages[0].content, memory._records[1].messages[0].content)
+        self.assertEqual(memory.get_intern_stats()["references"], 2)
+        with open(memory.strings_path, encoding="utf-8") as f:
+            self.assertEqual([json.loads(line)["v"] for line in f], [text])
+
+    def test_missing_string_table_entry_is_reported(self):
+        memory = self.make_memory(intern_min_chars=8)
+        text = "很长的重复内容" * 4
+        memory.add(turn(text))
+        memory.add(turn(text))
+        os.remove(memory.strings_path)
+        with mock.patch("builtins.print") as printed:
+            reloaded = Memory(self.path, intern_min_chars=8)
+        self.assertEqual(reloaded.get_all()[1]["messages"][0]["content"], "")
+        self.assertTrue(any("字符串表" in str(call) for call in printed.call_args_list))
+
+
+class TailLoadTest(MemoryTestCase):
+    def load_gated(self, **kwargs):
+        """加载时让后台线程等待 gate，模拟较早记录尚未读完"""
+        gate = threading.Event()
+        load_older = Memory._load_older
+
+        def gated(memory, *args):
+            gate.wait(5)
+            load_older(memory, *args)
+
+        with mock.patch.object(Memory, "_load_older", gated):
+            memory = Memory(self.path, **kwargs)
+        self.addCleanup(gate.set)
+        return memory, gate
+
+    def test_tail_is_available_before_older_records(self):
+        self.make_memory(10)
+        memory, gate = self.load_gated(tail_records=3)
+        self.assertFalse(memory.is_loaded)
+        self.assertEqual(len(memory.get_all()), 10)
+        self.assertEqual(memory.loaded_start, 7)
+        self.assertEqual(memory.get_all()[9]["request_input"], "第9轮")
+        gate.set()
+        self.assertTrue(memory.wait_loaded(5))
+        self.assertEqual(memory.loaded_start, 0)
+        self.assertEqual(self.contents(memory), [f"第{i}轮" for i in range(10)])
+
+    def test_encoded_tail_does_not_wait(self):
+        self.make_memory(10)
+        memory, gate = self.load_gated(tail_records=3)
+        body = memory.encoded_items(memory.loaded_start)
+        self.assertEqual(body.count(b'"record_index"'), 3)
+        self.assertFalse(memory.is_loaded)
+
+    def test_appends_during_load_keep_their_place(self):
+        self.make_memory(10)
+        memory, gate = self.load_gated(tail_records=3)
+        memory.add(turn("新的一轮"))
+        gate.set()
+        memory.wait_loaded(5)
+        self.assertEqual(self.contents(memory)[-2:], ["第9轮", "新的一轮"])
+        self.assertEqual(len(Memory(self.path, tail_records=3).get_all()), 11)
+
+
+class BranchTest(MemoryTestCase):
+    def test_branch_keeps_original_as_sibling(self):
+        memory = self.make_memory(3)
+        original = memory._records[1].node_id
+        self.assertTrue(memory.branch(1, turn("重试")))
+        self.assertEqual(self.contents(memory), ["第0轮", "重试"])
+        branches = memory.get_branches(1)
+        self.assertEqual(branches["nodes"], sorted([original, branches["active"]]))
+
+    def test_switch_restores_whole_branch(self):
+        memory = self.make_memory(3)
+        original = memory._records[1].node_id
+        memory.branch(1, turn("重试"))
+        retry = memory._records[1].node_id
+        self.assertTrue(memory.switch_branch(1, original))
+        self.assertEqual(self.contents(memory), ["第0轮", "第1轮", "第2轮"])
+        self.assertTrue(memory.switch_branch(1, retry))
+        self.assertEqual(self.contents(memory), ["第0轮", "重试"])
+        self.assertFalse(memory.switch_branch(2, original))
+
+    def test_branch_operations_only_append(self):
+        memory = self.make_memory(3)
+        original = memory._records[1].node_id
+        with open(self.path, "rb") as f:
+            before = f.read()
+        inode = os.stat(self.path).st_ino
+        memory.branch(1, turn("重试"))
+        memory.switch_branch(1, original)
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        with open(self.path, "rb") as f:
+            self.assertTrue(f.read().startswith(before))
+
+    def test_branches_survive_reload(self):
+        memory = self.make_memory(4)
+        original = memory._records[2].node_id
+        memory.branch(2, turn("重试"))
+        memory.add(turn("之后"))
+        for tail_records in (0, 1, 3):
+            reloaded = Memory(self.path, tail_records=tail_records)
+            reloaded.wait_loaded(5)
+            self.assertEqual(self.contents(reloaded), ["第0轮", "第1轮", "重试", "之后"])
+            self.assertIn(original, reloaded.get_branches(2)["nodes"])
+        reloaded.switch_branch(2, original)
+        self.assertEqual(self.contents(Memory(self.path)), ["第0轮", "第1轮", "第2轮", "第3轮"])
+
+    def test_full_save_compacts_superseded_lines(self):
+        memory = self.make_memory(3)
+        original = memory._records[1].node_id
+        memory.branch(1, turn("重试"))
+        memory.switch_branch(1, original)
+        memory.save()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read().count(b"\n"), 4)
+        self.assertEqual(self.contents(Memory(self.path)), ["第0轮", "第1轮", "第2轮"])
+
+
+class LegacyLoadTest(MemoryTestCase):
+    def test_legacy_array_is_converted(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump([{"timestamp": "t", "request_input": "旧", "messages": turn("旧")}], f, ensure_ascii=False)
+        memory = Memory(self.path)
+        self.assertEqual(self.contents(memory), ["旧"])
+        self.assertEqual(self.contents(Memory(self.path)), ["旧"])
+
+    def test_unreadable_file_is_kept_as_backup(self):
+        broken = '[{"timestamp": "t", "messages": [{"role": "user", "content": "半'
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(broken)
+        with mock.patch("builtins.print"):
+            memory = Memory(self.path)
+        self.assertEqual(len(memory.get_all()), 0)
+        with open(f"{self.path}.bak", encoding="utf-8") as f:
+            self.assertEqual(f.read(), broken)
+        memory.add(turn("新的"))
+        self.assertEqual(self.contents(Memory(self.path)), ["新的"])
+
+
+class TokenCountTest(MemoryTestCase):
+    def recount(self, memory):
+        return sum(Memory._count_tokens(record) for record in memory.get_all())
+
+    def test_running_total_follows_changes(self):
+        memory = self.make_memory(5)
+        first = memory.total_tokens()
+        self.assertEqual(first, int(round(self.recount(memory) * token_estimator.factor)))
+        memory.update_message(2, role="assistant", content="很长的新回复" * 20)
+        memory.branch(3, turn("重试"))
+        self.assertEqual(memory.total_tokens(), int(round(self.recount(memory) * token_estimator.factor)))
+        self.assertGreater(memory.total_tokens(), first)
+
+    def test_counts_are_stored_with_records(self):
+        memory = self.make_memory(3)
+        with open(self.path, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f][1:]
+        self.assertEqual([line["t"] for line in lines], [record.tokens for record in memory._records])
+        with mock.patch.object(Memory, "_count_tokens", side_effect=AssertionError("recounted")):
+            self.assertEqual(Memory(self.path).total_tokens(), memory.total_tokens())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+"""ContextPruner 的单元测试"""
+import unittest
+
+from core.pruning import CapMessageLength, CollapseSystemTriggers, ContextPruner, DropToolRounds
+
+
+def tool_turn(text):
+    return [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "t1", "type": "function"}]},
+        {"role": "tool", "tool_call_id": "t1", "content": "工具结果" * 20},
+        {"role": "assistant", "content": f"回复：{text}"},
+    ]
+
+
+class ContextPrunerTest(unittest.TestCase):
+    def test_from_spec(self):
+        pruner = ContextPruner.from_spec("tool_rounds:6, triggers:2,cap:2000:3,unknown:1,cap:x")
+        self.assertEqual(
+            [stage.describe() for stage in pruner.stages],
+            ["tool_rounds:6", "triggers:2", "cap:2000:3"]
+        )
+        self.assertEqual(ContextPruner.from_spec("off").stages, [])
+
+    def test_drop_tool_rounds_keeps_recent_turns(self):
+        turns = [tool_turn("早"), tool_turn("晚")]
+        pruned = DropToolRounds(1).apply(turns)
+        self.assertEqual([message["role"] for message in pruned[0]], ["user", "assistant"])
+        self.assertIs(pruned[1], turns[1])
+
+    def test_collapse_system_triggers(self):
+        trigger = {"role": "user", "content": "（系统自动触发：截止时间已到。请催促用户汇报进度。）"}
+        pruned = CollapseSystemTriggers(0).apply([[trigger]])
+        self.assertEqual(pruned[0][0]["content"], "（系统自动触发：截止时间已到。）")
+        self.assertIn("请催促", trigger["content"])
+
+    def test_cap_message_length(self):
+        turns = [[{"role": "assistant", "content": "长" * 50}], [{"role": "assistant", "content": "长" * 50}]]
+        pruned = CapMessageLength(10, keep_turns=1).apply(turns)
+        self.assertEqual(pruned[0][0]["content"], "长" * 10 + CapMessageLength.SUFFIX)
+        self.assertEqual(pruned[1][0]["content"], "长" * 50)
+
+    def test_run_reports_savings_and_leaves_input_untouched(self):
+        turns = [tool_turn("第一轮"), tool_turn("第二轮")]
+        messages, report = ContextPruner.from_spec("tool_rounds:1").run(turns)
+        self.assertEqual(len(messages), 6)
+        self.assertGreater(report["tokens_saved"], 0)
+        self.assertEqual(report["stages"][0]["tokens_saved"], report["tokens_saved"])
+        self.assertEqual(len(turns[0]), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
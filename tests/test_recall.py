@@ -0,0 +1,55 @@
+"""RecallIndex 的单元测试"""
+import os
+import tempfile
+import unittest
+
+from core.recall import RecallIndex
+
+
+def make_record(text):
+    return {"messages": [{"role": "user", "content": text}, {"role": "assistant", "content": "好的"}]}
+
+
+class RecallIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "recall_index.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_search_ranks_matching_record_first(self):
+        index = RecallIndex(self.path)
+        history = [make_record("今天讨论预算"), make_record("明天安排周报"), make_record("预算超支怎么办")]
+        hits = index.search("预算超支", history, top_k=2)
+        self.assertEqual(hits[0][0], 2)
+        self.assertEqual(index.search("预算", history, top_k=3, limit=1)[0][0], 0)
+
+    def test_refresh_appends_only_changed_records(self):
+        index = RecallIndex(self.path)
+        history = [make_record(f"第{i}条记录") for i in range(5)]
+        self.assertEqual(index.refresh(history), 5)
+        with open(self.path, "rb") as f:
+            lines = f.read().count(b"\n")
+        history.append(make_record("新的记录"))
+        self.assertEqual(index.refresh(history), 1)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read().count(b"\n"), lines + 1)
+
+    def test_reload_restores_updates_and_truncation(self):
+        index = RecallIndex(self.path)
+        history = [make_record(f"第{i}条记录") for i in range(5)]
+        index.refresh(history)
+        history[1] = make_record("改写后的记录")
+        index.mark_dirty(1)
+        index.refresh(history)
+        del history[3:]
+        index.mark_dirty(None)
+        index.refresh(history)
+        reloaded = RecallIndex(self.path)
+        self.assertEqual(reloaded._fingerprints, index._fingerprints)
+        self.assertEqual(reloaded.refresh(history), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""HistorySearchIndex 的单元测试"""
+import unittest
+
+from core.search import HistorySearchIndex
+
+
+def make_record(user, reply="好的"):
+    return {
+        "timestamp": "2026-01-01 09:00:00",
+        "messages": [{"role": "user", "content": user}, {"role": "assistant", "content": reply}]
+    }
+
+
+class HistorySearchIndexTest(unittest.TestCase):
+    def test_all_words_must_match_newest_first(self):
+        index = HistorySearchIndex()
+        history = [make_record("季度预算表"), make_record("预算 会议"), make_record("季度 预算 复盘")]
+        result = index.search("季度 预算", history)
+        self.assertEqual([hit["record_index"] for hit in result["results"]], [2, 0])
+        self.assertIsNone(result["next_before"])
+        self.assertTrue(result["results"][0]["highlights"])
+
+    def test_paging_by_record(self):
+        index = HistorySearchIndex()
+        history = [make_record(f"周报 第{i}周", reply="周报已收到") for i in range(5)]
+        first = index.search("周报", history, limit=3)
+        self.assertEqual([hit["record_index"] for hit in first["results"]][:3], [4, 4, 3])
+        second = index.search("周报", history, limit=3, before=first["next_before"])
+        self.assertTrue(all(hit["record_index"] < first["next_before"] for hit in second["results"]))
+
+    def test_single_character_query_scans(self):
+        index = HistorySearchIndex()
+        history = [make_record("天气不错"), make_record("开会")]
+        result = index.search("会", history)
+        self.assertEqual([hit["record_index"] for hit in result["results"]], [1])
+
+    def test_changed_records_are_reindexed(self):
+        index = HistorySearchIndex()
+        history = [make_record("旧的内容")]
+        self.assertEqual(len(index.search("旧的", history)["results"]), 1)
+        history[0] = make_record("新的内容")
+        index.mark_dirty(0)
+        self.assertEqual(index.search("旧的", history)["results"], [])
+        self.assertEqual(len(index.search("新的", history)["results"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,14 @@
 """
 CyberBoss UI 模块
 """
-from .terminal import TerminalUI
+
+
+def __getattr__(name):
+    # 终端 UI 依赖 pyfiglet/colorama，服务端只用 NullUI，不必加载
+    if name == "TerminalUI":
+        from .terminal import TerminalUI
+        return TerminalUI
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["TerminalUI"]